@@ -8,34 +8,43 @@
 # See the License for the specific language governing permissions and limitations under the License.
 
 """Configures and starts up the Repository Service."""
+import json
+import logging
 import os.path
 
 import tornado.ioloop
 import tornado.httpserver
-from tornado.options import options
+from tornado.options import options, define
 import koi
 
 from .controllers import (
     agreements_handler, assets_handler, capabilities_handler,
-    offers_handler, namespace_handler, sets_handler, root_handler)
+    offers_handler, namespace_handler, sets_handler, stats_handler, root_handler)
 
 from . import __version__
 from . import audit
+from .models.framework import db
 
 
+define('stats_log_interval', help='time in seconds between two logs of the statistics of the process, '
+       '0 to disable them', default=0, type=float)
+
 # directory containing the config files
 CONF_DIR = os.path.join(os.path.dirname(__file__), '../config')
 
 APPLICATION_URLS = [
     (r"", root_handler.RootHandler, {'version': __version__}),
     (r"/capabilities", capabilities_handler.CapabilitiesHandler),
+    (r"/stats", stats_handler.StatsHandler),
     (r"/repositories/{repository_id}/initialise$", namespace_handler.NamespaceHandler),
     (r"/repositories/{repository_id}/assets/identifiers$", assets_handler.IdentifiersHandler),
     (r"/repositories/{repository_id}/assets/{entity_id}/ids$", assets_handler.AssetIDHandler),
     (r"/repositories/{repository_id}/assets$", assets_handler.AssetsHandler),
+    (r"/repositories/{repository_id}/assets/upload$", assets_handler.AssetsUploadHandler),
     (r"/repositories/{repository_id}/assets/{asset_id}$", assets_handler.AssetHandler),
     (r"/repositories/{repository_id}/sets/{set_id}/assets$", sets_handler.SetAssetsHandler),
     (r"/repositories/{repository_id}/sets/{set_id}/assets/{asset_id}$", sets_handler.SetAssetHandler),
+    (r"/repositories/{repository_id}/sets/{set_id}/membership$", sets_handler.SetMembershipHandler),
     (r"/repositories/{repository_id}/sets/{set_id}$", sets_handler.SetHandler),
     (r"/repositories/{repository_id}/sets$", sets_handler.SetsHandler),
     (r"/repositories/{repository_id}/offers$", offers_handler.OffersHandler),
@@ -47,6 +56,11 @@ APPLICATION_URLS = [
 ]
 
 
+def log_stats():
+    """Log the statistics of the connections to the database, the caches and the RDF workers of this process"""
+    logging.info('stats: %s', json.dumps(stats_handler.process_stats(), sort_keys=True))
+
+
 def main():
     """
     The entry point for the service.
@@ -77,6 +91,14 @@ def main():
     # Forks multiple sub-processes, one for each core
     server.start(int(options.processes))
 
+    if options.repo_db_warm_namespaces:
+        tornado.ioloop.IOLoop.instance().spawn_callback(db.warm_namespaces)
+
+    if options.stats_log_interval:
+        tornado.ioloop.PeriodicCallback(log_stats,
+                                        float(options.stats_log_interval) * 1000,
+                                        io_loop=tornado.ioloop.IOLoop.instance()).start()
+
     tornado.ioloop.IOLoop.instance().start()
 
 
@@ -10,13 +10,18 @@
 """
 API assets handler. Stores data in database.
 """
+import base64
+import json
 import logging
+import re
+import tempfile
 
 import arrow
 from arrow.parser import ParserError
 from koi.exceptions import HTTPError
 from tornado import gen
-from tornado.options import options
+from tornado.options import options, define
+from tornado.web import stream_request_body
 from urllib import urlencode
 from urlparse import urlunsplit
 
@@ -26,6 +31,19 @@ from ..models import asset
 from ..models.offer import Offer
 from ..models.framework import helper
 from ..models.framework.db import DatabaseConnection
+from ..models.framework.entity import ENTITY_ID_REGEX
+
+define('asset_upload_max_size', help='maximum size in bytes of an assets upload', default=1024 ** 3, type=int)
+define('asset_upload_dir', help='directory of the temporary files of the assets uploads, empty for the '
+       'default temporary directory', default='', type=str)
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+# size of the streamed identifiers written before they are flushed to the client
+NDJSON_FLUSH_SIZE = 64 * 1024
+
+# number of identifiers queried at once from the database for a streamed page
+NDJSON_QUERY_SIZE = 1000
 
 
 def _validate_body(request):
@@ -36,11 +54,72 @@ def _validate_body(request):
 
 
 def _unique_ids(body):
+    """
+    Remove the duplicated ids of a bulk query, keeping the first occurrence
+    of each id as it was sent. The ids are compared in their canonical form
+    (see asset.canonical_source_id).
+
+    :param body: list of dictionaries containing "source_id_type" & "source_id"
+    :returns: tuple (list of unique ids, number of duplicates removed)
+    :raises: HTTPError if an item is not an id
+    """
+    if not isinstance(body, list):
+        raise HTTPError(400, "Body should be a list of ids")
+
     ids = []
+    seen = set()
     for item in body:
-        if item not in ids:
-            ids.append(item)
-    return ids
+        try:
+            key = asset.canonical_source_id(item['source_id_type'], item['source_id'])
+            if key in seen:
+                continue
+            seen.add(key)
+        except (KeyError, TypeError, AttributeError):
+            raise HTTPError(400, "Invalid object in post body")
+
+        ids.append({'source_id_type': item['source_id_type'], 'source_id': item['source_id']})
+
+    return ids, len(body) - len(ids)
+
+
+def _accepts_ndjson(request):
+    return NDJSON_CONTENT_TYPE in request.headers.get('Accept', '')
+
+
+def _encode_cursor(after):
+    """
+    Encode the position of the last asset of a page as an opaque cursor
+
+    :param after: (timestamp, entity_id)
+    :returns: str
+    """
+    return base64.urlsafe_b64encode(json.dumps(list(after))).rstrip('=')
+
+
+def _decode_cursor(cursor):
+    """
+    Decode a cursor returned by _encode_cursor
+
+    :param cursor: str, an empty cursor is the start of the feed
+    :returns: (timestamp, entity_id) or None
+    :raises HTTPError: 400 if the cursor is invalid
+    """
+    if not cursor:
+        return None
+
+    try:
+        cursor = str(cursor)
+        cursor += '=' * (-len(cursor) % 4)
+        timestamp, entity_id = json.loads(base64.urlsafe_b64decode(cursor))
+        arrow.get(timestamp)
+    except (TypeError, ValueError, ParserError, UnicodeError):
+        raise HTTPError(400, "Invalid cursor")
+
+    if (not isinstance(timestamp, basestring) or not isinstance(entity_id, basestring) or
+            not re.match(ENTITY_ID_REGEX + '$', entity_id)):
+        raise HTTPError(400, "Invalid cursor")
+
+    return timestamp, entity_id
 
 
 class IdentifiersHandler(RepoBaseHandler):
@@ -100,27 +179,79 @@ class IdentifiersHandler(RepoBaseHandler):
 
         return page, page_size
 
+    def _next_link(self, query):
+        """
+        Link to the next page of identifiers
+
+        :param query: dictionary of query arguments
+        :return: str
+        """
+        return urlunsplit((
+            self.request.protocol,
+            self.request.host,
+            self.request.path,
+            urlencode(query),
+            ''
+        ))
+
+    def _cursor_metadata(self, metadata, next_after, from_time, to_time, page_size):
+        """
+        Add the cursor of the following page and the link to it to the metadata
+
+        :param metadata: dictionary
+        :param next_after: (timestamp, entity_id) of the last asset of the page
+        """
+        metadata['cursor'] = _encode_cursor(next_after)
+        metadata['next'] = self._next_link({
+            'page_size': page_size,
+            'cursor': metadata['cursor'],
+            'from': from_time.isoformat(),
+            'to': to_time.isoformat()
+        })
+
     @gen.coroutine
     def get(self, repository_id):
         """
         Respond with JSON containing success or error message.
 
+        Pages are selected either with page & page_size, or with a cursor
+        (an empty cursor for the first page) in which case the next link
+        carries the cursor of the following page.
+
+        If application/x-ndjson is accepted the identifiers are streamed
+        instead, see _stream_identifiers.
+
         :param repository_id: str
         """
         ids = None
         result_range = None
+        next_after = None
         from_time, to_time = self._get_time_arguments()
         page, page_size = self._get_page_arguments()
+        cursor = self.get_argument('cursor', None)
+        after = _decode_cursor(cursor)
         status = 200
 
+        if _accepts_ndjson(self.request):
+            yield self._stream_identifiers(repository_id, from_time, to_time, after, page_size)
+            return
+
         # fetch the identifiers
         try:
-            ids, result_range = yield asset.retrieve_paged_assets(
-                DatabaseConnection(repository_id),
-                from_time,
-                to_time,
-                page=page,
-                page_size=page_size)
+            if cursor is None:
+                ids, result_range = yield asset.retrieve_paged_assets(
+                    DatabaseConnection(repository_id),
+                    from_time,
+                    to_time,
+                    page=page,
+                    page_size=page_size)
+            else:
+                ids, result_range, next_after = yield asset.retrieve_assets_after(
+                    DatabaseConnection(repository_id),
+                    from_time,
+                    to_time,
+                    after=after,
+                    page_size=page_size)
         except Exception:
             status = 500
             logging.exception("Error while retrieving ids from database")
@@ -136,25 +267,109 @@ class IdentifiersHandler(RepoBaseHandler):
         }
 
         if ids:
-            next_page = urlunsplit((
-                self.request.protocol,
-                self.request.host,
-                self.request.path,
-                urlencode({
+            if cursor is None:
+                result['metadata']['next'] = self._next_link({
                     'page_size': page_size,
                     'page': page + 1,
                     'from': result_range[1],
                     'to': to_time.isoformat()
-                }),
-                ''
-            ))
-            result['metadata']['next'] = next_page
+                })
+            else:
+                self._cursor_metadata(result['metadata'], next_after, from_time, to_time, page_size)
 
         self.finish(result)
 
+    @gen.coroutine
+    def _stream_identifiers(self, repository_id, from_time, to_time, after, page_size):
+        """
+        Respond with one JSON identifier record per line, written as the
+        results are received from the database, followed by a trailer line
+        with the status and the metadata (including the cursor of the next
+        page). Pages are always selected with a cursor in this mode.
+
+        The stream of a database query cannot be paused, so a page is
+        queried NDJSON_QUERY_SIZE identifiers at a time, and the next
+        identifiers are only queried once the previous ones were flushed to
+        the client. At most NDJSON_QUERY_SIZE records are buffered for a slow
+        client.
+
+        :param repository_id: str
+        :param from_time: arrow.Arrow
+        :param to_time: arrow.Arrow
+        :param after: decoded cursor, None for the first page
+        :param page_size: int
+        """
+        self.set_header('Content-Type', NDJSON_CONTENT_TYPE + '; charset=UTF-8')
+
+        buffered = [0]
+        flushing = [None]
+
+        def on_record(record):
+            line = json.dumps(record) + '\n'
+            self.write(line)
+            buffered[0] += len(line)
+            # the records of a query are buffered until the previous flush completes
+            if buffered[0] >= NDJSON_FLUSH_SIZE and (flushing[0] is None or flushing[0].done()):
+                buffered[0] = 0
+                flushing[0] = self.flush()
+
+        count = 0
+        result_range = None
+        next_after = None
+        status = 200
+        try:
+            result_range = ()
+            while True:
+                size = min(NDJSON_QUERY_SIZE, page_size - count)
+                received, query_range, query_after = yield asset.stream_assets_after(
+                    DatabaseConnection(repository_id),
+                    from_time,
+                    to_time,
+                    on_record,
+                    after=after,
+                    page_size=size)
+                if received:
+                    count += received
+                    result_range = (result_range[0] if result_range else query_range[0], query_range[1])
+                    next_after = after = query_after
+                if flushing[0] is not None:
+                    yield flushing[0]
+                if received < size or count >= page_size:
+                    break
+
+                # the next records are only queried once these ones are flushed
+                buffered[0] = 0
+                yield self.flush()
+        except Exception:
+            status = 500
+            logging.exception("Error while streaming ids from database")
+
+        metadata = {
+            'service_id': options.service_id,
+            'result_range': result_range,
+            'query_range': (from_time.isoformat(), to_time.isoformat()),
+            'count': count
+        }
+        if count:
+            self._cursor_metadata(metadata, next_after, from_time, to_time, page_size)
+
+        self.write(json.dumps({'status': status, 'metadata': metadata}) + '\n')
+        self.finish()
+
 
 class AssetsHandler(RepoBaseHandler):
     """Responsible for storing assets for a repository in database"""
+    @gen.coroutine
+    def _parse_body(self):
+        """
+        Validate the request body and parse it once for all the stages of
+        the ingestion
+
+        :returns: helper.ParsedPayload
+        """
+        graph = yield helper.parse(self.request.body, format=self.data_format())
+        raise gen.Return(helper.ParsedPayload(self.request.body, self.get_content_type(), graph=graph))
+
     @gen.coroutine
     def post(self, repository_id):
         """
@@ -163,12 +378,11 @@ class AssetsHandler(RepoBaseHandler):
         :param repository_id: str
         """
         _validate_body(self.request)
-        helper.validate(self.request.body, format=self.data_format())
+        payload = yield self._parse_body()
 
         assets_data = yield asset.store(
             DatabaseConnection(repository_id),
-            self.request.body,
-            self.get_content_type())
+            payload)
 
         audit.log_added_assets(
             assets_data,
@@ -185,12 +399,11 @@ class AssetsHandler(RepoBaseHandler):
         :param repository_id: str
         """
         _validate_body(self.request)
-        helper.validate(self.request.body, format=self.data_format())
+        payload = yield self._parse_body()
 
         yield asset.delete(
             DatabaseConnection(repository_id),
-            self.request.body,
-            self.get_content_type())
+            payload)
 
         audit.log_deleted_assets(
             self.request.body,
@@ -199,6 +412,92 @@ class AssetsHandler(RepoBaseHandler):
 
         self.finish({'status': 200})
 
+@stream_request_body
+class AssetsUploadHandler(RepoBaseHandler):
+    """
+    Store large uploads of assets
+
+    The body is spooled to a temporary file as it is received, validated
+    keeping only the triples identifying the assets, and streamed from the
+    file to the database, so that the memory used does not grow with the
+    size of the upload.
+
+    Only RDF/XML is accepted: rdflib parses it incrementally, whereas its
+    turtle parser reads the whole file in memory. Turtle assets are stored
+    with AssetsHandler.
+    """
+    CONTENT_TYPE_MAP = {
+        'application/xml': 'xml'
+    }
+    ALLOWED_CONTENT_TYPES = CONTENT_TYPE_MAP.keys()
+
+    @gen.coroutine
+    def prepare(self):
+        """
+        Check the content type and size of the upload and open the temporary
+        file before the body is received
+        """
+        self._upload = None
+
+        yield super(AssetsUploadHandler, self).prepare()
+        if self.request.method != 'POST':
+            return
+
+        self.get_content_type()
+        max_size = int(options.asset_upload_max_size)
+        if int(self.request.headers.get('Content-Length', 0)) > max_size:
+            raise HTTPError(413, "Upload larger than {} bytes".format(max_size))
+        self.request.connection.set_max_body_size(max_size)
+
+        self._upload = tempfile.TemporaryFile(dir=options.asset_upload_dir or None)
+
+    def data_received(self, chunk):
+        """
+        Write a chunk of the body to the temporary file
+
+        :param chunk: bytes
+        """
+        if self._upload is not None:
+            self._upload.write(chunk)
+
+    def on_finish(self):
+        super(AssetsUploadHandler, self).on_finish()
+        self._close()
+
+    def on_connection_close(self):
+        super(AssetsUploadHandler, self).on_connection_close()
+        self._close()
+
+    def _close(self):
+        """Remove the temporary file"""
+        upload, self._upload = self._upload, None
+        if upload is not None:
+            upload.close()
+
+    @gen.coroutine
+    def post(self, repository_id):
+        """
+        Respond with JSON containing success or error message.
+
+        :param repository_id: str
+        """
+        if not self._upload.tell():
+            raise HTTPError(400, "No Data in Body")
+
+        payload = yield asset.parse_upload(self._upload, self.get_content_type(), self.data_format())
+
+        assets_data = yield asset.store(
+            DatabaseConnection(repository_id),
+            payload)
+
+        audit.log_added_assets(
+            assets_data,
+            self.token,
+            repository_id=repository_id)
+
+        self.finish({'status': 200})
+
+
 class AssetHandler(RepoBaseHandler):
     """Handler for individual assets"""
 
@@ -265,13 +564,51 @@ class BulkOfferHandler(RepoBaseHandler):
         """
         Retrieve offers by bulk
 
+        If application/x-ndjson is accepted the offers are streamed
+        instead, see _stream_offers.
+
         :param repository_id: str
         """
-        body = _unique_ids(self.get_json_body())
+        body, duplicates = _unique_ids(self.get_json_body())
+        if _accepts_ndjson(self.request):
+            yield self._stream_offers(repository_id, body, duplicates)
+            return
+
         try:
             result = yield Offer.retrieve_for_assets(body, DatabaseConnection(repository_id))
         except KeyError as error:
             logging.info(error.message)
             raise HTTPError(400, "Invalid object in post body")
 
-        self.finish({'status': 200, 'data': result})
+        self.finish({'status': 200, 'data': result, 'metadata': {'duplicates_removed': duplicates}})
+
+    @gen.coroutine
+    def _stream_offers(self, repository_id, asset_ids, duplicates):
+        """
+        Respond with one JSON line per asset and its offers, written as soon
+        as the offers of the asset are retrieved, followed by a trailer line
+        with the status and the metadata.
+
+        :param repository_id: str
+        :param asset_ids: list of unique ids
+        :param duplicates: number of duplicated ids removed from the request
+        """
+        self.set_header('Content-Type', NDJSON_CONTENT_TYPE + '; charset=UTF-8')
+
+        def on_assets(assets):
+            if self._finished:
+                return None
+            self.write(''.join(json.dumps(x) + '\n' for x in assets))
+            return self.flush()
+
+        count = 0
+        status = 200
+        try:
+            count = yield Offer.stream_for_assets(asset_ids, DatabaseConnection(repository_id), on_assets)
+        except Exception:
+            status = 500
+            logging.exception("Error while streaming offers from database")
+
+        metadata = {'count': count, 'duplicates_removed': duplicates}
+        self.write(json.dumps({'status': status, 'metadata': metadata}) + '\n')
+        self.finish()
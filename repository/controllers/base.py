@@ -10,19 +10,200 @@
 
 import jwt
 import logging
+import time
+from functools import partial
 from urllib import urlencode
 
 import tornado.httpclient
 from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
 from tornado.options import options, define
 
 from koi.exceptions import HTTPError
 from koi.base import BaseHandler
 from koi.configure import ssl_server_options
 
+from repository.models.framework import clients
+from repository.models.framework.cache import TTLCache
 from repository.models.framework.helper import PermissionException, ValidationException
 
-from chub import API
+define('auth_cache_size', help='maximum number of token verifications cached', default=10000, type=int)
+define('auth_cache_ttl', help='maximum time in seconds a granted token verification is cached',
+       default=60.0, type=float)
+define('auth_cache_negative_ttl', help='time in seconds a denied token verification is cached',
+       default=5.0, type=float)
+define('organisation_cache_size', help='maximum number of repository organisations cached',
+       default=10000, type=int)
+define('organisation_cache_ttl', help='time in seconds a repository organisation is cached',
+       default=300.0, type=float)
+define('organisation_cache_stale_ttl', help='time in seconds an expired repository organisation '
+       'is still used while it is refreshed', default=3600.0, type=float)
+define('organisation_cache_negative_ttl', help='time in seconds an unknown repository is cached',
+       default=30.0, type=float)
+
+# token verifications, keyed by (token, requested_access, repository_id)
+_token_cache = None
+
+# organisation ids (or 404 errors for unknown repositories), keyed by repository_id
+_organisation_cache = None
+
+
+def token_cache():
+    """
+    The cache of token verifications of this process
+
+    :returns: TTLCache
+    """
+    global _token_cache
+    if _token_cache is None:
+        _token_cache = TTLCache(max_size=int(options.auth_cache_size))
+
+    return _token_cache
+
+
+def _token_ttl(token, has_access):
+    """
+    Time in seconds a token verification may be cached, bounded by the
+    expiry of the token
+
+    :param token: Access token
+    :param has_access: result of the verification
+    :returns: float
+    """
+    if not has_access:
+        return float(options.auth_cache_negative_ttl)
+
+    try:
+        expires = jwt.decode(token, verify=False).get('exp')
+    except jwt.InvalidTokenError:
+        return 0
+
+    ttl = float(options.auth_cache_ttl)
+    if expires is not None:
+        ttl = min(ttl, expires - time.time())
+
+    return ttl
+
+
+def organisation_cache():
+    """
+    The cache of repository organisations of this process
+
+    :returns: TTLCache
+    """
+    global _organisation_cache
+    if _organisation_cache is None:
+        _organisation_cache = TTLCache(max_size=int(options.organisation_cache_size))
+
+    return _organisation_cache
+
+
+def cache_stats():
+    """
+    Statistics about the token and organisation caches of this process
+
+    :returns: dictionary
+    """
+    return {
+        'token': token_cache().stats(),
+        'organisation': organisation_cache().stats()
+    }
+
+
+@coroutine
+def _lookup_organisation(repository_id):
+    """
+    Lookup organisation id of repository with the accounts service and cache the result
+
+    :param repository_id: id of repository being accessed
+    :returns: organisation_id string
+    """
+    client = clients.client(options.url_accounts,
+                            ssl_options=ssl_server_options())
+    headers = {'Accept': 'application/json'}
+    client.accounts.repositories[repository_id].prepare_request(headers=headers, request_timeout=180)
+
+    try:
+        result = yield client.accounts.repositories[repository_id].get()
+    except tornado.httpclient.HTTPError as ex:
+        # Must be converted to a tornado.web.HTTPError for the server
+        # to handle it correctly
+        logging.exception(ex.message)
+        if ex.code == 404:
+            error = HTTPError(404, ex.message)
+            organisation_cache().set(repository_id, error, ttl=float(options.organisation_cache_negative_ttl))
+            raise error
+        else:
+            raise HTTPError(500, 'Internal Server Error')
+
+    organisation_id = result['data']['organisation']['id']
+    organisation_cache().set(repository_id, organisation_id,
+                             ttl=float(options.organisation_cache_ttl),
+                             stale_ttl=float(options.organisation_cache_stale_ttl))
+    raise Return(organisation_id)
+
+
+@coroutine
+def _refresh_organisation(repository_id):
+    """
+    Refresh the cached organisation of a repository in the background
+
+    :param repository_id: id of repository
+    """
+    try:
+        yield organisation_cache().shared(repository_id, partial(_lookup_organisation, repository_id))
+    except Exception as exc:
+        logging.warning('Unable to refresh organisation of repository %s: %s' % (repository_id, exc))
+
+
+@coroutine
+def _verify_token(token, requested_access, repository_id=None):
+    """
+    Verify access to repository with the auth service and cache the result
+
+    :param repository_id: id of repository being accessed
+    :param token: Access token
+    :param requested_access: the access level the client has requested
+    :returns: boolean
+    """
+    client = clients.client(options.url_auth,
+                            auth_username=options.service_id,
+                            auth_password=options.client_secret,
+                            ssl_options=ssl_server_options())
+    headers = {'Content-Type': 'application/x-www-form-urlencoded',
+               'Accept': 'application/json'}
+    data = {
+        'token': token,
+        'requested_access': requested_access
+    }
+    if repository_id:
+        data['resource_id'] = repository_id
+
+    client.auth.verify.prepare_request(headers=headers, request_timeout=180)
+
+    try:
+        result = yield client.auth.verify.post(body=urlencode(data))
+    except tornado.httpclient.HTTPError as ex:
+        # Must be converted to a tornado.web.HTTPError for the server
+        # to handle it correctly
+        logging.exception(ex.message)
+        raise HTTPError(500, 'Internal Server Error')
+
+    has_access = result['has_access']
+    token_cache().set((token, requested_access, repository_id), has_access,
+                      ttl=_token_ttl(token, has_access))
+    raise Return(has_access)
+
+
+def _ignore_result(future):
+    """
+    Discard the result of a future that is no longer needed, so that
+    its error (if any) is not logged as unhandled
+
+    :param future: a Future or None
+    """
+    if future is not None:
+        IOLoop.current().add_future(future, lambda f: f.exception())
 
 
 class RepoBaseHandler(BaseHandler):
@@ -40,28 +221,27 @@ class RepoBaseHandler(BaseHandler):
     @coroutine
     def get_organisation_id(self, repository_id):
         """
-        Lookup organisation id of repository
+        Lookup organisation id of repository.
+
+        Organisations are cached for organisation_cache_ttl seconds. After that
+        the cached organisation is still returned for organisation_cache_stale_ttl
+        seconds while it is refreshed in the background. Unknown repositories are
+        cached for organisation_cache_negative_ttl seconds.
 
         :param repository_id: id of repository being accessed
         :returns: organisation_id string
         """
-        client = API(options.url_accounts,
-                     ssl_options=ssl_server_options())
-        headers = {'Accept': 'application/json'}
-        client.accounts.repositories[repository_id].prepare_request(headers=headers, request_timeout=180)
-
-        try:
-            result = yield client.accounts.repositories[repository_id].get()
-        except tornado.httpclient.HTTPError as ex:
-            # Must be converted to a tornado.web.HTTPError for the server
-            # to handle it correctly
-            logging.exception(ex.message)
-            if ex.code == 404:
-                raise HTTPError(404, ex.message)
-            else:
-                raise HTTPError(500, 'Internal Server Error')
-
-        raise Return(result['data']['organisation']['id'])
+        organisation_id, fresh = organisation_cache().lookup(repository_id)
+        if organisation_id is None:
+            organisation_id = yield organisation_cache().shared(
+                repository_id, partial(_lookup_organisation, repository_id))
+        elif not fresh:
+            IOLoop.current().spawn_callback(_refresh_organisation, repository_id)
+
+        if isinstance(organisation_id, HTTPError):
+            raise organisation_id
+
+        raise Return(organisation_id)
 
     def send_error(self, status_code=500, **kwargs):
         """
@@ -82,67 +262,89 @@ class RepoBaseHandler(BaseHandler):
     @coroutine
     def verify_repository_token(self, token, requested_access, repository_id=None):
         """
-        Verify access to repository
+        Verify access to repository.
+
+        Verifications are cached until the token expires (at most auth_cache_ttl
+        seconds), denials for auth_cache_negative_ttl seconds. Concurrent
+        requests for the same verification share a single call to the auth service.
 
         :param repository_id: id of repository being accessed
         :param token: Access token
         :param requested_access: the access level the client has requested
         :returns: boolean
         """
-        client = API(options.url_auth,
-                     auth_username=options.service_id,
-                     auth_password=options.client_secret,
-                     ssl_options=ssl_server_options())
-        headers = {'Content-Type': 'application/x-www-form-urlencoded',
-                   'Accept': 'application/json'}
-        data = {
-            'token': token,
-            'requested_access': requested_access
-        }
-        if repository_id:
-            data['resource_id'] = repository_id
-
-        client.auth.verify.prepare_request(headers=headers, request_timeout=180)
-
-        try:
-            result = yield client.auth.verify.post(body=urlencode(data))
-        except tornado.httpclient.HTTPError as ex:
-            # Must be converted to a tornado.web.HTTPError for the server
-            # to handle it correctly
-            logging.exception(ex.message)
-            raise HTTPError(500, 'Internal Server Error')
-        raise Return(result['has_access'])
+        key = (token, requested_access, repository_id)
+        has_access = token_cache().get(key)
+        if has_access is None:
+            has_access = yield token_cache().shared(
+                key, partial(_verify_token, token, requested_access, repository_id))
+
+        raise Return(has_access)
 
     @coroutine
     def prepare(self):
         """
         If OAuth verification is required, validate provided token.
 
+        The token verification and the lookup of the repository's organisation
+        are run concurrently. The time taken by each of them, and by the
+        whole of prepare, (in seconds) is recorded in request.timings.
+
         :raise: HTTPError if token does not have access
         """
         # We do not need to do anything for CORS pre-flight checks
         if self.request.method == 'OPTIONS':
             return
 
+        timings = self.request.timings = {}
+        start = time.time()
+
         repository_id = self.path_kwargs.get('repository_id')
 
         requested_access = self.endpoint_access(self.request.method)
         standalone = getattr(options, 'standalone', None)
 
+        token = None
         if requested_access is not self.UNAUTHENTICATED_ACCESS and not standalone:
             token = self.request.headers.get('Authorization', '').split(' ')[-1]
-            if token:
-                has_access = yield self.verify_repository_token(token, requested_access, repository_id)
-                if not has_access:
-                    msg = "'{}' access not granted.".format(requested_access)
-                    raise HTTPError(403, msg)
-                self.token = jwt.decode(token, verify=False)
-            else:
+            if not token:
                 msg = 'OAuth token not provided'
                 raise HTTPError(401, msg)
 
+        organisation = None
         if repository_id and not standalone:
-            self.organisation_id = yield self.get_organisation_id(repository_id)
+            organisation_start = time.time()
+            organisation = self.get_organisation_id(repository_id)
+            organisation.add_done_callback(
+                lambda future: timings.__setitem__('organisation', time.time() - organisation_start))
+
+        if token:
+            verify_start = time.time()
+            try:
+                has_access = yield self.verify_repository_token(token, requested_access, repository_id)
+            except Exception:
+                _ignore_result(organisation)
+                raise
+
+            timings['verify_token'] = time.time() - verify_start
+            if not has_access:
+                _ignore_result(organisation)
+                msg = "'{}' access not granted.".format(requested_access)
+                raise HTTPError(403, msg)
+            self.token = jwt.decode(token, verify=False)
+
+        if organisation is not None:
+            self.organisation_id = yield organisation
+
+        timings['prepare'] = time.time() - start
+
+    def on_finish(self):
+        """Log the time taken by the phases of prepare"""
+        timings = getattr(self.request, 'timings', None)
+        if timings:
+            logging.debug('%s %s prepare timings: %s' % (
+                self.request.method, self.request.path,
+                ', '.join('{}={:.4f}s'.format(k, v) for k, v in sorted(timings.items()))))
 
     def get_content_type(self):
         """
@@ -9,7 +9,12 @@
 
 
 """API assets handler. Query offers from the db."""
+import logging
+
 from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.options import options
+from tornado.web import stream_request_body
 
 from koi.base import HTTPError
 
@@ -18,6 +23,8 @@ from .. import audit
 from ..models.asset import Asset
 from ..models.set import Set
 from ..models.framework.db import DatabaseConnection
+from ..models.framework.entity import filter_existing
+from ..models.framework.helper import JSONStringsStream, NDJSONStream, ValidationException
 
 
 class SetsHandler(RepoBaseHandler):
@@ -72,14 +79,85 @@ class SetHandler(RepoBaseHandler):
         self.finish({'status': 200, 'data': set_obj})
 
 
+@stream_request_body
 class SetAssetsHandler(RepoBaseHandler):
-    """Link an asset with a set"""
+    """
+    Link an asset with a set
+
+    The body of a POST is parsed as it is received, and the assets written to
+    the database in batches, so that the memory used does not depend on the
+    number of assets.
+    """
+    ALLOWED_CONTENT_TYPES = ['application/json', 'application/x-ndjson']
+    DEFAULT_CONTENT_TYPE = 'application/json'
+
+    @gen.coroutine
+    def prepare(self):
+        """
+        Check the set exists and start replacing its elements before the
+        body of a POST is received
+        """
+        self._replacement = None
+        self._parser = None
+        self._body_error = None
+        self._received = []
+
+        yield super(SetAssetsHandler, self).prepare()
+        if self.request.method != 'POST':
+            return
+
+        content_type = self.get_content_type().lower().split(';')[0].strip()
+        if content_type == 'application/x-ndjson':
+            self._parser = NDJSONStream(self._received.append)
+        else:
+            self._parser = JSONStringsStream(self._received.append, key='assets')
+
+        repository = DatabaseConnection(self.path_kwargs['repository_id'])
+        set_id = self.path_kwargs['set_id']
+        set_exists = yield Set.exists(repository, set_id)
+        if not set_exists:
+            raise HTTPError(404, "Set {} not found".format(set_id))
+
+        self._replacement = Set.replace_elements(repository, set_id)
+
+    @gen.coroutine
+    def data_received(self, chunk):
+        """
+        Parse a chunk of the body and write the complete batches of assets.
+        Errors are kept until the whole body has been received.
+
+        :param chunk: bytes
+        """
+        if self._replacement is None or self._body_error is not None:
+            return
+
+        try:
+            self._parser.feed(chunk)
+            received = self._received[:]
+            del self._received[:]
+            yield self._replacement.add(received)
+        except Exception as exc:
+            self._body_error = exc
+
+    def on_connection_close(self):
+        super(SetAssetsHandler, self).on_connection_close()
+        self._abort()
+
+    def _abort(self):
+        """Remove the assets already staged"""
+        replacement, self._replacement = self._replacement, None
+        if replacement is not None:
+            IOLoop.current().spawn_callback(replacement.abort)
 
     @gen.coroutine
     def get(self, repository_id, set_id):
         """
         Return all assets associated to a set
 
+        Pages are selected either with page & page_size, or with an after
+        cursor (empty for the first page) in which case the response includes
+        the cursor of the next page, null after the last page.
+
         :param repository_id: the id of the repository
         :param set_id: the id of an offer
         :return: A JSON object containing an offer
@@ -93,29 +171,45 @@ class SetAssetsHandler(RepoBaseHandler):
         page = int(self.get_argument("page", "1"))
         page_size = int(self.get_argument("page_size", "100"))
         page_size = min(page_size, 1000)
+        after = self.get_argument("after", None)
+
+        if after is None:
+            elements = yield Set.get_elements(repository, set_id, page, page_size)
+        else:
+            elements = yield Set.get_elements(repository, set_id, page_size=page_size, after=after or None)
 
-        elements = yield Set.get_elements(repository, set_id, page, page_size)
+        data = {'assets': [e.split('/')[-1] for e in elements]}
+        if after is not None:
+            data['next'] = data['assets'][-1] if len(elements) == page_size and elements else None
 
-        self.finish({'status': 200, 'data': {'assets': [e.split('/')[-1] for e in elements]}})
+        self.finish({'status': 200, 'data': data})
 
     @gen.coroutine
     def post(self, repository_id, set_id):
         """
         Replace all the elements in a set.
 
+        The body is either a JSON object with a list of assets ids, or, with
+        the application/x-ndjson content type, one JSON string per line.
+        The elements of the set are only replaced once the whole body has
+        been received and written.
+
         :param repository_id: the id of the repository
         :param set_id: the id of an offer
         :return: A JSON object containing an offer
         """
-        body = self.get_json_body(['assets'])
-        repository = DatabaseConnection(repository_id)
-
-        set_exists = yield Set.exists(repository, set_id)
-        if not set_exists:
-            raise HTTPError(404, "Set {} not found".format(set_id))
-
-        yield Set.set_elements(repository, set_id, body['assets'])
-
+        try:
+            if self._body_error is not None:
+                raise self._body_error
+
+            self._parser.close()
+            yield self._replacement.add(self._received)
+            yield self._replacement.commit()
+        except Exception:
+            self._abort()
+            raise
+
+        self._replacement = None
         self.finish({'status': 200})
 
 
@@ -209,3 +303,46 @@ class SetAssetHandler(RepoBaseHandler):
         yield Set.remove_elements(repository, set_id, [asset_id])
 
         self.finish({'status': 200})
+
+
+class SetMembershipHandler(RepoBaseHandler):
+    """Check whether many assets are elements of a set"""
+
+    METHOD_ACCESS = {
+        "POST": RepoBaseHandler.READ_ACCESS,
+        "OPTIONS": RepoBaseHandler.READ_ACCESS
+    }
+
+    @gen.coroutine
+    def post(self, repository_id, set_id):
+        """
+        Tell which assets of a list are part of a set.
+
+        The existence of the set and of all the assets is checked with a single
+        query, and the membership of the assets that exist with another.
+
+        :param repository_id: the id of the repository
+        :param set_id: the id of the set
+        :return: A JSON object mapping each asset found to whether it is an
+            element of the set, and listing the assets not found
+        """
+        body = self.get_json_body(['assets'])
+        assets = body['assets']
+        if not isinstance(assets, list) or not all(isinstance(a, basestring) for a in assets):
+            raise HTTPError(400, "assets must be a list of asset ids")
+        if len(assets) > options.max_page_size:
+            raise HTTPError(400, "assets must contain at most {} ids".format(options.max_page_size))
+
+        repository = DatabaseConnection(repository_id)
+
+        existing = yield filter_existing(repository, [(Set, set_id)] + [(Asset, a) for a in assets])
+        if (Set, set_id) not in existing:
+            raise HTTPError(404, "Set {} not found".format(set_id))
+
+        found = [a for a in set(assets) if (Asset, a) in existing]
+        members = yield Set.filter_members(repository, set_id, found)
+
+        self.finish({'status': 200, 'data': {
+            'is_member': {a: a in members for a in found},
+            'not_found': sorted(set(assets).difference(found))
+        }})
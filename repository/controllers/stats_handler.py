@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""This handler returns the statistics of the process serving the request
+"""
+
+from repository.controllers import base
+from repository.controllers.base import RepoBaseHandler
+from repository.models.framework import db, workers
+
+
+def process_stats():
+    """
+    Statistics of the connections to the database, the caches and the RDF workers of this process
+
+    :returns: dictionary
+    """
+    return {
+        'db': db.pool_stats(),
+        'cache': base.cache_stats(),
+        'rdf_workers': workers.pool_stats()
+    }
+
+
+class StatsHandler(RepoBaseHandler):
+
+    """ Returns the statistics of the process.
+    """
+
+    def get(self):
+        """GET the statistics of the process serving the request.
+
+        Returns a JSON with the counters of the database connections, the caches and the RDF workers
+        """
+        msg = {
+            'status': 200,
+            'data': process_stats()
+        }
+        self.finish(msg)
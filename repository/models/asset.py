@@ -8,49 +8,64 @@
 # See the License for the specific language governing permissions and limitations under the License.
 
 
-import re
+import os
 import json
 import uuid
 import logging
 import urllib
 
-import rdflib.graph
-
-from chub import API
-from chub.oauth2 import Write, get_token
+from bass import hubkey
+from chub.oauth2 import Write
 from koi.configure import ssl_server_options
+from koi.exceptions import HTTPError
 from functools import partial
-from tornado.gen import coroutine, Return
+from tornado.gen import coroutine, Return, sleep
 from tornado.ioloop import IOLoop
-from tornado.options import options
+from tornado.locks import Semaphore
+from tornado.options import options, define
 
 from .queries.asset import (ASSET_CLASS,
                             ASSET_APPEND_ALSO_IDENTIFIED,
                             ASSET_QUERY_ALL_ENTITY_IDS,
+                            ASSET_QUERY_ALL_SOURCE_IDS,
                             ASSET_LIST_EXTRA_IDS,
                             ASSET_LIST_EXTRA_QUERY,
                             ASSET_GET_ALSO_IDENTIFIED,
                             ASSET_SELECT_BY_SOURCE_ID,
                             ASSET_SELECT_BY_ENTITY_ID,
                             ASSET_STRUCT_SELECT,
-                            FIND_ENTITY_TEMPLATE,
-                            SOURCE_ID_FILTER_TEMPLATE,
-                            FIND_ENTITY_SOURCE_IDS_TEMPLATE,
-                            FIND_ENTITY_COUNT_BY_SOURCE_IDS_TEMPLATE,
-                            DELETE_ID_TRIPLES_TEMPLATE,
-                            DELETE_ENTITY_TRIPLE_TEMPLATE
+                            FIND_ENTITIES_AND_SOURCE_IDS_TEMPLATE,
+                            COUNT_ENTITIES_BY_SOURCE_IDS_TEMPLATE,
+                            DELETE_SOURCE_IDS_TEMPLATE,
+                            DELETE_ENTITIES_TEMPLATE
                             )
 from .queries.generic import *
-from .framework.entity import Entity, build_sparql_str, build_uuid_reference, build_hub_reference, ENTITY_ID_REGEX
-
+from .framework import clients, helper, workers
+from .framework.entity import Entity, build_sparql_str, build_hub_reference, normalise_entity_id
 
-TYPE_MAPPING = {
-    'text/rdf+n3': 'n3',
-    'application/xml': 'xml'
-}
 
 HUB_KEY = "hub_key"
 
+define('index_notification_window', help='time in seconds the notifications of a repository to the index '
+       'service are folded into one', default=1.0, type=float)
+define('index_notification_max_outstanding', help='maximum number of notifications to the index service '
+       'in progress', default=10, type=int)
+define('index_delete_batch_size', help='maximum number of ids deleted from the index service by a request',
+       default=100, type=int)
+define('index_delete_max_outstanding', help='maximum number of deletes from the index service in progress',
+       default=10, type=int)
+define('index_delete_retries', help='number of times a failed delete from the index service is retried',
+       default=3, type=int)
+define('index_delete_backoff', help='time in seconds before the first retry of a delete from the index '
+       'service, doubled on each retry', default=0.5, type=float)
+
+# scheduler of the notifications to the index service
+_notification_scheduler = None
+
+# queue of the deletes from the index service
+_index_delete_queue = None
+
+
 @coroutine
 def _insert_ids(repository, entity_id, ids):
     """
@@ -92,53 +107,102 @@ def _validate_ids(ids):
     return errors
 
 
-def get_asset_source_ids(assets_data, content_type, entity_id):
+def canonical_source_id(source_id_type, source_id):
     """
-    This function extracts source_id and source_id_type of each asset in the data.
-    It does this by creating an in memory graph via RDF Lib.
+    The canonical form of a source id, under which equal ids compare equal.
+    Hub keys are case insensitive and are reduced to their lower case entity
+    id, other source ids are case sensitive and are kept as they are.
+
+    :param source_id_type: str
+    :param source_id: str
+    :return: a (source_id_type, source_id) tuple
+    """
+    if source_id_type == HUB_KEY:
+        source_id = source_id.strip().lower()
+        if source_id.startswith(PREFIXES['id']):
+            source_id = source_id[len(PREFIXES['id']):]
+    return source_id_type, source_id
+
+
+def _group_source_ids(payload):
+    """
+    Group the source_id and source_id_type of every entity in the payload
+
+    :param payload: a helper.ParsedPayload
+    :return: a dictionary mapping entity URIs to a list of (source_id_type, source_id)
+    """
+    result = {}
+    for entity_uri, source_id_type, source_id in payload.query(SPARQL_PREFIXES + ASSET_QUERY_ALL_SOURCE_IDS):
+        result.setdefault(str(entity_uri), []).append((source_id_type.split('/')[-1], str(source_id)))
+    return result
 
-    * Caution this is potentially very cpu expensive and could use a lot of memory
 
-    :param assets_data: A blob of triples
+def get_asset_source_ids(assets_data, content_type, entity_id):
+    """
+    This function extracts source_id and source_id_type of an asset in the data.
+    The ids of every asset are extracted from the in memory graph once and
+    shared by all the calls made with the same helper.ParsedPayload.
+
+    :param assets_data: A blob of triples or a helper.ParsedPayload
     :param content_type:  The type of the blob
+    :param entity_id: the id of the asset
     :return: an array of dicts that show the ids of assets
     """
-    graph = rdflib.graph.Graph()
-    graph.parse(data=assets_data, format=TYPE_MAPPING[content_type])
-    result = graph.query(
-            SPARQL_PREFIXES + (
-              ASSET_GET_ALSO_IDENTIFIED.format(
-                entity_id=Asset.normalise_id(entity_id)
-              )
-            ))
-    result = [{'source_id_type': x[0].split('/')[-1], 'source_id': str(x[1])} for x in result]
-    return result
+    payload = helper.ParsedPayload.from_data(assets_data, content_type)
+    source_ids = payload.memoise('asset_source_ids', partial(_group_source_ids, payload))
+    entity_uri = str(helper.solve_ns(Asset.normalise_id(entity_id)))
+
+    return [{'source_id_type': source_id_type, 'source_id': source_id}
+            for source_id_type, source_id in source_ids.get(entity_uri, [])]
+
 
 def get_asset_ids(assets_data, content_type):
     """
-    *********************************************************************************
-    **** NOTE - 28 June 2018                                                    *****
-    **** This function does NOT do what the original comment below says         *****
-    **** This function does NOT extract source_id etc from an in memory graph   *****
-    **** Thus function DOES retrieve asset ids from an in memory graph          *****
-    *********************************************************************************
-
-    This function extracts source_id, source_id_type and entity_uri of each asset in the data.
-    It does this by creating an in memory graph via RDF Lib.
+    This function retrieves the entity id of each asset in the data,
+    from an in memory graph via RDF Lib.
 
-    * Caution this is potentially very cpu expensive and could use a lot of memory
+    * Caution parsing the data is potentially very cpu expensive and could use a lot of memory.
+      Pass a helper.ParsedPayload to reuse a graph that has already been parsed.
 
-    :param assets_data: A blob of triples
+    :param assets_data: A blob of triples or a helper.ParsedPayload
     :param content_type:  The type of the blob
     :return: an array of dicts that show the ids of assets
     """
-    graph = rdflib.graph.Graph()
-    graph.parse(data=assets_data, format=TYPE_MAPPING[content_type])
-    result = graph.query(SPARQL_PREFIXES + ASSET_QUERY_ALL_ENTITY_IDS)
+    payload = helper.ParsedPayload.from_data(assets_data, content_type)
+    result = payload.query(SPARQL_PREFIXES + ASSET_QUERY_ALL_ENTITY_IDS)
     result = [{u'entity_id': x[u'entity_id'].split('/')[-1]} for x in result]
     return result
 
 
+def _identifiers_graph():
+    """
+    A graph keeping the triples matched by ASSET_QUERY_ALL_ENTITY_IDS and
+    ASSET_QUERY_ALL_SOURCE_IDS
+
+    :return: helper.FilteredGraph
+    """
+    predicates = [helper.solve_ns(x) for x in ('op:alsoIdentifiedBy', 'op:id_type', 'op:value')]
+    return helper.FilteredGraph(predicates, types=[helper.solve_ns(ASSET_CLASS)])
+
+
+@coroutine
+def parse_upload(fileobj, content_type, format):
+    """
+    Validate an uploaded file on the RDF workers, keeping only the triples
+    identifying its assets. The memory used does not grow with the size of
+    the upload for RDF/XML only, the turtle parser reads the whole file.
+
+    :param fileobj: the uploaded file
+    :param content_type: mimetype of the file
+    :param format: 'xml' or 'turtle'
+    :return: helper.ParsedPayload, whose data (the file) is streamed when stored
+    :raises ValidationException if the file cannot be parsed
+    """
+    fileobj.seek(0, os.SEEK_END)
+    graph = yield workers.run(fileobj.tell(), helper.parse_file, fileobj, _identifiers_graph(), format)
+    raise Return(helper.ParsedPayload(fileobj, content_type, graph=graph))
+
+
 @coroutine
 def add_ids(repository, entity_id, ids):
     """
@@ -156,14 +220,35 @@ def add_ids(repository, entity_id, ids):
     raise Return(errors)
 
 
+@coroutine
+def index_token():
+    """
+    A write token for the index service
+
+    :returns: Access token
+    """
+    token = yield clients.service_token(Write(options.url_index))
+    raise Return(token)
+
+
+def _drop_rejected_token(error):
+    """
+    Remove the cached token for the index service if the index service
+    rejected it
+
+    :param error: the error of a request to the index service
+    """
+    if getattr(error, 'code', None) == 401:
+        clients.drop_service_token(Write(options.url_index))
+
+
 @coroutine
 def send_notification(repository, **kwargs):
     """
     Send a fire-and-forget notification to the index service
 
-    NOTE: all exceptions are unhandled. It's assumed that the function is used
-    as a callback outside of the request's context using IOLoop.spawn_callback
-    (see: http://www.tornadoweb.org/en/stable/ioloop.html)
+    NOTE: all exceptions are logged. It's assumed that the function is called
+    outside of the request's context by the NotificationScheduler
     """
     headers = {
         'Accept': 'application/json',
@@ -171,14 +256,10 @@ def send_notification(repository, **kwargs):
     }
 
     try:
-        token = yield get_token(options.url_auth,
-                                options.service_id,
-                                options.client_secret,
-                                scope=Write(options.url_index),
+        token = yield index_token()
+        client = clients.client(options.url_index,
+                                token=token,
                                 ssl_options=ssl_server_options())
-        client = API(options.url_index,
-                        token=token,
-                        ssl_options=ssl_server_options())
         client.index.notifications.prepare_request(
             request_timeout=options.request_timeout,
             headers=headers,
@@ -187,45 +268,256 @@ def send_notification(repository, **kwargs):
         logging.debug('calling send_notification ' + str(repository.repository_id))
         yield client.index.notifications.post()
     except Exception as e:
+        _drop_rejected_token(e)
         logging.exception("failed to notify index: " + e.message)
 
+
+class NotificationScheduler(object):
+    """
+    Schedules the notifications of repositories to the index service.
+
+    The notifications of a repository within a window are folded into one, and
+    a notification is only sent once fewer than max_outstanding notifications
+    are in progress. Notifications of a repository received while its
+    notification is waiting are folded into it as well.
+    """
+
+    def __init__(self, send, window, max_outstanding):
+        """
+        :param send: coroutine function sending the notification of a repository
+        :param window: time in seconds a notification is delayed
+        :param max_outstanding: maximum number of notifications in progress
+        """
+        self.send = send
+        self.window = window
+        self.scheduled = 0
+        self.folded = 0
+        self.sent = 0
+        self._pending = {}
+        self._semaphore = Semaphore(max_outstanding)
+
+    def notify(self, repository):
+        """
+        Schedule a notification of a repository, unless one is already pending
+
+        :param repository: the repository that has changed
+        """
+        repository_id = repository.repository_id
+        if repository_id in self._pending:
+            self.folded += 1
+            return
+
+        self._pending[repository_id] = repository
+        self.scheduled += 1
+        IOLoop.current().call_later(self.window, self._flush, repository_id)
+
+    @coroutine
+    def _flush(self, repository_id):
+        """
+        Send the pending notification of a repository
+
+        :param repository_id: id of the repository
+        """
+        yield self._semaphore.acquire()
+        try:
+            repository = self._pending.pop(repository_id)
+            yield self.send(repository)
+            self.sent += 1
+        except Exception:
+            logging.exception("failed to notify index of repository " + str(repository_id))
+        finally:
+            self._semaphore.release()
+
+    def stats(self):
+        """
+        Counters of the scheduler
+
+        :returns: dictionary
+        """
+        return {
+            'pending': len(self._pending),
+            'scheduled': self.scheduled,
+            'folded': self.folded,
+            'sent': self.sent
+        }
+
+
+def notification_scheduler():
+    """
+    The scheduler of the notifications to the index service of this process
+
+    :returns: NotificationScheduler
+    """
+    global _notification_scheduler
+    if _notification_scheduler is None:
+        _notification_scheduler = NotificationScheduler(
+            send_notification,
+            float(options.index_notification_window),
+            int(options.index_notification_max_outstanding))
+
+    return _notification_scheduler
+
 @coroutine
 def delete_from_index(repository, ids, **kwargs):
     """
-    Send a fire-and-forget delete to the index service 
+    Delete source ids of a repository from the index service
 
-    NOTE: all exceptions are unhandled. It's assumed that the function is used
-    as a callback outside of the request's context using IOLoop.spawn_callback
-    (see: http://www.tornadoweb.org/en/stable/ioloop.html)
+    :param repository: the repository
+    :param ids: list of dictionaries containing "source_id" & "source_id_type"
+    :raises: the error of the request to the index service
     """
-    headers = {
-        'Accept': 'application/json',
-        'Content-Type': 'application/json'
-    }
+    # extract the id list and id_type list from the incoming ids parameter
+    source_id_types = ','.join([urllib.unquote(str(x['source_id_type'])) for x in ids])
+    source_ids = ','.join([urllib.unquote(str(x['source_id'])) for x in ids])
 
-    try:
-        # extract the id list and id_type list from the incoming ids parameter    
-        source_id_types = ','.join([urllib.unquote(str(x['source_id_type'])) for x in ids])
-        source_ids = ','.join([urllib.unquote(str(x['source_id'])) for x in ids])
-
-        logging.debug ('delete_from_index : source_id_types ' + source_id_types)
-        logging.debug ('delete_from_index : source_ids ' + source_ids)
+    logging.debug('delete_from_index : source_id_types ' + source_id_types)
+    logging.debug('delete_from_index : source_ids ' + source_ids)
 
-        token = yield get_token(options.url_auth,
-                                options.service_id,
-                                options.client_secret,
-                                scope=Write(options.url_index),
+    try:
+        token = yield index_token()
+        client = clients.client(options.url_index,
+                                token=token,
                                 ssl_options=ssl_server_options())
-        client = API(options.url_index,
-                     token=token,
-                     ssl_options=ssl_server_options())
 
         logging.debug('delete_from_index : repo ' + str(repository.repository_id))
 
-        yield client.index['entity-types']['asset']['id-types'][source_id_types].ids[source_ids].repositories[repository.repository_id].delete()          
-
+        yield client.index['entity-types']['asset']['id-types'][source_id_types].ids[source_ids].repositories[repository.repository_id].delete()
     except Exception as e:
-        logging.exception("failed to delete from index: " + e.message)
+        _drop_rejected_token(e)
+        raise
+
+
+def _retryable(error):
+    """
+    Whether a failed request to the index service may succeed if retried
+
+    :param error: the error of the request
+    :returns: bool
+    """
+    code = getattr(error, 'code', None)
+    return code is None or code in (401, 429) or code >= 500
+
+
+class IndexDeleteQueue(object):
+    """
+    Deletes source ids from the index service in batches.
+
+    The ids deleted from a repository during an IOLoop iteration are gathered
+    and sent in batches of at most batch_size ids, with at most
+    max_outstanding batches in progress. A failed batch is retried with an
+    exponential backoff.
+    """
+
+    def __init__(self, send, batch_size, max_outstanding, retries, backoff):
+        """
+        :param send: coroutine function deleting a batch of ids of a repository
+        :param batch_size: maximum number of ids in a batch
+        :param max_outstanding: maximum number of batches in progress
+        :param retries: number of times a failed batch is retried
+        :param backoff: time in seconds before the first retry, doubled on each retry
+        """
+        self.send = send
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.queued = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self._pending = {}
+        self._semaphore = Semaphore(max_outstanding)
+
+    def delete(self, repository, ids):
+        """
+        Queue source ids to be deleted from the index service
+
+        :param repository: the repository
+        :param ids: list of dictionaries containing "source_id" & "source_id_type"
+        """
+        if not ids:
+            return
+
+        repository_id = repository.repository_id
+        if repository_id not in self._pending:
+            self._pending[repository_id] = (repository, [])
+            IOLoop.current().spawn_callback(self._flush, repository_id)
+
+        self._pending[repository_id][1].extend(ids)
+        self.queued += len(ids)
+
+    @coroutine
+    def _flush(self, repository_id):
+        """
+        Send the queued ids of a repository in batches
+
+        :param repository_id: id of the repository
+        """
+        repository, ids = self._pending.pop(repository_id)
+        yield [self._send(repository, ids[i:i + self.batch_size])
+               for i in range(0, len(ids), self.batch_size)]
+
+    @coroutine
+    def _send(self, repository, batch):
+        """
+        Send a batch, retrying it if it fails
+
+        :param repository: the repository
+        :param batch: list of ids
+        """
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.retried += 1
+                yield sleep(self.backoff * 2 ** (attempt - 1))
+
+            yield self._semaphore.acquire()
+            try:
+                yield self.send(repository, batch)
+            except Exception as e:
+                error = e
+            else:
+                self.sent += 1
+                raise Return()
+            finally:
+                self._semaphore.release()
+
+            if not _retryable(error):
+                break
+
+        self.failed += 1
+        logging.error("failed to delete {} ids of repository {} from index: {}".format(
+            len(batch), repository.repository_id, error))
+
+    def stats(self):
+        """
+        Counters of the queue
+
+        :returns: dictionary
+        """
+        return {
+            'pending': len(self._pending),
+            'queued': self.queued,
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed
+        }
+
+
+def index_delete_queue():
+    """
+    The queue of the deletes from the index service of this process
+
+    :returns: IndexDeleteQueue
+    """
+    global _index_delete_queue
+    if _index_delete_queue is None:
+        _index_delete_queue = IndexDeleteQueue(
+            delete_from_index,
+            int(options.index_delete_batch_size),
+            int(options.index_delete_max_outstanding),
+            int(options.index_delete_retries),
+            float(options.index_delete_backoff))
+
+    return _index_delete_queue
 
 
 ## ASSET MODEL
@@ -241,12 +533,7 @@ class Asset(Entity):
         :param entity_id: The entity_id of the offer either in the form of an IRI, either as an id
         :returns: an id normalised usable in SPARQL queries
         """
-        if entity_id.startswith(PREFIXES['id']):
-            entity_id = entity_id[len(PREFIXES['id']):]
-        entity_id = entity_id.lower()
-        if not re.match("id:{}".format(ENTITY_ID_REGEX), entity_id):
-            return build_uuid_reference(entity_id)
-        return entity_id
+        return normalise_entity_id(entity_id)
 
     # LIST VIEW
     LIST_EXTRA_IDS = ASSET_LIST_EXTRA_IDS
@@ -309,210 +596,174 @@ class Asset(Entity):
         entity_ids = [x[u'entity_id'] for x in assetids]
         yield Entity.insert_timestamps(ids=entity_ids, repository=repository)
 
-        # Send notification to index service
-        IOLoop.current().spawn_callback(partial(eval('send_notification'), repository))
+        # Send notification to index service, folded with the other
+        # notifications of the repository. There is no index service in
+        # standalone mode.
+        if not options.standalone:
+            notification_scheduler().notify(repository)
 
         raise Return(assetids)
 
     @classmethod
     @coroutine
     def before_store(cls, payload, content_type, repository):
+        if isinstance(payload, helper.ParsedPayload):
+            yield payload.load()
+
         assetids = get_asset_ids(payload, content_type)
         entity_ids = [x[u'entity_id'] for x in assetids]
 
+        assets_ids = []
         for entity_id in entity_ids:
             ids = get_asset_source_ids(payload, content_type, entity_id)
 
             logging.debug('beforestore got ' + str(ids))
 
-            # delete existing tripes from index
-            IOLoop.current().spawn_callback(partial(eval('delete_from_index'), repository, ids))
+            # delete existing tripes from index, batched with the other ids
+            index_delete_queue().delete(repository, ids)
+            assets_ids.append(ids)
 
-            # delete from repository
-            yield cls._delete(repository, ids)
+        # delete from repository
+        yield cls._delete(repository, assets_ids)
         raise Return()
 
-    @classmethod
-    @coroutine
-    def _getMatchingEntities(self, dbc, ids):
+    @staticmethod
+    def _validate_source_ids(ids):
         """
-        Get list of entities matching the given incoming ids 
-
-        :param dbc: the repository database connection
-        :param ids: a list of dictionaries containing "source_id" & "source_id_type".
+        Validate and normalise source ids
 
-        :returns: a list of entity ids
+        :param ids: a list of dictionaries containing "source_id" & "source_id_type"
+            (or "id" & "id_type")
+        :returns: a list of dictionaries containing "source_id" & "source_id_type"
+        :raises: HTTPError if an id is invalid
         """
-        subqueries = [SOURCE_ID_FILTER_TEMPLATE.substitute(id = x['source_id'], id_type = x['source_id_type'])
-                      for x in ids]
+        validated_ids, errors = [], []
 
-        query = FIND_ENTITY_TEMPLATE.substitute(id_filter = ''.join(subqueries))
+        for x in ids:
+            if 'id' in x:
+                x = {'source_id': x['id'], 'source_id_type': x['id_type']}
+            if 'source_id_type' not in x or 'source_id' not in x:
+                errors.append(x)
+            elif x['source_id_type'] == HUB_KEY:
+                try:
+                    parsed = hubkey.parse_hub_key(x['source_id'])
+                    validated_ids.append({'source_id': parsed['entity_id'], 'source_id_type': HUB_KEY})
+                except ValueError:
+                    errors.append(x)
+            else:
+                # NOTE: internal representation of the index will use
+                # id_type and id to construct URI and assusmes that id_type
+                # and and have been url_quoted
+                validated_ids.append({'source_id': x['source_id'], 'source_id_type': x['source_id_type']})
 
-        logging.debug('search : ' + query)
-        
-        queryresults = yield dbc.query(query)
+        if errors:
+            raise HTTPError(400, errors)
 
-        results = [x['s'] for x in self._parse_response(queryresults)]
-        raise Return(results)
+        return validated_ids
 
-    @classmethod
-    @coroutine
-    def _getEntityIdsAndTypes(self, dbc, entity_id):
+    @staticmethod
+    def _source_id_filter(ids):
         """
-        Get list of source_ids and source_id_types for a given entity id
-
-        :param dbc: the repository database connection
-        :param entity_id: the entity id
+        Build the VALUES rows matching source ids
 
-        :returns: a list of source_id and source_id_types
+        :param ids: an iterable of (source_id_type, source_id) tuples
+        :returns: str
         """
-        query = FIND_ENTITY_SOURCE_IDS_TEMPLATE.substitute(entity_id = entity_id)
-
-        queryresults = yield dbc.query(query)
-        results = [{'source_id_type': x['idtype'], 'source_id': x['id']} for x in self._parse_response(queryresults)]
-        raise Return(results)
+        return '\n'.join('(%s <%s%s>)' % (build_sparql_str(source_id), PREFIXES['hub'], source_id_type)
+                         for source_id_type, source_id in ids)
 
     @classmethod
     @coroutine
-    def _countMatchesNotIncluding(self, dbc, idAndType, entity_id):
+    def _getMatchingEntities(cls, dbc, ids):
         """
-        Count the number of entities using these ids/types (other than this entity)
+        Get the entities using any of the given ids, with all of their ids
 
         :param dbc: the repository database connection
-        :param: idAndType: the source_id and source_id_type to search for
-        :param entity_id: the entity id of the entity to exclude
+        :param ids: an iterable of (source_id_type, source_id) tuples
 
-        :returns: a count of entities
+        :returns: a dictionary mapping each entity to a dictionary of its
+            (source_id_type, source_id) tuples to (id type, id) rdflib terms
         """
-        query = FIND_ENTITY_COUNT_BY_SOURCE_IDS_TEMPLATE.substitute(source_id_type = idAndType['source_id_type'],
-                                                                    source_id = idAndType['source_id'],
-                                                                    entity_id = entity_id)
+        query = FIND_ENTITIES_AND_SOURCE_IDS_TEMPLATE.substitute(id_filter=cls._source_id_filter(ids))
 
+        logging.debug('search : ' + query)
         queryresults = yield dbc.query(query)
-        logging.debug(queryresults)
 
-        raise Return(self._parse_response(queryresults)[0]['count'])
+        results = {}
+        for x in cls._parse_response(queryresults):
+            key = (x['idtype'].toPython().replace(PREFIXES['hub'], ''), x['id'].value)
+            results.setdefault(x['s'], {})[key] = (x['idtype'], x['id'])
 
-    @classmethod
-    @coroutine
-    def _deleteIds(self, dbc, idAndType):
-        """
-        Delete id/type triples
-
-        :param dbc: the repository database connection
-        :param: idAndType: the source_id and source_id_type to delete
-
-        :returns: nothing
-        """
-        logging.debug('delete idandtype ' + str(idAndType))
-        query = DELETE_ID_TRIPLES_TEMPLATE.substitute(source_id_type = idAndType['source_id_type'],
-                                                                    source_id = idAndType['source_id'])
-
-        queryresults = yield dbc.update(query)
-        logging.debug(queryresults)
-
-        raise Return()    
+        raise Return(results)
 
     @classmethod
     @coroutine
-    def _deleteAsset(self, dbc, entity_id):
+    def _countMatchesNotIncluding(cls, dbc, ids, entities):
         """
-        Delete entity triples
+        Count the number of entities using these ids/types (other than these entities)
 
         :param dbc: the repository database connection
-        :param: entity_id: the id of the entity to delete
+        :param ids: a list of (id type, id) rdflib terms
+        :param entities: the entities to exclude
 
-        :returns: nothing
+        :returns: a dictionary mapping (id type, id) to a count of entities
         """
-        logging.debug('delete entity_id ' + str(entity_id))
-        query = DELETE_ENTITY_TRIPLE_TEMPLATE.substitute(entity_id = entity_id)
+        query = COUNT_ENTITIES_BY_SOURCE_IDS_TEMPLATE.substitute(
+            id_filter='\n'.join('(%s %s)' % (id_.n3(), idtype.n3()) for idtype, id_ in ids),
+            entity_ids=', '.join(entity.n3() for entity in entities))
 
-        queryresults = yield dbc.update(query)
-        logging.debug(queryresults)
+        queryresults = yield dbc.query(query)
 
-        raise Return()    
+        raise Return({(x['idtype'], x['id']): int(x['count']) for x in cls._parse_response(queryresults)})
 
     @classmethod
     @coroutine
-    def _delete(self, dbc, ids):
+    def _delete(cls, dbc, assets_ids):
         """
-        Delete the triples relating to an entity (if they're not used
-        by another entity)
+        Delete the triples relating to the entities identified by exactly the
+        same ids as an asset, and their ids if they're not used by another
+        entity. The repository is queried and updated in a fixed number of
+        requests, whatever the number of assets.
 
         :param dbc: the repository database connection
-        :param ids: a list of dictionaries containing "id" & "id_type"
+        :param assets_ids: a list containing, for each asset, a list of
+            dictionaries containing "source_id" & "source_id_type"
         """
-        
-        validated_ids, errors = [], []
-
-        for x in ids:                        # source_id / source_id_type
-            if 'id' in x:
-                x['source_id'] = x['id']
-                x['source_id_type'] = x['id_type']
-            if 'source_id_type' not in x or 'source_id' not in x:
-                errors.append(x)
-            elif x['source_id_type'] == HUB_KEY:
-                try:
-                    parsed = hubkey.parse_hub_key(x['source_id'])
-                    x['source_id'] = parsed['entity_id']
-                    validated_ids.append(x)
-                except ValueError:
-                    errors.append(x)
-            else:
-                # NOTE: internal representation of the index will use
-                # id_type and id to construct URI and assusmes that id_type
-                # and and have been url_quoted
-                x['source_id'] = x['source_id']
-                x['source_id_type'] = x['source_id_type']
-                validated_ids.append(x)
-
-        if errors:
-            raise exceptions.HTTPError(400, errors)
+        assets_ids = [{(x['source_id_type'], x['source_id']) for x in cls._validate_source_ids(ids)}
+                      for ids in assets_ids]
+        searched = set().union(*assets_ids)
+        if not searched:
+            raise Return()
 
         # get all the entities that match the the ids in this repo
-        logging.debug('searching for ids ' + str(validated_ids))
-        entities = yield self._getMatchingEntities(dbc, validated_ids)
-
-        logging.debug('found entities ' + str(entities))
-
-        # for each entity find all the ids associated with it
-        for entity in entities:
-            idsAndTypes = yield self._getEntityIdsAndTypes(dbc, entity)
+        logging.debug('searching for ids ' + str(searched))
+        entities = yield cls._getMatchingEntities(dbc, searched)
 
-            logging.debug('for entity ' + str(entity) + ' got these ids ' + str(idsAndTypes))
+        # only delete the entities that are an exact match for the ids of an asset
+        assets_ids = set(frozenset(ids) for ids in assets_ids)
+        entities = {entity: ids for entity, ids in entities.items() if frozenset(ids) in assets_ids}
 
-            assetMatch = yield self._checkIdsAndTypesIdentical(validated_ids, idsAndTypes)
+        logging.debug('found entities ' + str(entities.keys()))
+        if not entities:
+            raise Return()
 
-            logging.debug('identical? : ' + str(assetMatch))
+        # delete the ids that are NOT used for anything else
+        ids = list({id_ for entity_ids in entities.values() for id_ in entity_ids.values()})
+        counts = yield cls._countMatchesNotIncluding(dbc, ids, entities.keys())
+        unused = [id_ for id_ in ids if counts.get(id_, 0) == 0]
 
-            # if this asset is an exact match for the ids we're looking for
-            if assetMatch:
-                # loop through each set of ids for this entity
-                for idAndType in idsAndTypes:
-                    # if these ids are NOT used for anything else then delete them
+        query = DELETE_ENTITIES_TEMPLATE.substitute(
+            entity_filter='\n'.join('(%s)' % (entity.n3(),) for entity in entities))
+        if unused:
+            query = DELETE_SOURCE_IDS_TEMPLATE.substitute(
+                id_filter='\n'.join('(%s %s)' % (id_.n3(), idtype.n3()) for idtype, id_ in unused)
+            ) + ';' + query
 
-                    logging.debug('counting ' + str(idAndType))
-
-                    result = yield self._countMatchesNotIncluding(dbc, idAndType, entity)
-                    count = int(result)
+        queryresults = yield dbc.update(query)
+        logging.debug(queryresults)
 
-                    logging.debug('count '+ str(count))
-                    if count == 0:
-                        yield self._deleteIds(dbc, idAndType)
-                
-                # delete the entity itself
-                yield self._deleteAsset(dbc, entity)
-            
         raise Return()
 
-    @classmethod
-    @coroutine
-    def _checkIdsAndTypesIdentical(self, searchIds, assetRdfIds):
-        if not [s for s in searchIds if (s['source_id_type'], s['source_id']) not in {(a['source_id_type'].toPython().replace('http://openpermissions.org/ns/hub/', ''), a['source_id'].value) for a in assetRdfIds}] \
-            and not [a for a in assetRdfIds if (a['source_id_type'].toPython().replace('http://openpermissions.org/ns/hub/', ''), a['source_id'].value) not in {(s['source_id_type'], s['source_id']) for s in searchIds}]:
-            raise Return(True)
-        else:
-            raise Return(False)
 
 @coroutine
 def retrieve_paged_assets(repository, from_time, to_time, page=1, page_size=1000):
@@ -550,6 +801,95 @@ def retrieve_paged_assets(repository, from_time, to_time, page=1, page_size=1000
     raise Return((results, results_range))
 
 
+
+# columns of the rows returned by Asset._retrieve_ids_after
+_AFTER_FIELDS = ['entity_uri', 'source_id', 'source_id_type', 'last_modified', 'cursor']
+
+
+def _asset_after_record(row):
+    """
+    Convert a row returned by Asset._retrieve_ids_after into an asset record
+
+    :param row: sequence of values
+    :returns: (record, cursor of the row)
+    """
+    record = dict(zip(_AFTER_FIELDS, row))
+    record['entity_id'] = record['entity_uri'].split('/')[-1]
+    record['source_id_type'] = record['source_id_type'].split('/')[-1]
+    cursor = (unicode(record.pop('cursor')), record['entity_id'])
+    return record, cursor
+
+
+def _after_where(from_time, to_time):
+    return Asset.timerange_constraint(
+        "when",
+        from_time=from_time.isoformat(),
+        to_time=to_time.isoformat())
+
+
+@coroutine
+def retrieve_assets_after(repository, from_time, to_time, after=None, page_size=1000):
+    """
+    Get identifiers of assets that have been modified/added within time window,
+    starting after a cursor rather than at an offset.
+
+    :param repository: the repository/namespace that we want to query
+    :param from_time: datetime
+    :param to_time: datetime
+    :param after: (timestamp, entity_id) cursor returned for the previous page, None for the first page
+    :param page_size: number of assets per page
+    :returns: (results, results range, cursor of the next page)
+    """
+    where = _after_where(from_time, to_time)
+
+    query_result = yield Asset._retrieve_ids_after(where, after=after, page_size=page_size, repository=repository)
+
+    if not query_result:
+        raise Return(([], (), None))
+
+    results, cursors = zip(*[_asset_after_record(row) for row in query_result])
+    results = list(results)
+
+    # the last entity of the page in the order of the query
+    next_after = max(cursors)
+
+    results_range = (results[0]['last_modified'], results[-1]['last_modified'])
+    raise Return((results, results_range, next_after))
+
+
+@coroutine
+def stream_assets_after(repository, from_time, to_time, on_record, after=None, page_size=1000):
+    """
+    Same as retrieve_assets_after, with each asset record passed to on_record
+    as it is received from the database, so that the page is never held in memory.
+
+    :param repository: the repository/namespace that we want to query
+    :param from_time: datetime
+    :param to_time: datetime
+    :param on_record: function called with each asset record
+    :param after: (timestamp, entity_id) cursor returned for the previous page, None for the first page
+    :param page_size: number of assets per page
+    :returns: (number of records, results range, cursor of the next page)
+    """
+    where = _after_where(from_time, to_time)
+    state = {'first': None, 'last': None, 'after': None}
+
+    def on_row(row):
+        record, cursor = _asset_after_record(row)
+        if state['first'] is None:
+            state['first'] = record['last_modified']
+        state['last'] = record['last_modified']
+        state['after'] = max(state['after'], cursor)
+        on_record(record)
+
+    count = yield Asset._stream_ids_after(where, after=after, page_size=page_size,
+                                          repository=repository, on_row=on_row)
+
+    if not count:
+        raise Return((0, (), None))
+
+    raise Return((count, (state['first'], state['last']), state['after']))
+
 exists = Asset.exists
 insert_timestamps = Asset.insert_timestamps
 store = Asset.store
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""In process caches"""
+import functools
+import time
+from collections import OrderedDict
+
+from tornado.ioloop import IOLoop
+
+_MISSING = object()
+
+
+class _Memo(dict):
+    """The memo of a function memoised by memoise, keyed by the arguments of the calls"""
+    def __init__(self, func, max_size):
+        super(_Memo, self).__init__()
+        self.func = func
+        self.half = max(1, max_size // 2)
+        self.previous = {}
+
+    def __missing__(self, args):
+        value = self.previous.pop(args, _MISSING)
+        if value is _MISSING:
+            value = self.func(*args)
+
+        if len(self) >= self.half:
+            self.previous = dict(self)
+            self.clear()
+        self[args] = value
+        return value
+
+    def clear_all(self):
+        self.previous = {}
+        self.clear()
+
+
+def memoise(max_size):
+    """
+    Decorator memoising the results of a function of hashable arguments.
+
+    The memo is bounded to about max_size results and drops the least
+    recently used ones first. It keeps two generations of results: results
+    are added to the current generation, which replaces the previous
+    generation once it holds max_size / 2 results, and a result found in the
+    previous generation is moved to the current one. A lookup is a dictionary
+    lookup, where an OrderedDict based LRU would be slower than the functions
+    it memoises.
+
+    Exceptions are not memoised. The memo of the decorated function can be
+    emptied with its clear attribute.
+
+    :param max_size: maximum number of results memoised
+    """
+    def decorator(func):
+        memo = _Memo(func, max_size)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            return memo[args]
+
+        wrapper.clear = memo.clear_all
+        return wrapper
+
+    return decorator
+
+
+class TTLCache(object):
+    """
+    A bounded least recently used cache whose entries expire.
+
+    The cache is bounded by its number of entries and, optionally, by the
+    total cost (e.g. the size in bytes) of its entries.
+
+    An entry may be kept for a stale period after it has expired, during which
+    it is only returned by `lookup`.
+    """
+
+    def __init__(self, max_size=1000, ttl=60.0, clock=time.time, max_cost=None):
+        """
+        :param max_size: maximum number of entries, the least recently used are evicted first
+        :param ttl: default time to live of the entries in seconds
+        :param clock: function returning the current time in seconds
+        :param max_cost: maximum total cost of the entries, None for no limit
+        """
+        self.max_size = max_size
+        self.max_cost = max_cost
+        self.cost = 0
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _find(self, key):
+        """
+        Find an entry that has not passed its stale period, marking it as most recently used
+
+        :param key: the key of the entry
+        :returns: (value, expires, stale_until, cost) tuple or None
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        elif self.clock() >= entry[2]:
+            self.cost -= entry[3]
+            return None
+
+        self._entries[key] = entry
+        return entry
+
+    def get(self, key, default=None):
+        """
+        Get the value of an entry that has not expired
+
+        :param key: the key of the entry
+        :param default: value returned if there is no entry for the key
+        :returns: the value of the entry or default
+        """
+        entry = self._find(key)
+        if entry is None or self.clock() >= entry[1]:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return entry[0]
+
+    def lookup(self, key):
+        """
+        Get the value of an entry, including an expired entry in its stale period
+
+        :param key: the key of the entry
+        :returns: (value, fresh) tuple, (None, False) if there is no entry for the key
+        """
+        entry = self._find(key)
+        if entry is None:
+            self.misses += 1
+            return None, False
+        elif self.clock() >= entry[1]:
+            self.stale_hits += 1
+            return entry[0], False
+
+        self.hits += 1
+        return entry[0], True
+
+    def set(self, key, value, ttl=None, stale_ttl=0, cost=0):
+        """
+        Add or replace an entry
+
+        :param key: the key of the entry
+        :param value: the value of the entry
+        :param ttl: time to live in seconds, defaults to the cache's ttl
+        :param stale_ttl: time in seconds the entry is kept after it has expired
+        :param cost: cost of the entry, counted against max_cost
+        """
+        if ttl is None:
+            ttl = self.ttl
+
+        self.pop(key)
+        if ttl <= 0 and stale_ttl <= 0:
+            return
+        if self.max_cost is not None and cost > self.max_cost:
+            return
+
+        expires = self.clock() + ttl
+        self._entries[key] = (value, expires, expires + stale_ttl, cost)
+        self.cost += cost
+        while len(self._entries) > self.max_size or (self.max_cost is not None and self.cost > self.max_cost):
+            self.cost -= self._entries.popitem(last=False)[1][3]
+
+    def pop(self, key, default=None):
+        """
+        Remove an entry
+
+        :param key: the key of the entry
+        :param default: value returned if there is no entry for the key
+        :returns: the value of the removed entry or default
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+
+        self.cost -= entry[3]
+        return entry[0]
+
+    def clear(self):
+        """Remove all the entries"""
+        self._entries.clear()
+        self.cost = 0
+
+    def shared(self, key, func):
+        """
+        Call func unless a call for the same key is already in progress, in
+        which case the future of that call is returned.
+
+        :param key: the key of the entry
+        :param func: function returning a Future, typically loading and setting the entry
+        :returns: Future
+        """
+        future = self._pending.get(key)
+        if future is None or future.done():
+            future = self._pending[key] = func()
+
+            def done(f):
+                if self._pending.get(key) is f:
+                    del self._pending[key]
+
+            IOLoop.current().add_future(future, done)
+
+        return future
+
+    def stats(self):
+        """
+        Counters of the cache
+
+        :returns: dictionary
+        """
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'cost': self.cost,
+            'max_cost': self.max_cost,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses
+        }
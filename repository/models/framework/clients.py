@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+
+"""Outbound clients of other services and tokens of this service"""
+import logging
+import time
+from functools import partial
+from urlparse import urljoin
+
+import jwt
+from chub.api import API_VERSION, Resource
+from chub.handlers import make_fetch_func
+from chub.oauth2 import get_token
+from koi.configure import ssl_server_options
+from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
+from tornado.options import options, define
+
+from .cache import TTLCache
+
+define('service_token_ttl', help='maximum time in seconds a token of this service is used',
+       default=600.0, type=float)
+define('service_token_refresh', help='time in seconds before its expiry a token of this service '
+       'is refreshed in the background', default=60.0, type=float)
+
+# seconds before its expiry a token is no longer used
+TOKEN_EXPIRY_MARGIN = 10
+
+# fetch functions, each with its own pooled HTTP client, keyed by base url and defaults
+_fetchers = {}
+
+# tokens of this service, keyed by scope
+_service_token_cache = None
+
+
+class Client(Resource):
+    """
+    An API client sharing the HTTP client of the other clients of a service.
+    Requests are made as with chub's API, with the fetch function made once
+    for all the clients of a service by client().
+
+    The resources of a client are not shared, so a request prepared on a
+    client does not affect the requests of other clients.
+    """
+
+    def __init__(self, base_url, fetch, token=None):
+        """
+        :param base_url: base url of the versioned API
+        :param fetch: the shared fetch function
+        :param token: (optional) access token
+        """
+        super(Client, self).__init__(base_url, fetch)
+        self.base_url = base_url
+        if token:
+            self.token = token
+
+    @property
+    def token(self):
+        """The access token sent with the requests, empty if there is none"""
+        header = self.default_headers.get('Authorization', '')
+        if header.startswith('Bearer '):
+            return header[len('Bearer '):]
+        return header
+
+    @token.setter
+    def token(self, token):
+        self.default_headers['Authorization'] = 'Bearer {}'.format(token)
+
+
+def client(base_url, token=None, **kwargs):
+    """
+    An API client of a service
+
+    :param base_url: base url of the service
+    :param token: (optional) access token
+    :param kwargs: defaults of the requests, e.g. ssl_options
+    :returns: Client
+    """
+    key = (base_url, repr(sorted(kwargs.items())))
+    fetcher = _fetchers.get(key)
+    if fetcher is None:
+        versioned_url = urljoin(base_url, API_VERSION)
+        fetcher = _fetchers[key] = (versioned_url, make_fetch_func(versioned_url, True, **kwargs))
+
+    return Client(fetcher[0], fetcher[1], token=token)
+
+
+def service_token_cache():
+    """
+    The cache of tokens of this service of this process
+
+    :returns: TTLCache
+    """
+    global _service_token_cache
+    if _service_token_cache is None:
+        _service_token_cache = TTLCache(max_size=100)
+
+    return _service_token_cache
+
+
+def _token_lifetime(token):
+    """
+    Time in seconds a token may be used, bounded by the expiry of the token
+
+    :param token: Access token
+    :returns: float
+    """
+    lifetime = float(options.service_token_ttl)
+    try:
+        expires = jwt.decode(token, verify=False).get('exp')
+    except jwt.InvalidTokenError:
+        expires = None
+
+    if expires is not None:
+        lifetime = min(lifetime, expires - time.time())
+
+    return lifetime - TOKEN_EXPIRY_MARGIN
+
+
+@coroutine
+def _fetch_service_token(scope):
+    """
+    Get a new token of this service from the auth service and cache it
+
+    :param scope: scope of the token
+    :returns: Access token
+    """
+    token = yield get_token(options.url_auth,
+                            options.service_id,
+                            options.client_secret,
+                            scope=scope,
+                            cache=False,
+                            ssl_options=ssl_server_options())
+
+    lifetime = _token_lifetime(token)
+    refresh = min(float(options.service_token_refresh), lifetime)
+    service_token_cache().set(str(scope), token, ttl=lifetime - refresh, stale_ttl=refresh)
+    raise Return(token)
+
+
+@coroutine
+def _refresh_service_token(scope):
+    """
+    Refresh a cached token of this service in the background
+
+    :param scope: scope of the token
+    """
+    try:
+        yield service_token_cache().shared(str(scope), partial(_fetch_service_token, scope))
+    except Exception as exc:
+        logging.warning('Unable to refresh token for scope %s: %s' % (scope, exc))
+
+
+@coroutine
+def service_token(scope):
+    """
+    A token of this service.
+
+    The token is requested once and cached. A token close to its expiry is
+    still returned while it is refreshed in the background.
+
+    :param scope: scope of the token, e.g. chub.oauth2.Write(url)
+    :returns: Access token
+    """
+    cache = service_token_cache()
+    token, fresh = cache.lookup(str(scope))
+    if token is None:
+        token = yield cache.shared(str(scope), partial(_fetch_service_token, scope))
+    elif not fresh:
+        IOLoop.current().spawn_callback(_refresh_service_token, scope)
+
+    raise Return(token)
+
+
+def drop_service_token(scope):
+    """
+    Remove a cached token of this service, e.g. after it has been rejected
+
+    :param scope: scope of the token
+    """
+    service_token_cache().pop(str(scope))
@@ -10,17 +10,43 @@
 from __future__ import unicode_literals
 import logging
 import os
+import time
+import weakref
+
+import rdflib
 
 from functools import partial
 from tornado.gen import coroutine, Return
 from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.ioloop import IOLoop
 from tornado.options import options, define
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
 from urllib import urlencode
 
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:  # pragma: no cover
+    # pycurl is not available
+    CurlAsyncHTTPClient = None
+
 from ..framework import helper
 
 define("url_repo_db", help='location of database server', default="http://localhost", type=str)
 define("repo_db_port", help='port on which the database runs', default="8080", type=str)
+define("repo_db_use_curl", help='use a pooled, keep-alive curl client to connect to the database',
+       default=True, type=bool)
+define("repo_db_max_clients", help='maximum number of concurrent connections to the database',
+       default=50, type=int)
+define("repo_db_connect_timeout", help='timeout in seconds for connecting to the database',
+       default=20.0, type=float)
+define("repo_db_request_timeout", help='timeout in seconds for a request to the database',
+       default=20.0, type=float)
+define("repo_db_gzip", help='request gzip compressed responses from the database',
+       default=True, type=bool)
+define("repo_db_upload_timeout", help='timeout in seconds for streaming a file to the database',
+       default=600.0, type=float)
+define("repo_db_warm_namespaces", help='list the existing namespaces of the database on start up',
+       default=True, type=bool)
 
 # FIXME: This is probably no more necessary
 define("repo_db_path", help='path of the default namespace (deprecated)', default="/bigdata/namespace/", type=str)
@@ -35,6 +61,141 @@ NAMESPACE_ASSET = """
 
 INITIAL_DATA = os.path.join(os.path.dirname(__file__), '../../../initial_data')
 
+# predicate of the namespace names in blazegraph's namespace listing
+BIGDATA_NAMESPACE = 'http://www.bigdata.com/rdf#/features/KB/Namespace'
+
+# size of the chunks of a file streamed to the database
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+# HTTP clients used to connect to the database, one per IOLoop
+_clients = weakref.WeakKeyDictionary()
+
+# HTTP clients streaming files to the database, one per IOLoop
+_upload_clients = weakref.WeakKeyDictionary()
+
+# counters of requests made to the database by this process
+_stats = {
+    'requests': 0,
+    'errors': 0,
+    'active': 0,
+    'max_active': 0
+}
+
+# number of requests in flight on each HTTP client
+_in_flight = weakref.WeakKeyDictionary()
+
+# namespaces known to exist in the database, with the time they were found
+_known_namespaces = {}
+
+# namespace creations in progress, shared by the requests waiting on them
+_namespace_creations = {}
+
+
+def _make_http_client():
+    """
+    Create an HTTP client configured with the repo_db_* options
+
+    :return: AsyncHTTPClient
+    """
+    kwargs = {
+        'max_clients': int(options.repo_db_max_clients),
+        'defaults': {
+            'connect_timeout': float(options.repo_db_connect_timeout),
+            'request_timeout': float(options.repo_db_request_timeout),
+            'decompress_response': bool(options.repo_db_gzip)
+        }
+    }
+
+    if options.repo_db_use_curl:
+        if CurlAsyncHTTPClient is not None:
+            return CurlAsyncHTTPClient(force_instance=True, **kwargs)
+        logging.warning('pycurl is not installed, using the simple HTTP client for the database')
+
+    return SimpleAsyncHTTPClient(force_instance=True, **kwargs)
+
+
+def http_client():
+    """
+    The HTTP client used for database requests on the current IOLoop.
+    It is shared by all requests so that connections are pooled and kept alive.
+
+    :return: AsyncHTTPClient
+    """
+    io_loop = IOLoop.current()
+    client = _clients.get(io_loop)
+    if client is None:
+        client = _clients[io_loop] = _make_http_client()
+
+    return client
+
+
+def upload_client():
+    """
+    The HTTP client streaming files to the database on the current IOLoop.
+    The curl client does not support streamed request bodies, so the simple
+    HTTP client is used.
+
+    :return: AsyncHTTPClient
+    """
+    io_loop = IOLoop.current()
+    client = _upload_clients.get(io_loop)
+    if client is None:
+        client = _upload_clients[io_loop] = SimpleAsyncHTTPClient(
+            force_instance=True,
+            max_clients=int(options.repo_db_max_clients),
+            defaults={
+                'connect_timeout': float(options.repo_db_connect_timeout),
+                'request_timeout': float(options.repo_db_upload_timeout)
+            })
+
+    return client
+
+
+def pool_stats():
+    """
+    Statistics about the requests made to the database by this process
+
+    :return: dictionary
+    """
+    stats = dict(_stats)
+    client = _clients.get(IOLoop.current())
+    stats['client'] = type(client).__name__ if client else None
+    stats['max_clients'] = None
+    if client is not None:
+        # the requests beyond the connections of the client wait in its queue
+        stats['max_clients'] = int(options.repo_db_max_clients)
+        stats['queued'] = max(0, _in_flight.get(client, 0) - stats['max_clients'])
+
+    return stats
+
+
+@coroutine
+def _fetch(url, client=None, **kwargs):
+    """
+    Send a request to the database with the shared HTTP client
+
+    :param url: url of the request
+    :param client: (optional) the HTTP client, defaults to http_client()
+    :param kwargs: arguments of AsyncHTTPClient.fetch
+    :return: HTTPResponse
+    """
+    client = client or http_client()
+    _stats['requests'] += 1
+    _stats['active'] += 1
+    _stats['max_active'] = max(_stats['max_active'], _stats['active'])
+    _in_flight[client] = _in_flight.get(client, 0) + 1
+    try:
+        rsp = yield client.fetch(url, **kwargs)
+    except Exception:
+        _stats['errors'] += 1
+        raise
+    finally:
+        _stats['active'] -= 1
+        _in_flight[client] -= 1
+
+    raise Return(rsp)
+
 
 @coroutine
 def load_directory(directory, repository_id):
@@ -64,12 +225,12 @@ def load_data(filename, cdb):
         content = content_file.read()
 
     if filename.endswith('.ttl'):
-        helper.validate(content, format='turtle')
+        yield helper.parse(content, format='turtle')
         yield cdb.store(
             content,
             content_type='text/turtle')
     elif filename.endswith('.xml') or filename.endswith('.rdf'):
-        helper.validate(content, format='xml')
+        yield helper.parse(content, format='xml')
         yield cdb.store(
             content,
             content_type='application/xml')
@@ -88,13 +249,82 @@ def _initialise_namespace(namespace):
     namespace_query = NAMESPACE_ASSET.format(namespace).strip()
     db_url = _namespace_url('')
     headers = {'Content-Type': 'application/xml'}
-    yield AsyncHTTPClient().fetch(db_url, method="POST", body=namespace_query, headers=headers)
+    yield _fetch(db_url, method="POST", body=namespace_query, headers=headers)
 
 
 @coroutine
 def create_namespace(namespace):
     yield _initialise_namespace(namespace)
     yield load_directory(INITIAL_DATA, namespace)
+    _known_namespaces[namespace] = time.time()
+
+
+@coroutine
+def _create_missing_namespace(namespace):
+    """
+    Create a namespace that was not found in the database, ignoring errors
+    so that the request which needed it can be retried
+
+    :param namespace: name of the namespace
+    """
+    try:
+        yield create_namespace(namespace)
+    except HTTPError as exc:
+        # Namespace already exists with a 409 error
+        if exc.code != 409:
+            logging.error("%s:%s" % (str(exc.code), exc.message))
+        else:
+            logging.warning('Namespace %s already exists' % namespace)
+            _known_namespaces[namespace] = time.time()
+
+
+def ensure_namespace(namespace):
+    """
+    Create a missing namespace. Concurrent callers share the same creation,
+    so that the namespace is created (and the initial data loaded) only once.
+
+    :param namespace: name of the namespace
+    :return: Future resolved when the namespace has been created
+    """
+    future = _namespace_creations.get(namespace)
+    if future is None:
+        future = _namespace_creations[namespace] = _create_missing_namespace(namespace)
+
+        def done(f):
+            if _namespace_creations.get(namespace) is f:
+                del _namespace_creations[namespace]
+
+        IOLoop.current().add_future(future, done)
+
+    return future
+
+
+def known_namespaces():
+    """
+    The namespaces known to exist in the database by this process
+
+    :return: set of namespace names
+    """
+    return set(_known_namespaces)
+
+
+@coroutine
+def warm_namespaces():
+    """
+    Fill the known namespaces with the namespaces listed by the database,
+    so that requests to them skip the namespace creation check
+    """
+    try:
+        rsp = yield _fetch(_namespace_url(''), method='GET',
+                           headers={'Accept': 'application/rdf+xml'})
+        graph = yield helper.parse(rsp.body, format='xml')
+    except Exception as exc:
+        logging.warning('Unable to list the database namespaces: %s' % exc)
+        return
+
+    now = time.time()
+    for name in graph.objects(predicate=rdflib.URIRef(BIGDATA_NAMESPACE)):
+        _known_namespaces.setdefault(unicode(name), now)
 
 
 def _namespace_url(namespace):
@@ -126,6 +356,8 @@ def _set_accept_header(accept_type):
         headers['Accept'] = 'application/sparql-results+xml'
     elif accept_type == 'json':
         headers['Accept'] = "application/sparql-results+json"
+    elif accept_type == 'tsv':
+        headers['Accept'] = "text/tab-separated-values"
     elif accept_type is None:
         pass
     elif accept_type == 'wibble':
@@ -138,16 +370,67 @@ def _set_accept_header(accept_type):
     return headers
 
 
+def _streaming_arguments(streaming_callback):
+    """
+    Arguments of AsyncHTTPClient.fetch passing the body of a successful
+    response to streaming_callback as it is received. The body of an error
+    response (e.g. a missing namespace) is dropped.
+
+    :param streaming_callback: function called with each chunk of the body, or None
+    :return: dictionary
+    """
+    if streaming_callback is None:
+        return {}
+
+    status = [None]
+
+    def header_callback(line):
+        if line.startswith('HTTP/'):
+            status[0] = int(line.split(' ', 2)[1])
+
+    def on_chunk(chunk):
+        if status[0] is not None and 200 <= status[0] < 300:
+            streaming_callback(chunk)
+
+    return {'header_callback': header_callback, 'streaming_callback': on_chunk}
+
+
+def _file_arguments(fileobj, headers):
+    """
+    Arguments of _fetch streaming the content of a file as the body of the
+    request, so that the file is not read in memory
+
+    :param fileobj: the file
+    :param headers: headers of the request, its Content-Length is set
+    :return: dictionary
+    """
+    fileobj.seek(0, os.SEEK_END)
+    headers['Content-Length'] = str(fileobj.tell())
+
+    @coroutine
+    def body_producer(write):
+        fileobj.seek(0)
+        while True:
+            chunk = fileobj.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield write(chunk)
+
+    return {'body_producer': body_producer, 'client': upload_client()}
+
+
 @coroutine
-def request(body_type, namespace, payload,  response_type=None, content_type=None):
+def request(body_type, namespace, payload,  response_type=None, content_type=None, streaming_callback=None):
     """
     Makes request to blazegraph
 
     :param body_type: type of request (e.g: 'query', 'update' or None)
-    :param payload: request body
+    :param payload: request body, or a file streamed as the body if body_type is None
     :param namespace: namespace of request
-    :param response_type: Accept type for header ('csv', 'xml', 'json' or None)
+    :param response_type: Accept type for header ('csv', 'tsv', 'xml', 'json' or None)
     :param content_type: Content type for header
+    :param streaming_callback: (optional) function called with each chunk of the
+        response body as it is received, instead of buffering it in the response
     :return: Response from blazegraph
     """
     if not namespace:
@@ -159,33 +442,34 @@ def request(body_type, namespace, payload,  response_type=None, content_type=Non
     if content_type:
         headers['Content-Type'] = content_type
 
+    arguments = _streaming_arguments(streaming_callback)
     if body_type:
-        body = urlencode({body_type: payload})
+        arguments['body'] = urlencode({body_type: payload})
+    elif hasattr(payload, 'read'):
+        arguments.update(_file_arguments(payload, headers))
     else:
-        body = payload
+        arguments['body'] = payload
 
     logging.debug('request. body_type:' + str(body_type))
     logging.debug('request. payload:' + str(payload))
+    sent = time.time()
     try:
-        rsp = yield AsyncHTTPClient().fetch(db_url, method="POST", body=body, headers=headers)
+        rsp = yield _fetch(db_url, method="POST", headers=headers, **arguments)
     except HTTPError as exc:
-        # If response is 404 then namespace does not exist.
-        # Lazily create namespace and retry request.
-        if exc.code == 404:
-            try:
-                yield create_namespace(namespace)
-            except HTTPError as exc:
-                # Namespace already exists with a 409 error
-                if exc.code != 409:
-                    logging.error("%s:%s" % (str(exc.code), exc.message))
-                else:
-                    logging.warning('Namespace %s already exists' % namespace)
-
-            rsp = yield AsyncHTTPClient().fetch(
-                db_url, method="POST", body=body, headers=headers)
-        else:
+        if exc.code != 404:
             raise exc
 
+        # If response is 404 then namespace does not exist.
+        # Lazily create namespace and retry request, unless it was created
+        # by another request since this one was sent.
+        found = _known_namespaces.get(namespace)
+        if found is None or found <= sent:
+            _known_namespaces.pop(namespace, None)
+            yield ensure_namespace(namespace)
+
+        rsp = yield _fetch(db_url, method="POST", headers=headers, **arguments)
+
+    _known_namespaces.setdefault(namespace, sent)
     raise Return(rsp)
 
 
@@ -17,11 +17,54 @@ import uuid
 from rdflib.query import Result
 from tornado.gen import coroutine, Return
 
-from . import helper
+from . import helper, workers
+from .cache import memoise
 from ..queries import generic
 
 ENTITY_ID_REGEX = "([0-9a-fA-F]{1,64})"
 
+ENTITY_ID_PATTERN = re.compile(ENTITY_ID_REGEX)
+# an entity id, or an id: reference to an entity
+ID_REFERENCE_PATTERN = re.compile("(id:)?" + ENTITY_ID_REGEX)
+SAFE_ID_PATTERN = re.compile(r"([a-zA-Z0-9_.#+@:/%\-]+)")
+PREFIXED_ID_PATTERN = re.compile(r"([a-zA-Z0-9_.\-]+):([a-zA-Z0-9_.#+@%\-]+)")
+PREDICATE_PATH_PATTERN = re.compile(r"(\([^)]*\)|<[^>]*>|\w+:\w+)(?=/|$)")
+
+def _graphs_to_json_ld(graphs):
+    """
+    Serialise graphs as JSON-LD
+
+    :param graphs: dictionary of rdflib graphs (or None)
+    :returns: dictionary of JSON-LD data (or None)
+    """
+    return {key: helper.graph_to_json_ld(graph) if graph is not None else None
+            for key, graph in graphs.items()}
+
+
+def _renamed_copy(g, ids_to_update):
+    """
+    Copy a graph, giving new ids to some of its nodes
+
+    :param g: rdflib.Graph
+    :param ids_to_update: the nodes to rename
+    :returns: rdflib.Graph
+    """
+    new_ids = {x: rdflib.URIRef(generic.PREFIXES['id'] + str(uuid.uuid4()).replace('-', ''))
+               for x in ids_to_update}
+    ng = rdflib.Graph()
+    iquery = ng.query
+
+    def nquery(query,*args, **kwargs):
+        lines = query.split("\n")
+        query = "\n".join([l for l in lines if "hint:Query hint:optimizer \"Runtime\"" not in l])
+        return iquery(query, *args, **kwargs)
+    ng.query = nquery
+
+    for s, p, o in g:
+        ng.add((new_ids.get(s, s), p, new_ids.get(o, o)))
+
+    return ng
+
 
 def build_sparql_filter(*args):
     if len(args):
@@ -40,15 +83,47 @@ def build_hub_reference(s):
 
 
 def validate_entity_id(entity_id):
-    return re.match(ENTITY_ID_REGEX, entity_id)
+    return ENTITY_ID_PATTERN.match(entity_id)
 
 
 def build_uuid_reference(s):
-    if (not re.match(ENTITY_ID_REGEX, s)):
+    if (not ENTITY_ID_PATTERN.match(s)):
         raise helper.ValidationException("%r is not a valid uuid" % (s,))
     return "id:%s" % (s,)
 
 
+def normalise_entity_id(entity_id):
+    """
+    Normalise the id of an entity to the form used in SPARQL queries
+
+    :param entity_id: the id, either an IRI or an id
+    :returns: the id: reference of the entity
+    :raises: ValidationException if the id is not valid
+    """
+    if entity_id.startswith(generic.PREFIXES['id']):
+        entity_id = entity_id[len(generic.PREFIXES['id']):]
+    entity_id = entity_id.lower()
+    match = ID_REFERENCE_PATTERN.match(entity_id)
+    if match is None:
+        return build_uuid_reference(entity_id)
+    elif match.group(1) is None:
+        return "id:%s" % (entity_id,)
+    return entity_id
+
+
+# The predicates come from the queries of the models, so the few distinct paths are
+# almost always found in the memo. The bound only matters if callers build paths.
+@memoise(1024)
+def split_predicate_path(predicate):
+    """
+    Split a predicate path in its predicates, see Entity.set_attr
+
+    :param predicate: a predicate or a predicate path
+    :returns: tuple of str
+    """
+    return tuple(PREDICATE_PATH_PATTERN.findall(predicate))
+
+
 class Entity(object):
     ## The following query ensure the object exists in the database and has the right type
     CLASS = None
@@ -58,7 +133,9 @@ class Entity(object):
     INSERT_TIMESTAMPS = generic.GENERIC_INSERT_TIMESTAMPS
     CHECK_EXISTS = generic.GENERIC_CHECK_EXISTS
     LIST_BY_TIME = generic.GENERIC_LIST
+    LIST_AFTER = generic.GENERIC_LIST_AFTER
     STRUCT_SELECT = None
+    STRUCT_PATTERN = None
 
     @classmethod
     def _parse_response(cls, rsp):
@@ -73,13 +150,13 @@ class Entity(object):
         :returns: the normalised id
         """
         # virtual to be specialised accordingly by each entity
-        if not re.match(r"([a-zA-Z0-9_.#+@:/%\-]+)", id):
+        if not SAFE_ID_PATTERN.match(id):
             raise helper.ValidationException("Not a valid id '{}'".format(id))
 
         if id.startswith("http://"):
             return "<%s>" % (id,)
 
-        if not re.match(r"([a-zA-Z0-9_.\-]+):([a-zA-Z0-9_.#+@%\-]+)", id):
+        if not PREFIXED_ID_PATTERN.match(id):
             return cls.normalise_id(id)
 
         return id
@@ -98,28 +175,41 @@ class Entity(object):
             return "<%s>" % (id,)
         return id
 
+    @classmethod
+    @coroutine
+    def _prepare_payload(cls, payload, content_type):
+        """
+        Wrap the payload so that it is parsed at most once, and validate
+        RDF/XML and JSON-LD payloads on the RDF workers.
+
+        :param payload: raw data or a helper.ParsedPayload
+        :param content_type: mimetype of the raw data
+        :returns: tuple (helper.ParsedPayload, content type of the data stored)
+        """
+        payload = helper.ParsedPayload.from_data(payload, content_type)
+        if payload.format in ('xml', 'json-ld'):
+            yield payload.load()
+
+        raise Return((payload, payload.serialize()[1]))
+
     @classmethod
     @coroutine
     def store(cls, repository, payload, content_type='application/xml'):
         """
         Store the assets in the database.
 
-        :param payload: tornado.httputil.HTTPServerRequest instance
+        :param payload: the data to store, or a helper.ParsedPayload
         :param repository: the linked-data database where to store the asset
-        :param content_type: mimetype of the data uploaded
+        :param content_type: mimetype of the data uploaded (ignored if payload
+            is a helper.ParsedPayload)
         :returns: list of encountered errors
         """
-
-        if content_type == 'application/xml':
-            helper.validate(payload, 'xml')
-        elif content_type == 'application/ld+json':
-            g = helper.validate(payload, 'json-ld')
-            payload = g.serialize()
-            content_type = 'application/xml'
+        payload, content_type = yield cls._prepare_payload(payload, content_type)
 
         yield cls.call_event_handler("before_store", payload=payload, content_type=content_type, repository=repository)
 
-        yield repository.store(payload, content_type=content_type)
+        data, content_type = payload.serialize()
+        yield repository.store(data, content_type=content_type)
 
         res = yield cls.call_event_handler("on_store", payload=payload, content_type=content_type,
                                            repository=repository)
@@ -132,18 +222,13 @@ class Entity(object):
         """
         Delete an asset in the database.
 
-        :param payload: tornado.httputil.HTTPServerRequest instance
+        :param payload: the data to delete, or a helper.ParsedPayload
         :param repository: the linked-data database where to store the asset
-        :param content_type: mimetype of the data uploaded
+        :param content_type: mimetype of the data uploaded (ignored if payload
+            is a helper.ParsedPayload)
         :returns: list of encountered errors
         """
-
-        if content_type == 'application/xml':
-            helper.validate(payload, 'xml')
-        elif content_type == 'application/ld+json':
-            g = helper.validate(payload, 'json-ld')
-            payload = g.serialize()
-            content_type = 'application/xml'
+        payload, content_type = yield cls._prepare_payload(payload, content_type)
 
         yield cls.call_event_handler("before_store", payload=payload, content_type=content_type, repository=repository)
 
@@ -187,15 +272,74 @@ class Entity(object):
         if format == "turtle":
             raise Return(rsp.body)
         if format == "graph":
-            graph = rdflib.Graph()
-            graph.parse(data=rsp.body, format="turtle")
+            graph = yield workers.run(len(rsp.body), helper.parse_graph, rsp.body, "turtle")
             raise Return(graph)
         elif format == "jsonld":
-            result = helper.rdf_to_json_ld(rsp.body, input_format='turtle')
+            result = yield workers.run(len(rsp.body), helper.rdf_to_json_ld, rsp.body, input_format='turtle')
             raise Return(result)
         else:
             raise ValueError("Unsupported serialisation format requested")
 
+    @staticmethod
+    def _id_uri(normalised_id):
+        """
+        The URI of a normalised id
+
+        :param normalised_id: an id as returned by normalise_id
+        :returns: rdflib.URIRef
+        """
+        if normalised_id.startswith('<'):
+            return rdflib.URIRef(normalised_id[1:-1])
+        return helper.solve_ns(normalised_id)
+
+    @classmethod
+    @coroutine
+    def retrieve_many(cls, repository, entity_ids, format="jsonld"):
+        """
+        Retrieve several objects with a single query
+
+        :param repository: the linked-data database where to store the asset
+        :param entity_ids: ids of the objects
+        :param format: "jsonld" or "graph"
+        :return: a dictionary mapping each id to the object (None if the object was not found)
+        """
+        if format not in ("jsonld", "graph"):
+            raise ValueError("Unsupported serialisation format requested")
+
+        entity_ids = set(entity_ids)
+        if not entity_ids:
+            raise Return({})
+
+        normalised = {eid: cls.normalise_id(eid) for eid in entity_ids}
+
+        query = generic.SPARQL_PREFIXES
+        if cls.STRUCT_PATTERN is not None:
+            struct_query = cls.STRUCT_PATTERN
+        else:
+            struct_query = "BIND ( ?entity as ?s ) "
+        query += (generic.GENERIC_GET_MANY % (struct_query,)).format(
+            ids=" ".join(sorted(set(normalised.values()))), **{'class': cls.CLASS})
+        rsp = yield repository.query(query, response_type='#text/turtle')
+
+        graph = yield workers.run(len(rsp.body), helper.parse_graph, rsp.body, "turtle")
+
+        retrieved_for = rdflib.URIRef(generic.GENERIC_RETRIEVED_FOR)
+        subgraphs = {}
+        for s, entity in graph.subject_objects(retrieved_for):
+            subgraph = subgraphs.setdefault(entity, rdflib.Graph())
+            for p, o in graph.predicate_objects(s):
+                if p != retrieved_for:
+                    subgraph.add((s, p, o))
+
+        result = {eid: subgraphs.get(cls._id_uri(nid)) for eid, nid in normalised.items()}
+        if format == "graph":
+            result = {eid: subgraph if subgraph is not None else rdflib.Graph()
+                      for eid, subgraph in result.items()}
+        else:
+            result = yield workers.run(len(rsp.body), _graphs_to_json_ld, result)
+
+        raise Return(result)
+
     @classmethod
     @coroutine
     def call_event_handler(cls, event, **kwargs):
@@ -217,6 +361,55 @@ class Entity(object):
             raise Return(res)
         raise ValueError
 
+    @classmethod
+    def _insert_timestamps_query(cls, entity_id):
+        """
+        INSERT_TIMESTAMPS query of an entity
+
+        :param entity_id: the id of the entity, normalised or not
+        :returns: the query
+        """
+        entity_id = cls.normalise_id(entity_id)
+        # IRI references, e.g. <http://...>, are used as they are
+        if not entity_id.startswith(('id:', '<')):
+            entity_id = 'id:' + entity_id
+        return cls.INSERT_TIMESTAMPS.format(entity_id=entity_id)
+
+    @classmethod
+    @coroutine
+    def get_modified(cls, repository, entity_ids):
+        """
+        Get the time entities were last modified
+
+        :param repository: the linked-data database
+        :param entity_ids: ids of the entities
+        :returns: a dictionary mapping the ids of the entities that have a modified timestamp to the timestamp
+        """
+        entity_ids = set(entity_ids)
+        if not entity_ids:
+            raise Return({})
+
+        normalised = {eid: cls.normalise_id(eid) for eid in entity_ids}
+
+        query = generic.SPARQL_PREFIXES
+        query += generic.GENERIC_GET_MODIFIED.format(ids=" ".join(sorted(set(normalised.values()))))
+        rsp = yield repository.query(query, response_type='json')
+
+        # timestamps are all written by INSERT_TIMESTAMPS in the same format,
+        # so the latest is also the greatest string
+        modified = {}
+        for row in json.loads(rsp.body)['results']['bindings']:
+            uri = row['entity']['value']
+            modified[uri] = max(modified.get(uri), row['modified']['value'])
+
+        result = {}
+        for eid, nid in normalised.items():
+            uri = unicode(cls._id_uri(nid))
+            if uri in modified:
+                result[eid] = modified[uri]
+
+        raise Return(result)
+
     @classmethod
     @coroutine
     def insert_timestamps(cls, repository, ids):
@@ -230,7 +423,7 @@ class Entity(object):
             raise Return()
 
         query = generic.SPARQL_PREFIXES
-        query += ";\n".join(map(lambda i: cls.INSERT_TIMESTAMPS.format(entity_id=cls.normalise_id(i)), ids))
+        query += ";\n".join(map(cls._insert_timestamps_query, ids))
         if query:
             yield repository.update(query)
 
@@ -268,6 +461,80 @@ class Entity(object):
 
         raise Return(result)
 
+    @classmethod
+    def _ids_after_query(cls, filters, after, page_size):
+        """
+        Build the query of identifiers of entities ordered by modification time, starting after a cursor.
+
+        :param filters: a list of filter to be applied to the query
+        :param after: (timestamp, entity_id) of the last entity of the previous page, None for the first page
+        :param page_size: number of entities per page
+        :return: SPARQL query
+        """
+        page_size = max(1, page_size)
+
+        after_filter = ""
+        if after:
+            timestamp, entity_id = after
+            timestamp = "{}^^xsd:dateTime".format(build_sparql_str(timestamp))
+            entity_uri = build_sparql_str(unicode(cls._id_uri(cls.normalise_id(entity_id))))
+            after_filter = "FILTER(?when > {when} || (?when = {when} && STR(?{id_name}) > {uri}))".format(
+                when=timestamp, uri=entity_uri, id_name=cls.ID_NAME)
+
+        query = generic.SPARQL_PREFIXES
+        query += cls.LIST_AFTER.format(**{
+            'class': cls.CLASS,
+            'id_name': cls.ID_NAME,
+            'filter': build_sparql_filter(*filters),
+            'after': after_filter,
+            'extra_query': getattr(cls, "LIST_EXTRA_QUERY", "").format(id_name=cls.ID_NAME),
+            'extra_query_ids': getattr(cls, "LIST_EXTRA_IDS", ""),
+            'page_size': page_size
+        })
+        return query
+
+    @classmethod
+    @coroutine
+    def _retrieve_ids_after(cls, filters, after, page_size, repository):
+        """
+        Query identifiers of entities ordered by modification time, starting after a cursor.
+
+        :param filters: a list of filter to be applied to the query
+        :param after: (timestamp, entity_id) of the last entity of the previous page, None for the first page
+        :param page_size: number of entities per page
+        :param repository: the linked-data database
+        :return: List of entities, with the timestamp used to order each entity as last column
+        """
+        query = cls._ids_after_query(filters, after, page_size)
+
+        rsp = yield repository.query(query)
+
+        result = cls._parse_response(rsp)
+
+        raise Return(result)
+
+    @classmethod
+    @coroutine
+    def _stream_ids_after(cls, filters, after, page_size, repository, on_row):
+        """
+        Same query as _retrieve_ids_after, with each row passed to on_row as
+        it is received from the database instead of returning a list.
+
+        :param filters: a list of filter to be applied to the query
+        :param after: (timestamp, entity_id) of the last entity of the previous page, None for the first page
+        :param page_size: number of entities per page
+        :param repository: the linked-data database
+        :param on_row: function called with each row, a list of rdflib terms
+        :return: number of rows
+        """
+        query = cls._ids_after_query(filters, after, page_size)
+        parser = helper.TSVResultStream(on_row)
+
+        yield repository.query(query, response_type='tsv', streaming_callback=parser.feed)
+        parser.close()
+
+        raise Return(parser.rows)
+
     @classmethod
     def float_range_constraint(cls, var, from_value, to_value, datatype="xsd:float"):
         """
@@ -320,7 +587,7 @@ class Entity(object):
 
     @classmethod
     @coroutine
-    def get_attr(cls, repository, entity_id, predicate, filters=None, page=None, page_size=None):
+    def get_attr(cls, repository, entity_id, predicate, filters=None, page=None, page_size=None, after=None):
         """
         Returns a list of attribute value attached to an entity
 
@@ -330,19 +597,26 @@ class Entity(object):
         :param filters: a set of constraint that the object has to match
         :param page: an integer allowing for paginated replies
         :param page_size: an integer allowing for paginated replies
+        :param after: (optional) only return the values whose string is greater,
+            the page then starts after this value rather than at an offset
         :returns: True or False
         """
         if filters is None:
             filters = []
+        if after is not None:
+            filters = filters + ["STR(?o) > {}".format(build_sparql_str(unicode(after)))]
         query = generic.SPARQL_PREFIXES
         pagination = ""
         if page_size is not None:
             if page_size < 0:
                 raise ValidationError
-            if page is None or page < 1:
-                page = 1
-            page -= 1
-            pagination = "ORDER BY ?o\nOFFSET %d\nLIMIT %d\n" % (page*page_size, page_size)
+            if after is not None:
+                pagination = "ORDER BY ?o\nLIMIT %d\n" % (page_size,)
+            else:
+                if page is None or page < 1:
+                    page = 1
+                page -= 1
+                pagination = "ORDER BY ?o\nOFFSET %d\nLIMIT %d\n" % (page*page_size, page_size)
         query += generic.GENERIC_GET_ATTR.format(id=cls.normalise_id(entity_id), predicate=predicate,
                                                  filter=build_sparql_filter(*filters), pagination=pagination)
 
@@ -389,7 +663,7 @@ class Entity(object):
         """
         if filters is None:
             filters = []
-        predicate_path = re.findall("(\([^)]*\)|<[^>]*>|\w+:\w+)(?=/|$)", predicate)
+        predicate_path = split_predicate_path(predicate)
         query = generic.SPARQL_PREFIXES
         entity_id = cls.normalise_id(entity_id)
 
@@ -420,7 +694,7 @@ class Entity(object):
         if update_last_modified:
             if query.strip()[-1] != ';':
                 query += ";"
-            query += cls.INSERT_TIMESTAMPS.format(entity_id=entity_id)
+            query += cls._insert_timestamps_query(entity_id)
 
         yield repository.update(query)
 
@@ -439,7 +713,7 @@ class Entity(object):
         """
         if filters is None:
             filters = []
-        predicate_path = re.findall("(\([^)]*\)|<[^>]*>|\w+:\w+)(?=/|$)", predicate)
+        predicate_path = split_predicate_path(predicate)
         entity_id = cls.normalise_id(entity_id)
         if len(predicate_path) > 1:
             where_query = """
@@ -465,7 +739,7 @@ class Entity(object):
 
         if update_last_modified:
             query += ";"
-            query += cls.INSERT_TIMESTAMPS.format(entity_id=entity_id)
+            query += cls._insert_timestamps_query(entity_id)
 
         yield repository.update(generic.SPARQL_PREFIXES + query)
 
@@ -490,7 +764,7 @@ class Entity(object):
         """
         if filters is None:
             filters = []
-        predicate_path = re.findall("(\([^)]*\)|<[^>]*>|\w+:\w+)(?=/|$)", predicate)
+        predicate_path = split_predicate_path(predicate)
         entity_id = cls.normalise_id(entity_id)
         if len(predicate_path) > 1:
             where_query = """
@@ -514,35 +788,42 @@ class Entity(object):
         yield cls.append_attr(repository, entity_id, predicate, value, datatype, filters, prequery=prequery, update_last_modified=update_last_modified)
 
     @classmethod
-    def _copy_graph(cls, g, entity_id):
+    def _ids_to_copy(cls, g, entity_id):
+        """
+        The ids of the nodes of an entity that are renamed when it is copied
+
+        :param g: rdflib.Graph containing the entity
+        :param entity_id: id of the entity
+        :returns: list of rdflib.URIRef
+        """
         if cls.STRUCT_SELECT:
             query = generic.SPARQL_PREFIXES + cls.STRUCT_SELECT.format(id=cls.safe_id(entity_id))
-            ids_to_update = [x[0] for x in g.query(query)]
-        else:
-            if not isinstance(entity_id, rdflib.URIRef):
-                entity_id = helper.solve_ns(cls.normalise_id(entity_id))
-            ids_to_update = [entity_id]
+            return [x[0] for x in g.query(query)]
 
-        new_id = [rdflib.URIRef(generic.PREFIXES['id'] + str(uuid.uuid4()).replace('-', '')) for x in ids_to_update]
-        ng = rdflib.Graph()
-        iquery = ng.query
+        if not isinstance(entity_id, rdflib.URIRef):
+            entity_id = helper.solve_ns(cls.normalise_id(entity_id))
+        return [entity_id]
 
-        def nquery(query,*args, **kwargs):
-            lines = query.split("\n")
-            query = "\n".join([l for l in lines if "hint:Query hint:optimizer \"Runtime\"" not in l])
-            return iquery(query, *args, **kwargs)
-        ng.query = nquery
+    @classmethod
+    def _copy_graph(cls, g, entity_id):
+        return _renamed_copy(g, cls._ids_to_copy(g, entity_id))
 
-        for t in g:
-            s, p, o = t
-            if s in ids_to_update:
-                s = new_id[ids_to_update.index(s)]
-            if o in ids_to_update:
-                o = new_id[ids_to_update.index(o)]
+    @classmethod
+    @coroutine
+    def copy_graph(cls, g, entity_id):
+        """
+        Copy an entity with new ids, on the RDF workers
 
-            ng.add((s, p, o))
+        The ids are queried on the IOLoop thread, as the SPARQL parser of
+        rdflib is not thread safe.
 
-        return ng
+        :param g: rdflib.Graph containing the entity
+        :param entity_id: id of the entity
+        :returns: rdflib.Graph
+        """
+        ids_to_update = cls._ids_to_copy(g, entity_id)
+        ng = yield workers.run(workers.graph_size(g), _renamed_copy, g, ids_to_update)
+        raise Return(ng)
 
     @classmethod
     @coroutine
@@ -551,4 +832,41 @@ class Entity(object):
         Retrieve a copy of the entity, which has all internal IDs changed
         """
         g = yield cls.retrieve(repository, entity_id, format="graph")
-        raise Return(cls._copy_graph(g, entity_id))
+        ng = yield cls.copy_graph(g, entity_id)
+        raise Return(ng)
+
+
+@coroutine
+def filter_existing(repository, entities):
+    """
+    Find which of a list of entities exist, with a single query whatever
+    their number and their classes
+
+    :param repository: the linked-data database
+    :param entities: iterable of (Entity subclass, entity id) pairs
+    :returns: set of the (Entity subclass, entity id) pairs that exist
+    """
+    keys = {}
+    for entity in set(entities):
+        cls, entity_id = entity
+        normalised = cls.normalise_id(entity_id)
+        key = (normalised, cls.CLASS)
+        keys.setdefault(key, []).append(entity)
+
+    if not keys:
+        raise Return(set())
+
+    query = generic.SPARQL_PREFIXES
+    query += generic.GENERIC_FILTER_EXISTING.format(
+        pairs=" ".join("({} {})".format(*key) for key in sorted(keys)))
+    rsp = yield repository.query(query, response_type='json')
+
+    found = {(row['entity']['value'], row['class']['value'])
+             for row in json.loads(rsp.body)['results']['bindings']}
+
+    result = set()
+    for (normalised, class_), key_entities in keys.items():
+        if (unicode(Entity._id_uri(normalised)), unicode(helper.solve_ns(class_))) in found:
+            result.update(key_entities)
+
+    raise Return(result)
@@ -14,9 +14,20 @@ import json
 import re
 
 from koi.test_helpers import make_future
+from tornado.gen import coroutine, Return
 
+from . import workers
 from ..queries.generic import PREFIXES, JSON_LD_CONTEXT
 
+# rdflib parser used for each of the content types accepted when storing data
+RDF_FORMATS = {
+    'application/xml': 'xml',
+    'application/ld+json': 'json-ld',
+    'text/rdf+n3': 'n3',
+    'text/turtle': 'turtle',
+    'application/x-turtle': 'turtle'
+}
+
 
 def future_wrap(x):
     """
@@ -46,11 +57,39 @@ def rdf_to_json_ld(rdf, json_ld_context=JSON_LD_CONTEXT, input_format='xml'):
     result = None
     if rdf:
         graph = rdflib.Graph().parse(data=rdf, format=input_format)
+        result = graph_to_json_ld(graph, json_ld_context)
+
+    return result
+
+
+def parse_graph(data, format):
+    """
+    Parse trusted data, e.g. returned by the database
+
+    :param data: the data
+    :param format: rdflib format of the data
+    :returns: rdflib.Graph
+    """
+    graph = rdflib.Graph()
+    if data:
+        graph.parse(data=data, format=format)
+
+    return graph
+
 
-        if graph:
-            string = graph.serialize(format='json-ld',
-                                     context=json_ld_context)
-            result = json.loads(string)
+def graph_to_json_ld(graph, json_ld_context=JSON_LD_CONTEXT):
+    """
+    Serialise a graph as JSON-LD
+
+    :param graph: rdflib graph
+    :param json_ld_context: JSON-LD context used to compact the result
+    :returns: JSON-LD data, None if the graph is empty
+    """
+    result = None
+    if graph:
+        string = graph.serialize(format='json-ld',
+                                 context=json_ld_context)
+        result = json.loads(string)
 
     return result
 
@@ -98,3 +137,444 @@ def validate(data, format=None):
     except Exception, e:
         logging.error(data)
         raise ValidationException("error while parsing data+"+str(e))
+
+
+@coroutine
+def parse(data, format=None):
+    """
+    Validate data on the RDF workers, see validate
+
+    :param data: xml, ttl, or json-ld data
+    :param format: rdflib format of the data
+    :return: rdflib.Graph
+    :raises ValidationException if there is anything wrong
+    """
+    graph = yield workers.run(len(data), validate, data, format=format)
+    raise Return(graph)
+
+
+class FilteredGraph(rdflib.Graph):
+    """
+    A graph keeping only some of the triples added to it, so that a large
+    payload can be validated without holding all its triples in memory
+    """
+    def __init__(self, predicates, types=()):
+        """
+        :param predicates: predicates of the triples kept
+        :param types: classes of the rdf:type triples kept
+        """
+        super(FilteredGraph, self).__init__()
+        self.predicates = frozenset(predicates)
+        self.types = frozenset(types)
+        self.parsed = 0
+
+    def add(self, triple):
+        self.parsed += 1
+        if triple[1] in self.predicates or (triple[1] == rdflib.RDF.type and triple[2] in self.types):
+            super(FilteredGraph, self).add(triple)
+
+
+class _FileSource(object):
+    """A file read by rdflib, which is not closed once it has been parsed"""
+    def __init__(self, fileobj):
+        self._file = fileobj
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def readline(self, *args):
+        return self._file.readline(*args)
+
+    def close(self):
+        pass
+
+
+def parse_file(fileobj, graph, format):
+    """
+    Parse a file into a graph, reading it from the start
+
+    :param fileobj: the file, left open
+    :param graph: rdflib.Graph, e.g. a FilteredGraph
+    :param format: 'xml' or 'turtle'
+    :return: the graph
+    :raises ValidationException if there is anything wrong
+    """
+    fileobj.seek(0)
+    try:
+        graph.parse(source=_FileSource(fileobj), format=format)
+    except Exception, e:
+        raise ValidationException("error while parsing data+"+str(e))
+
+    return graph
+
+
+class ParsedPayload(object):
+    """
+    An RDF payload that is parsed at most once.
+
+    The graph, the data to be stored and the results of queries made against
+    the graph are kept, so that every stage handling an upload (validation,
+    id extraction, event handlers...) shares the same in-memory data instead
+    of parsing the payload again.
+    """
+    def __init__(self, data, content_type='application/xml', graph=None):
+        """
+        :param data: xml, ttl, or json-ld data
+        :param content_type: mimetype of the data
+        :param graph: (optional) rdflib.Graph already parsed from the data
+        """
+        self.content_type = content_type
+        self.format = RDF_FORMATS.get(content_type.lower().split(';')[0].strip())
+        self._data = data
+        self._graph = graph
+        self._memo = {}
+
+    @classmethod
+    def from_data(cls, data, content_type='application/xml'):
+        """
+        Wrap data in a ParsedPayload unless it already is one
+
+        :param data: raw data or a ParsedPayload
+        :param content_type: mimetype of the data
+        :returns: ParsedPayload
+        """
+        if isinstance(data, cls):
+            return data
+        return cls(data, content_type)
+
+    @property
+    def graph(self):
+        """
+        rdflib.Graph containing the payload, parsed on first access
+
+        :raises ValidationException if the payload cannot be parsed
+        """
+        if self._graph is None:
+            self._graph = validate(self._data, format=self.format)
+        return self._graph
+
+    def validate(self):
+        """
+        Check the payload can be parsed
+
+        :returns: rdflib.Graph
+        :raises ValidationException if there is anything wrong
+        """
+        return self.graph
+
+    @coroutine
+    def load(self):
+        """
+        Parse the payload, and convert JSON-LD to RDF/XML, on the RDF workers
+
+        :returns: rdflib.Graph
+        :raises ValidationException if the payload cannot be parsed
+        """
+        if self._graph is None:
+            self._graph = yield parse(self._data, format=self.format)
+
+        if self.format == 'json-ld' and 'serialized' not in self._memo:
+            self._memo['serialized'] = yield workers.run(len(self._data), self._graph.serialize)
+
+        raise Return(self._graph)
+
+    def serialize(self):
+        """
+        The data to send to the database. JSON-LD is converted to RDF/XML.
+
+        :returns: tuple (data, content_type)
+        """
+        if self.format == 'json-ld':
+            data = self.memoise('serialized', self.graph.serialize)
+            return data, 'application/xml'
+
+        return self._data, self.content_type
+
+    def memoise(self, key, func):
+        """
+        Compute a value derived from the payload once
+
+        :param key: a hashable key identifying the value
+        :param func: callable returning the value
+        """
+        if key not in self._memo:
+            self._memo[key] = func()
+        return self._memo[key]
+
+    def query(self, query):
+        """
+        Run a SPARQL query against the graph, caching the results
+
+        :param query: SPARQL query
+        :returns: list of result rows
+        """
+        return self.memoise(('query', query), lambda: list(self.graph.query(query)))
+
+
+class TSVResultStream(object):
+    """
+    Incremental parser of SPARQL results in the tab separated values format,
+    fed with the chunks of a response as they are received so that the rows
+    never need to be held in memory together.
+    """
+    def __init__(self, on_row):
+        """
+        :param on_row: function called with the list of rdflib terms of each row,
+            None for unbound values
+        """
+        self.on_row = on_row
+        self.variables = None
+        self.rows = 0
+        self._buffer = b''
+
+    def feed(self, chunk):
+        """
+        Parse the complete lines of a chunk of the results
+
+        :param chunk: bytes
+        """
+        lines = (self._buffer + chunk).split(b'\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            self._parse_line(line)
+
+    def close(self):
+        """Parse the last line of the results"""
+        buffer, self._buffer = self._buffer, b''
+        self._parse_line(buffer)
+
+    def _parse_line(self, line):
+        line = line.rstrip(b'\r')
+        if not line:
+            return
+
+        values = line.decode('utf-8').split('\t')
+        if self.variables is None:
+            self.variables = [value.lstrip('?') for value in values]
+            return
+
+        self.rows += 1
+        self.on_row([rdflib.util.from_n3(value) if value else None for value in values])
+
+
+class JSONStringsStream(object):
+    """
+    Incremental parser of a JSON array of strings, either the whole document
+    or the value of a key of the top level object, fed with the chunks of a
+    request body as they are received.
+
+    The document before the array is checked before the first string is
+    parsed. Only the keys of the top level object are matched, the strings
+    and nested values are skipped. The rest of the document is kept, with an
+    empty array in place of the array, and parsed when the parser is closed,
+    so that the document is rejected if it is not valid JSON, as with
+    json.loads.
+    """
+    STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+    # the separator between a key and its value, and the start of the value
+    VALUE = re.compile(r'\s*:\s*(\S)')
+    # what is expected next in the array
+    FIRST, ITEM, SEPARATOR = range(3)
+
+    def __init__(self, on_item, key=None):
+        """
+        :param on_item: function called with each string of the array
+        :param key: (optional) key of the array in the top level object
+        """
+        self.on_item = on_item
+        self.key = key
+        self._buffer = b''
+        self._document = []
+        self._expected = None
+        self._done = False
+        # state of the search of the key, see _find_start
+        self._position = 0
+        self._depth = 0
+        self._key_expected = False
+
+    def feed(self, chunk):
+        """
+        Parse the complete strings of a chunk of the document
+
+        :param chunk: bytes
+        :raises ValidationException: if the document is not as expected
+        """
+        if self._done:
+            self._document.append(chunk)
+            return
+
+        buffer = self._buffer + chunk
+        position = 0
+        if self._expected is None:
+            position = self._find_start(buffer)
+            if position is None:
+                self._buffer = buffer
+                return
+            self._expected = self.FIRST
+            self._document.append(buffer[:position])
+
+        while True:
+            while position < len(buffer) and buffer[position] in b' \t\r\n':
+                position += 1
+            if position == len(buffer):
+                break
+
+            char = buffer[position]
+            if char == b']' and self._expected != self.ITEM:
+                self._done = True
+                self._document.append(buffer[position:])
+                break
+            elif char == b',' and self._expected == self.SEPARATOR:
+                self._expected = self.ITEM
+                position += 1
+                continue
+            elif char != b'"' or self._expected == self.SEPARATOR:
+                raise ValidationException('Expected a list of strings')
+
+            match = self.STRING.match(buffer, position)
+            if match is None:
+                break
+            try:
+                item = json.loads(match.group())
+            except ValueError:
+                raise ValidationException('Invalid string in list')
+            self.on_item(item)
+            self._expected = self.SEPARATOR
+            position = match.end()
+
+        self._buffer = b'' if self._done else buffer[position:]
+
+    def _find_start(self, buffer):
+        """
+        Find the opening bracket of the array
+
+        :param buffer: the document received so far
+        :returns: the position after the bracket, None if it was not received yet
+        :raises ValidationException: if the document before the array is not as expected
+        """
+        if self.key is None:
+            stripped = buffer.lstrip()
+            if not stripped:
+                return None
+            if stripped[:1] != b'[':
+                raise ValidationException('Expected a list of strings')
+            return len(buffer) - len(stripped) + 1
+
+        position = self._position
+        while position < len(buffer):
+            char = buffer[position]
+            if char == b'"':
+                match = self.STRING.match(buffer, position)
+                if match is None:
+                    break
+                if self._depth == 1 and self._key_expected:
+                    try:
+                        key = json.loads(match.group())
+                    except ValueError:
+                        raise ValidationException('Invalid JSON document')
+                    if key == self.key:
+                        value = self.VALUE.match(buffer, match.end())
+                        if value is None:
+                            break
+                        if value.group(1) != b'[':
+                            raise ValidationException('Expected a list of strings')
+                        return self._check_prefix(buffer[:value.end()])
+                self._key_expected = False
+                position = match.end()
+                continue
+
+            if char in b' \t\r\n':
+                pass
+            elif self._depth == 0 and char != b'{':
+                raise ValidationException('Invalid JSON document')
+            elif char in b'{[':
+                self._depth += 1
+                self._key_expected = self._depth == 1
+            elif char in b'}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    raise ValidationException('Expected a list of strings')
+            elif self._depth == 1:
+                self._key_expected = char == b','
+            position += 1
+
+        self._position = position
+        return None
+
+    @staticmethod
+    def _check_prefix(prefix):
+        """
+        Check the document before the array is valid JSON
+
+        :param prefix: the document up to the opening bracket of the array
+        :returns: the position after the bracket
+        :raises ValidationException: if the document is not valid JSON
+        """
+        try:
+            json.loads(prefix + b']}')
+        except ValueError:
+            raise ValidationException('Invalid JSON document')
+        return len(prefix)
+
+    def close(self):
+        """
+        :raises ValidationException: if the array is incomplete, or the document is not valid JSON
+        """
+        if not self._done:
+            raise ValidationException('Incomplete list of strings')
+
+        try:
+            document = json.loads(b''.join(self._document))
+        except ValueError:
+            raise ValidationException('Invalid JSON document')
+
+        # e.g. the key is repeated after the array
+        if self.key is None:
+            valid = document == []
+        else:
+            valid = isinstance(document, dict) and document.get(self.key) == []
+        if not valid:
+            raise ValidationException('Expected a list of strings')
+
+
+class NDJSONStream(object):
+    """
+    Incremental parser of newline delimited JSON strings, fed with the chunks
+    of a request body as they are received.
+    """
+    def __init__(self, on_item):
+        """
+        :param on_item: function called with the string of each line
+        """
+        self.on_item = on_item
+        self._buffer = b''
+
+    def feed(self, chunk):
+        """
+        Parse the complete lines of a chunk of the document
+
+        :param chunk: bytes
+        :raises ValidationException: if a line is not a JSON string
+        """
+        lines = (self._buffer + chunk).split(b'\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            self._parse_line(line)
+
+    def close(self):
+        """Parse the last line of the document"""
+        buffer, self._buffer = self._buffer, b''
+        self._parse_line(buffer)
+
+    def _parse_line(self, line):
+        if not line.strip():
+            return
+
+        try:
+            item = json.loads(line)
+        except ValueError:
+            raise ValidationException('Invalid JSON line')
+
+        if not isinstance(item, basestring):
+            raise ValidationException('Expected one string per line')
+        self.on_item(item)
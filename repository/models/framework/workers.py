@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+
+"""Threads running CPU bound RDF work (parsing, serialising) outside of the IOLoop"""
+import sys
+from multiprocessing.pool import ThreadPool
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.options import options, define
+
+define('rdf_workers', help='number of threads parsing and serialising RDF, 0 to use the IOLoop thread',
+       default=4, type=int)
+define('rdf_worker_min_size', help='minimum size in bytes of the RDF data handled by the worker threads, '
+       'smaller data is handled on the IOLoop thread', default=65536, type=int)
+
+# approximate size in bytes of a triple, used to compare graphs to rdf_worker_min_size
+TRIPLE_SIZE = 100
+
+# the workers of this process
+_pool = None
+
+
+class WorkerPool(object):
+    """
+    A pool of threads running functions whose results are resolved on the
+    IOLoop.
+
+    Functions handling little data are run directly, as handing them over to
+    a thread would cost more than running them.
+
+    rdflib is pure Python and holds the GIL while it parses or serialises,
+    so the threads do not add CPU capacity and do not keep the latency of
+    the IOLoop steady: they only let it interleave with long RDF work instead
+    of being blocked until the work completes. Throughput is scaled with
+    more processes (the processes option). A process pool is not used as the
+    graphs, and the uploaded files, would have to be pickled between the
+    processes, which costs about as much as parsing them.
+    """
+
+    def __init__(self, size, min_size=0):
+        """
+        :param size: number of threads, 0 to run every function directly
+        :param min_size: minimum size of the data handled by the threads
+        """
+        self.size = size
+        self.min_size = min_size
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.inline = 0
+        self.pending = 0
+        self.max_pending = 0
+        self._threads = ThreadPool(size) if size > 0 else None
+
+    def run(self, size, func, *args, **kwargs):
+        """
+        Run a function on a thread of the pool
+
+        :param size: size in bytes of the data handled by the function
+        :param func: the function
+        :param args: positional arguments of the function
+        :param kwargs: keyword arguments of the function
+        :returns: Future resolved with the result of the function
+        """
+        future = Future()
+        if self._threads is None or size < self.min_size:
+            self.inline += 1
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+            return future
+
+        io_loop = IOLoop.current()
+
+        def done(succeeded, result):
+            self.pending -= 1
+            if succeeded:
+                self.completed += 1
+                future.set_result(result)
+            else:
+                self.failed += 1
+                future.set_exc_info(result)
+
+        def call():
+            try:
+                result = True, func(*args, **kwargs)
+            except Exception:
+                result = False, sys.exc_info()
+            io_loop.add_callback(done, *result)
+
+        self.submitted += 1
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        self._threads.apply_async(call)
+
+        return future
+
+    def close(self):
+        """Stop the threads of the pool"""
+        if self._threads is not None:
+            self._threads.terminate()
+            self._threads = None
+
+    def stats(self):
+        """
+        Counters of the pool
+
+        :returns: dictionary
+        """
+        return {
+            'size': self.size,
+            'min_size': self.min_size,
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'inline': self.inline
+        }
+
+
+def pool():
+    """
+    The RDF workers of this process
+
+    :returns: WorkerPool
+    """
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool(int(options.rdf_workers), int(options.rdf_worker_min_size))
+
+    return _pool
+
+
+def run(size, func, *args, **kwargs):
+    """
+    Run a CPU bound function on the RDF workers
+
+    :param size: size in bytes of the data handled by the function
+    :param func: the function
+    :returns: Future resolved with the result of the function
+    """
+    return pool().run(size, func, *args, **kwargs)
+
+
+def graph_size(graph):
+    """
+    Approximate size in bytes of a graph
+
+    :param graph: rdflib.Graph
+    :returns: int
+    """
+    return len(graph) * TRIPLE_SIZE
+
+
+def pool_stats():
+    """
+    Statistics about the RDF workers of this process
+
+    :returns: dictionary
+    """
+    return pool().stats()
@@ -10,12 +10,12 @@
 
 import logging
 import rdflib
-import re
 import json
 
 from tornado import gen
 
-from .framework.entity import build_uuid_reference
+from .framework import workers
+from .framework.entity import normalise_entity_id
 from .queries.policy import (
     OFFER_CLASS,
     OFFER_EXPIRE_PREDICATE,
@@ -23,7 +23,7 @@ from .queries.policy import (
     OFFER_LIST_EXTRA_IDS,
     OFFER_LIST_EXTRA_QUERY
 )
-from .queries.generic import (PREFIXES, SPARQL_PREFIXES)
+from .queries.generic import SPARQL_PREFIXES
 from .framework.helper import solve_ns, future_wrap, ValidationException
 from .policy import Policy
 from .party import Party
@@ -42,12 +42,7 @@ class Offer(Policy):
         :param entity_id: The entity_id of the offer either in the form of an IRI, either as an id
         :returns: an id normalised usable in SPARQL queries
         """
-        if entity_id.startswith(PREFIXES['id']):
-            entity_id = entity_id[len(PREFIXES['id']):]
-        entity_id = entity_id.lower()
-        if not re.match("id:([0-9a-f]{1,64})", entity_id):
-            return build_uuid_reference(entity_id)
-        return entity_id
+        return normalise_entity_id(entity_id)
 
     @classmethod
     @gen.coroutine
@@ -111,7 +106,7 @@ class Offer(Policy):
                 offer = json.dumps(offerj['@graph'])
                 kwargs['context'] = offerj.get('@context', {})
         try:
-            g.parse(data=offer, format=format, **kwargs)
+            yield workers.run(len(offer), g.parse, data=offer, format=format, **kwargs)
         except ValueError, e:
             raise ValidationException("Unable to parse offer data:" + str(e, ))
 
@@ -121,7 +116,7 @@ class Offer(Policy):
             raise ValidationException("Invalid number of offers submitted")
         initial_offer_id = results[0][0]
         logging.info("Found offer %s" % (initial_offer_id,))
-        ng = cls._copy_graph(g, initial_offer_id)
+        ng = yield cls.copy_graph(g, initial_offer_id)
 
         # find policy
         results = list(ng.query(query))
@@ -134,7 +129,7 @@ class Offer(Policy):
             party = yield Party.new_party(future_wrap(ng), assigner)
             yield cls.set_attr(future_wrap(ng), offer_id, POLICY_ASSIGNER,  solve_ns(Party.normalise_id(party)))
 
-        rdfxml = ng.serialize()
+        rdfxml = yield workers.run(workers.graph_size(ng), ng.serialize)
         yield cls.store(repository, rdfxml)
         logging.info("Created offer {}".format(offer_id))
         raise gen.Return(str(offer_id).split('/')[-1])
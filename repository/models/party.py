@@ -9,11 +9,10 @@
 
 
 import uuid
-import re
-from queries.generic import PREFIXES, TURTLE_PREFIXES
+from queries.generic import TURTLE_PREFIXES
 from tornado.gen import coroutine, Return
 
-from .framework.entity import (Entity, build_sparql_str, build_uuid_reference)
+from .framework.entity import (Entity, build_sparql_str, normalise_entity_id)
 from .queries.party import PARTY_TEMPLATE
 
 class Party(Entity):
@@ -27,12 +26,7 @@ class Party(Entity):
         :param entity_id: The entity_id of the offer either in the form of an IRI, either as an id
         :returns: an id normalised usable in SPARQL queries
         """
-        if entity_id.startswith(PREFIXES['id']):
-            entity_id = entity_id[len(PREFIXES['id']):]
-        entity_id=entity_id.lower()
-        if not re.match("id:([0-9a-f]{1,64})", entity_id):
-            return build_uuid_reference(entity_id)
-        return entity_id
+        return normalise_entity_id(entity_id)
 
 
     @classmethod
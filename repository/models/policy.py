@@ -11,34 +11,69 @@
 import csv
 import json
 import logging
-import re
+import sys
 import urllib
+from collections import OrderedDict
 
 from tornado.gen import Return, coroutine
+from tornado.locks import Semaphore
+from tornado.options import options, define
 
 
+from .framework.cache import TTLCache
 from .framework.helper import solve_ns, ValidationException
-from .framework.entity import Entity, build_uuid_reference
+from .framework.entity import Entity, normalise_entity_id
 
 from .queries.policy import (
     POLICY_STRUCT_SELECT,
+    POLICY_STRUCT_PATTERN,
     OFFER_CLASS,
     POLICY_METADATA_ATTRIBUTE_MAP,
     ASSET_SELECTOR_CLASS,
     GET_POLICY_TARGETS
 )
 
-from .queries.generic import PREFIXES, SPARQL_PREFIXES
+from .queries.generic import SPARQL_PREFIXES
 from .queries.asset import ASSET_GET_POLICIES_FOR_ASSETS, ASSET_CLASS
 
 from .set import Set
 from . import asset
 
+define('policy_cache_size', help='maximum size in bytes of the cached policies',
+       default=64 * 1024 * 1024, type=int)
+define('policy_cache_ttl', help='maximum time in seconds a policy is cached',
+       default=300.0, type=float)
+define('bulk_search_chunk_size', help='maximum number of asset ids searched by a query of a bulk offer search',
+       default=500, type=int)
+define('bulk_search_concurrency', help='maximum number of concurrent queries of a bulk offer search',
+       default=4, type=int)
+
+# JSON-LD of policies and their modified timestamp,
+# keyed by (repository_id, generation of the repository, class, normalised id)
+_policy_cache = None
+
+# incremented when policies are stored in a repository, to invalidate its cached policies
+_generations = {}
+
+
+def policy_cache():
+    """
+    The cache of policies of this process
+
+    :returns: TTLCache
+    """
+    global _policy_cache
+    if _policy_cache is None:
+        _policy_cache = TTLCache(max_size=sys.maxint, max_cost=int(options.policy_cache_size))
+
+    return _policy_cache
+
 
 class Policy(Entity):
     CLASS = OFFER_CLASS
     GET_POLICIES_FOR_ASSETS = ASSET_GET_POLICIES_FOR_ASSETS
     STRUCT_SELECT = POLICY_STRUCT_SELECT
+    STRUCT_PATTERN = POLICY_STRUCT_PATTERN
 
     @classmethod
     def normalise_id(cls, entity_id):
@@ -48,51 +83,227 @@ class Policy(Entity):
         :param entity_id: The entity_id of the offer either in the form of an IRI, either as an id
         :returns: an id normalised usable in SPARQL queries
         """
-        if entity_id.startswith(PREFIXES['id']):
-            entity_id = entity_id[len(PREFIXES['id']):]
-        entity_id = entity_id.lower()
-        if not re.match("id:([0-9a-f]{1,64})", entity_id):
-            return build_uuid_reference(entity_id)
-        return entity_id
+        return normalise_entity_id(entity_id)
+
+    @classmethod
+    def _cache_key(cls, repository, entity_id):
+        """
+        Key of a policy in the policy cache
+
+        :param repository: a DatabaseConnection
+        :param entity_id: the policy's ID
+        :returns: tuple, None if the repository cannot be cached
+        """
+        repository_id = getattr(repository, 'repository_id', None)
+        if repository_id is None:
+            return None
+        return (repository_id, _generations.get(repository_id, 0), cls.CLASS, cls.normalise_id(entity_id))
+
+    @classmethod
+    @coroutine
+    def retrieve(cls, repository, entity_id, format="jsonld"):
+        """
+        Retrieve a policy. JSON-LD results are cached, see retrieve_many.
+
+        :param entity_id: id of the policy
+        :param repository: the linked-data database
+        :param format: "jsonld", "graph" or "turtle"
+        :return: the policy
+        """
+        if format != "jsonld":
+            result = yield super(Policy, cls).retrieve(repository, entity_id, format=format)
+        else:
+            result = yield cls.retrieve_many(repository, [entity_id])
+            result = result[entity_id]
+
+        raise Return(result)
+
+    @classmethod
+    @coroutine
+    def retrieve_many(cls, repository, entity_ids, format="jsonld"):
+        """
+        Retrieve several policies.
+
+        JSON-LD results are cached with the policy's dcterm:modified timestamp.
+        A cached policy is used only while the timestamp in the database is
+        unchanged, and at most policy_cache_ttl seconds.
+
+        :param repository: the linked-data database
+        :param entity_ids: ids of the policies
+        :param format: "jsonld" or "graph"
+        :return: a dictionary mapping each id to the policy (None if the policy was not found)
+        """
+        entity_ids = set(entity_ids)
+        if format != "jsonld" or not entity_ids or getattr(repository, 'repository_id', None) is None:
+            result = yield super(Policy, cls).retrieve_many(repository, entity_ids, format=format)
+            raise Return(result)
+
+        modified = yield cls.get_modified(repository, entity_ids)
+
+        cache = policy_cache()
+        result = {}
+        missing = []
+        for eid in entity_ids:
+            cached = cache.get(cls._cache_key(repository, eid))
+            if cached is not None and cached[0] == modified.get(eid):
+                result[eid] = json.loads(cached[1])
+            else:
+                missing.append(eid)
+
+        if missing:
+            retrieved = yield super(Policy, cls).retrieve_many(repository, missing)
+            for eid, data in retrieved.items():
+                result[eid] = data
+                if data is not None and eid in modified:
+                    serialised = json.dumps(data)
+                    cache.set(cls._cache_key(repository, eid), (modified[eid], serialised),
+                              ttl=float(options.policy_cache_ttl), cost=len(serialised))
+
+        raise Return(result)
+
+    @classmethod
+    def invalidate(cls, repository, entity_id=None):
+        """
+        Remove cached policies
+
+        :param repository: a DatabaseConnection
+        :param entity_id: the policy's ID, if None all the policies of the repository are removed
+        """
+        repository_id = getattr(repository, 'repository_id', None)
+        if repository_id is None:
+            return
+
+        if entity_id is None:
+            _generations[repository_id] = _generations.get(repository_id, 0) + 1
+        else:
+            policy_cache().pop(cls._cache_key(repository, entity_id))
+
+    @classmethod
+    @coroutine
+    def on_store(cls, repository, **kwargs):
+        """
+        Invalidate the cached policies of the repository after policies are stored
+        """
+        cls.invalidate(repository)
+
+    @classmethod
+    @coroutine
+    def append_attr(cls, repository, entity_id, *args, **kwargs):
+        """
+        Add an attribute to a policy, see Entity.append_attr
+        """
+        try:
+            yield super(Policy, cls).append_attr(repository, entity_id, *args, **kwargs)
+        finally:
+            cls.invalidate(repository, entity_id)
+
+    @classmethod
+    @coroutine
+    def filter_out_attr(cls, repository, entity_id, *args, **kwargs):
+        """
+        Remove attribute values from a policy, see Entity.filter_out_attr
+        """
+        try:
+            yield super(Policy, cls).filter_out_attr(repository, entity_id, *args, **kwargs)
+        finally:
+            cls.invalidate(repository, entity_id)
 
     @staticmethod
-    def _parse_row(cdb, row):
+    def _parse_cells(bundle, ids, policies, interned=None):
         """
-        parse a row from the query result.
-        :param row: a dictionary representing a row
+        parse the cells of a row from the query result.
+        :param bundle: utf-8 encoded entity_id_bundle cell, source_id_type#source_id
+        :param ids: utf-8 encoded |-separated entity ids
+        :param policies: utf-8 encoded |-separated policy ids
+        :param interned: (optional) dictionary of the policy ids already parsed,
+            so that the rows share a single copy of each policy id
         :return: a dictionary with a unified format for all id types with the
         following keys id, source_id, source_id_type, offer_ids.
         """
-        row = {k: v.decode('utf-8') for k, v in row.iteritems()}
         # return only one HK if multiple HK
-        entity_id = str(row['ids']).split('|')[0]
-        source_id_type, source_id = row['entity_id_bundle'].split('#')
-        source_id_type = source_id_type.split('/')[-1]
-
-        entity_id = str(entity_id).split('/')[-1]
-        result = {
+        entity_id = ids.split('|', 1)[0].rpartition('/')[2]
+        source_id_type, _, source_id = bundle.decode('utf-8').partition('#')
+        source_id_type = source_id_type.rpartition('/')[2]
+        if '%' in source_id or '+' in source_id:
+            source_id = urllib.unquote_plus(source_id)
+        if '%' in source_id_type or '+' in source_id_type:
+            source_id_type = urllib.unquote_plus(source_id_type)
+
+        policies_ids = policies.decode('utf-8').split('|')
+        if interned is not None:
+            policies_ids = [interned.setdefault(x, x) for x in policies_ids]
+
+        return {
             'entity_id': entity_id,
-            'source_id': urllib.unquote_plus(source_id),
-            'source_id_type': urllib.unquote_plus(source_id_type),
-            'policies_ids': row['policies'].split('|')
+            'source_id': source_id,
+            'source_id_type': source_id_type,
+            'policies_ids': policies_ids
         }
 
-        return result
+    @classmethod
+    def _parse_row(cls, cdb, row):
+        """
+        parse a row from the query result.
+        :param row: a dictionary representing a row
+        :return: a dictionary with a unified format for all id types with the
+        following keys id, source_id, source_id_type, offer_ids.
+        """
+        return cls._parse_cells(row['entity_id_bundle'], row['ids'], row['policies'])
 
     @classmethod
-    @coroutine
-    def _process(cls, cdb, csv_buffer):
+    def _parse_rows(cls, cdb, csv_buffer):
         """
-        Attach license objects to asset data
+        Parse the rows of the reply of a GET_POLICIES_FOR_ASSETS query. The
+        columns are located once from the header, and only the cells that are
+        used are decoded.
         :param cdb: db containing the licenses
         :param csv_buffer: CSV reply containing policies for the assets queried
-        :param assets: return asset associated with policies
+        :return: list of dictionaries, see _parse_cells
+        """
+        reader = csv.reader(csv_buffer)
+        header = next(reader, None)
+        if not header:
+            return []
+
+        bundle, ids, policies = (header.index(x) for x in ('entity_id_bundle', 'ids', 'policies'))
+        interned = {}
+        parse = cls._parse_cells
+
+        return [parse(row[bundle], row[ids], row[policies], interned) for row in reader if row]
+
+    @staticmethod
+    def _merge_rows(chunks):
+        """
+        Merge the rows of the replies of several queries, the rows of the same
+        asset id are merged into the first one.
+        :param chunks: lists of rows, see _parse_rows
+        :return: list of rows
+        """
+        merged = OrderedDict()
+        for rows in chunks:
+            for row in rows:
+                key = (row['source_id_type'], row['source_id'])
+                if key not in merged:
+                    merged[key] = row
+                else:
+                    policies_ids = merged[key]['policies_ids']
+                    policies_ids.extend(x for x in row['policies_ids'] if x not in policies_ids)
+
+        return merged.values()
+
+    @classmethod
+    @coroutine
+    def _attach_policies(cls, cdb, assets):
+        """
+        Replace the policy ids of the assets with the policies
+        :param cdb: db containing the licenses
+        :param assets: list of rows, see _parse_rows
+        :return: assets
         """
-        assets = [cls._parse_row(cdb, row) for row in csv.DictReader(csv_buffer)]
         policy_ids = {offer_id for item in assets for offer_id in item['policies_ids']}
 
         # retrieve from db
-        policies = yield {oid: cls.retrieve(cdb, oid) for oid in policy_ids}
+        policies = yield cls.retrieve_many(cdb, policy_ids)
 
         # replacing offer ids with actual offer
         for casset in assets:
@@ -101,11 +312,63 @@ class Policy(Entity):
 
         raise Return(assets)
 
+    @classmethod
+    @coroutine
+    def _process(cls, cdb, csv_buffer):
+        """
+        Attach license objects to asset data
+        :param cdb: db containing the licenses
+        :param csv_buffer: CSV reply containing policies for the assets queried
+        :param assets: return asset associated with policies
+        """
+        assets = yield cls._attach_policies(cdb, cls._parse_rows(cdb, csv_buffer))
+        raise Return(assets)
+
+    @classmethod
+    @coroutine
+    def _query_assets(cls, repository, asset_ids, semaphore):
+        """
+        Query the policies of a chunk of asset ids
+        :param repository: repository name (namespace in db)
+        :param asset_ids: a list of id_types,ids for the assets
+        :param semaphore: bounds the number of concurrent queries
+        :return: list of rows, see _parse_rows
+        """
+        subquery = asset.Asset.asset_subselect_idlist(asset_ids)
+
+        query = SPARQL_PREFIXES
+        query += cls.GET_POLICIES_FOR_ASSETS.format(idname="entity", subquery=subquery, policy_type=cls.CLASS)
+        yield semaphore.acquire()
+        try:
+            rsp = yield repository.query(payload=query, response_type='csv')
+        finally:
+            semaphore.release()
+
+        raise Return(cls._parse_rows(repository, rsp.buffer))
+
+    @staticmethod
+    def _chunks(asset_ids):
+        """
+        Split the asset ids of a bulk search in chunks of bulk_search_chunk_size
+        :param asset_ids: a list of id_types,ids for the assets
+        :return: tuple (list of chunks, semaphore bounding the concurrent queries)
+        """
+        chunk_size = max(1, int(options.bulk_search_chunk_size))
+        semaphore = Semaphore(max(1, int(options.bulk_search_concurrency)))
+        chunks = [asset_ids[i:i + chunk_size] for i in range(0, len(asset_ids), chunk_size)]
+
+        return chunks, semaphore
+
     @classmethod
     @coroutine
     def retrieve_for_assets(cls, asset_ids, repository):
         """
         Retrieve offers by id and type of the id
+
+        The ids are searched with one query per chunk of bulk_search_chunk_size
+        ids, at most bulk_search_concurrency queries at a time, and the
+        policies of all the chunks are retrieved together.
+
         :param asset_ids: a list of id_types,ids for the assets
         :param repository: repository name (namespace in db)
         :return: list of offers for the asset
@@ -115,16 +378,101 @@ class Policy(Entity):
             raise Return([])
 
         logging.debug("query : %r" % (asset_ids,))
-        subquery = asset.Asset.asset_subselect_idlist(asset_ids)
+        chunks, semaphore = cls._chunks(asset_ids)
+        rows = yield [cls._query_assets(repository, chunk, semaphore) for chunk in chunks]
 
-        query = SPARQL_PREFIXES
-        query += cls.GET_POLICIES_FOR_ASSETS.format(idname="entity", subquery=subquery, policy_type=cls.CLASS)
-        rsp = yield repository.query(payload=query, response_type='csv')
-
-        result = yield cls._process(repository, rsp.buffer)
+        result = yield cls._attach_policies(repository, cls._merge_rows(rows))
 
         raise Return(result)
 
+    @classmethod
+    @coroutine
+    def _stream_chunk(cls, repository, asset_ids, semaphore, callback, streamed):
+        """
+        Query the policies of a chunk of asset ids and pass the assets to callback
+        :param repository: repository name (namespace in db)
+        :param asset_ids: a list of id_types,ids for the assets
+        :param semaphore: bounds the number of concurrent queries
+        :param callback: function called with the list of assets with their
+            offers, it may return a future that is waited for
+        :param streamed: set of the (source_id_type, source_id) of the assets
+            already passed to callback, the assets of this chunk are added
+        :return: number of assets passed to callback
+        """
+        rows = yield cls._query_assets(repository, asset_ids, semaphore)
+
+        # an asset found by ids of two chunks has the same policies in both
+        unique = []
+        for row in rows:
+            key = (row['source_id_type'], row['source_id'])
+            if key not in streamed:
+                streamed.add(key)
+                unique.append(row)
+
+        assets = yield cls._attach_policies(repository, unique)
+        if assets:
+            result = callback(assets)
+            if result is not None:
+                yield result
+
+        raise Return(len(assets))
+
+    @classmethod
+    @coroutine
+    def stream_for_assets(cls, asset_ids, repository, callback):
+        """
+        Retrieve offers by id and type of the id, passing the assets of each
+        chunk of bulk_search_chunk_size ids to callback as soon as their
+        policies are retrieved, so that the assets do not have to be held
+        in memory until the slowest chunk completes.
+
+        The assets are passed in the order the chunks complete, an asset found
+        by ids of two different chunks is passed once. If a chunk fails, the
+        other chunks are waited for, without passing their assets to callback,
+        before the error is raised.
+
+        :param asset_ids: a list of id_types,ids for the assets
+        :param repository: repository name (namespace in db)
+        :param callback: function called with a list of assets with their
+            offers, it may return a future (e.g. of a flush) that is waited for
+        :return: number of assets
+        """
+        if not asset_ids:
+            logging.warning('bulk query with no data')
+            raise Return(0)
+
+        logging.debug("query : %r" % (asset_ids,))
+        chunks, semaphore = cls._chunks(asset_ids)
+        streamed = set()
+        failed = []
+
+        def on_assets(assets):
+            if not failed:
+                return callback(assets)
+
+        def on_done(future):
+            if future.exc_info() is not None:
+                failed.append(future)
+
+        futures = [cls._stream_chunk(repository, chunk, semaphore, on_assets, streamed) for chunk in chunks]
+        for future in futures:
+            future.add_done_callback(on_done)
+
+        count = 0
+        for future in futures:
+            try:
+                count += yield future
+            except Exception:
+                # raised once all the chunks completed
+                pass
+
+        if failed:
+            for future in failed[1:]:
+                logging.error('Error while streaming offers from database', exc_info=future.exc_info())
+            failed[0].result()
+
+        raise Return(count)
+
     @classmethod
     @coroutine
     def update_metadata(cls, repository, agreement_id, metadata, update_last_modified):
@@ -241,10 +589,8 @@ class Policy(Entity):
             raise ValidationException('This policy requires you to enumerate '
                                       'the elements you want to accept')
 
-        for cid in assets:
-            present = yield Set.has_element(repository, set_id, cid)
-            if present:
-                ids.add(cid.split('/')[-1])
+        members = yield Set.filter_members(repository, set_id, assets)
+        ids.update(cid.split('/')[-1] for cid in members)
 
         # NOTE: we currently assume that offer do not provide access to union
         # of overlapping offer sets if this was the the case the previous
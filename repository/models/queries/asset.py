@@ -91,6 +91,20 @@ SELECT DISTINCT ?entity_id WHERE
 }
 """
 
+# Gets all alsoIdentifiedBy ids for every entity in graph
+# NOTE: Not used in blazegraph. Used when onboarding assets to identify the assets coming from the user.
+# :returns entity_id: Id of entity
+# :returns source_id_type: Type of Source Id for entity
+# :returns source_id: Value of Source Id for entity
+ASSET_QUERY_ALL_SOURCE_IDS = """
+SELECT ?entity_id ?source_id_type ?source_id WHERE
+{
+  ?entity_id op:alsoIdentifiedBy ?id .
+  ?id op:id_type ?source_id_type .
+  ?id op:value ?source_id .
+}
+"""
+
 # Gets identifiers for an asset by entity id, for use in ASSET_GET_POLICIES_FOR_ASSETS
 # :param idname: name of the variable for the id
 # :param idlist: List of entity ids
@@ -130,50 +144,76 @@ SELECT ?{idname}_entity  ?{idname}_id_value ?{idname}_id_type {{
 # used by GENERIC_GET.
 ASSET_STRUCT_SELECT = """ SELECT DISTINCT ?s {{ {id} (op:alsoIdentifiedBy)? ?s . }} """
 
-FIND_ENTITY_TEMPLATE = string.Template("""
-SELECT DISTINCT ?s
-WHERE {?s ?p ?o.
-	?o  	<http://openpermissions.org/ns/op/1.1/value>  ?id;
-<http://openpermissions.org/ns/op/1.1/id_type>  ?idtype
-		.
-		VALUES (?id ?idtype) {
-		$id_filter
-		}
-	}
-""")
-
-SOURCE_ID_FILTER_TEMPLATE = string.Template("""
-("$id" <http://openpermissions.org/ns/hub/$id_type>)
-""")
-
-FIND_ENTITY_SOURCE_IDS_TEMPLATE = string.Template("""
-SELECT DISTINCT ?id ?idtype
-WHERE {<$entity_id> ?p ?o.
-?o  	<http://openpermissions.org/ns/op/1.1/value>  ?id;
-<http://openpermissions.org/ns/op/1.1/id_type> ?idtype.}
+# The following templates are used to replace existing assets when assets are stored.
+# :param id_filter: VALUES rows of ("source_id" <source_id_type>) pairs
+# :param entity_filter: VALUES rows of (<entity>)
+# :param entity_ids: comma separated list of <entity>
+# The delete templates are sent together as a single update.
+
+# Finds every entity using one of the ids, together with all of the ids of those entities
+# :returns s: the entity
+# :returns id: source id of the entity
+# :returns idtype: source id type of the entity
+FIND_ENTITIES_AND_SOURCE_IDS_TEMPLATE = string.Template("""
+SELECT DISTINCT ?s ?id ?idtype
+WHERE {
+    {
+        SELECT DISTINCT ?s
+        WHERE {
+            ?s ?match_p ?match_o .
+            ?match_o <http://openpermissions.org/ns/op/1.1/value> ?match_id ;
+                     <http://openpermissions.org/ns/op/1.1/id_type> ?match_idtype .
+            VALUES (?match_id ?match_idtype) {
+            $id_filter
+            }
+        }
+    }
+    ?s ?p ?o .
+    ?o <http://openpermissions.org/ns/op/1.1/value> ?id ;
+       <http://openpermissions.org/ns/op/1.1/id_type> ?idtype .
+}
 """)
 
-FIND_ENTITY_COUNT_BY_SOURCE_IDS_TEMPLATE = string.Template("""
-SELECT (COUNT(?s) AS ?count)
-WHERE {?s ?p ?o.
-		?o 
-           <http://openpermissions.org/ns/op/1.1/value> "$source_id";
-			<http://openpermissions.org/ns/op/1.1/id_type> <$source_id_type>
-			.    
-      FILTER NOT EXISTS {<$entity_id> ?p ?o}
-                 }
+# Counts, for each id, the entities using it other than the given entities
+# :returns id: source id
+# :returns idtype: source id type
+# :returns count: number of other entities using the id
+COUNT_ENTITIES_BY_SOURCE_IDS_TEMPLATE = string.Template("""
+SELECT ?id ?idtype (COUNT(DISTINCT ?s) AS ?count)
+WHERE {
+    VALUES (?id ?idtype) {
+    $id_filter
+    }
+    OPTIONAL {
+        ?s ?p ?o .
+        ?o <http://openpermissions.org/ns/op/1.1/value> ?id ;
+           <http://openpermissions.org/ns/op/1.1/id_type> ?idtype .
+        FILTER (?s NOT IN ($entity_ids))
+    }
+}
+GROUP BY ?id ?idtype
 """)
 
-DELETE_ID_TRIPLES_TEMPLATE = string.Template("""
-DELETE
-WHERE {?s 
-           <http://openpermissions.org/ns/op/1.1/value> "$source_id";
-			<http://openpermissions.org/ns/op/1.1/id_type> <$source_id_type>;
-      ?p ?o.}
+# Deletes the triples of the ids
+DELETE_SOURCE_IDS_TEMPLATE = string.Template("""
+DELETE { ?s ?p ?o }
+WHERE {
+    VALUES (?id ?idtype) {
+    $id_filter
+    }
+    ?s <http://openpermissions.org/ns/op/1.1/value> ?id ;
+       <http://openpermissions.org/ns/op/1.1/id_type> ?idtype ;
+       ?p ?o .
+}
 """)
 
-DELETE_ENTITY_TRIPLE_TEMPLATE = string.Template("""
-DELETE
+# Deletes the triples of the entities
+DELETE_ENTITIES_TEMPLATE = string.Template("""
+DELETE { ?s ?p ?o }
 WHERE {
-<$entity_id> ?p ?o}
+    VALUES (?s) {
+    $entity_filter
+    }
+    ?s ?p ?o .
+}
 """)
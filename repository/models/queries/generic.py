@@ -53,17 +53,41 @@ ASK  WHERE {{
 }}
 """
 
+# Select which of a list of entities exist with the given classes
+# :param pairs: space separated (id class) pairs
+# :returns entity: the entities that exist
+# :returns class: the class of the entities
+GENERIC_FILTER_EXISTING = """
+SELECT DISTINCT ?entity ?class
+WHERE {{
+    VALUES (?entity ?class) {{ {pairs} }}
+    ?entity a ?class .
+}}
+"""
+
 # Adds a new timestamp for entity
-# :param entity_id: Id of entity
+# :param entity_id: id: reference or <IRI> of entity
 GENERIC_INSERT_TIMESTAMPS = """
 INSERT {{
-  id:{entity_id} dcterm:modified ?now .
+  {entity_id} dcterm:modified ?now .
 }}
 WHERE {{
     BIND ( NOW() as ?now ) .
 }}
 """
 
+# Gets the modification times of entities
+# :param ids: ids of the entities, separated by spaces
+# :returns entity: Id of entity
+# :returns modified: Timestamp entity was modified
+GENERIC_GET_MODIFIED = """
+SELECT DISTINCT ?entity ?modified
+WHERE {{
+    VALUES ?entity {{ {ids} }}
+    ?entity dcterm:modified ?modified .
+}}
+"""
+
 # Gets a list of entities
 #
 # :param id_name: name of the variable for the id for use in extra queries
@@ -103,6 +127,39 @@ ORDER BY ?last_modified
 """
 
 
+# Gets a list of entities, after a cursor (keyset pagination)
+# Same as GENERIC_LIST except that the page starts after the cursor instead of at an offset,
+# so that the database does not have to skip all the previous rows.
+#
+# :param after: (optional) SPARQL filter selecting the timestamps ?when (and ?{id_name}) after the cursor
+# :returns cursor: Timestamp used to order the entity in the page
+GENERIC_LIST_AFTER = """
+SELECT ?{id_name} {extra_query_ids} ?last_modified ?cursor
+WHERE {{
+    hint:Query hint:optimizer "Runtime" .
+    {{
+        SELECT ?{id_name} (MAX(?when) AS ?last_modified) (MAX(?page_when) AS ?cursor)
+
+        WHERE {{
+            {{ SELECT ?{id_name} (?when AS ?page_when) {{
+                ?{id_name} a {class} .
+                ?{id_name} dcterm:modified ?when .
+
+                {filter}
+                {after}
+          }} ORDER BY ?when ?{id_name}
+             LIMIT {page_size}
+         }}
+         OPTIONAL {{ ?{id_name} dcterm:modified ?when }}
+        }}
+        GROUP BY ?{id_name}
+    }}
+    {extra_query}
+}}
+ORDER BY ?last_modified
+"""
+
+
 INSERT_DATA = """
 INSERT DATA {
 %s
@@ -193,3 +250,31 @@ WHERE
   ?s ?p ?o .
 }}
 """
+
+# Predicate linking the subjects returned by GENERIC_GET_MANY to the entity they belong to
+GENERIC_RETRIEVED_FOR = "urn:x-repository:retrievedFor"
+
+# Gets several entities at once
+# :param ids: ids of the entities, separated by spaces
+# :param class: class of the entities
+# :param %s: The STRUCT_PATTERN which is responsible for matching the subjects ?s of the subgraph of each entity ?entity.
+#
+# :returns: Entities triples, and a "?s <GENERIC_RETRIEVED_FOR> ?entity" triple for each subject of each entity
+GENERIC_GET_MANY = """
+CONSTRUCT {{ ?s ?p ?o . ?s <urn:x-repository:retrievedFor> ?entity }}
+WHERE
+{{
+  hint:Query hint:optimizer "Runtime" .
+
+  {{
+    SELECT DISTINCT ?entity ?s
+    {{
+      VALUES ?entity {{ {ids} }}
+      ?entity a {class} .
+      %s
+    }}
+  }}
+
+  ?s ?p ?o .
+}}
+"""
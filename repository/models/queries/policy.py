@@ -92,6 +92,10 @@ def struct_to_struct_selector(d, p="", s="?"):
 _POLICY_STRUCT_SPARQLPATH = struct_to_struct_selector(POLICY_STRUCT)
 POLICY_STRUCT_SELECT = """ SELECT DISTINCT ?s {{ {{ {id} %s ?s .  }} UNION {{ {id} (%s)/odrl:target ?s . ?s a op:AssetSelector . }}  }} """ % (_POLICY_STRUCT_SPARQLPATH, _POLICY_STRUCT_SPARQLPATH)
 
+# Used by GENERIC_GET_MANY
+# Same as POLICY_STRUCT_SELECT for each of the policies ?entity
+POLICY_STRUCT_PATTERN = """ {{ ?entity %s ?s .  }} UNION {{ ?entity (%s)/odrl:target ?s . ?s a op:AssetSelector . }} """ % (_POLICY_STRUCT_SPARQLPATH, _POLICY_STRUCT_SPARQLPATH)
+
 
 # The two following queries are  used when transforming offers in agreements
 # to record how the assignee claim to have satisfy the duty required by the permissions
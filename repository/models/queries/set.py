@@ -24,3 +24,79 @@ SET_TEMPLATE = """
 {id} a {class_} .
 {id} dcterm:title {title} .
 """
+
+# Select the elements of a set among a list of candidates
+# :param id: id of the set
+# :param predicate: predicate linking the set to its elements
+# :param elements: space separated candidate elements
+# :returns element: candidates that are elements of the set
+SET_FILTER_MEMBERS = """
+SELECT DISTINCT ?element
+WHERE {{
+    VALUES ?element {{ {elements} }}
+    {id} {predicate} ?element .
+}}
+"""
+
+# Elements replacing the elements of a set are staged on a subject of their
+# own, named with this prefix, which has no type and is not linked to the set,
+# so that the staged elements are not seen by the queries of the set
+SET_STAGING = "urn:x-repository:setStaging:"
+# Predicate linking a staging subject to its elements
+SET_STAGED_ELEMENT = "<urn:x-repository:stagedElement>"
+
+# Start staging the elements of a set, recording the set and the time the
+# staging started
+# :param staging: staging subject
+# :param id: id of the set
+# :param started: xsd:dateTime, time the staging started
+SET_START_STAGING = """
+INSERT DATA {{
+{staging} <urn:x-repository:stagedFor> {id} ;
+    <urn:x-repository:stagingStarted> "{started}"^^xsd:dateTime .
+}}
+"""
+
+# Remove a staging subject
+# :param staging: staging subject
+SET_DELETE_STAGING = """
+DELETE {{ {staging} ?p ?o }} WHERE {{ {staging} ?p ?o }}
+"""
+
+# Remove the staging subjects abandoned before a time, e.g. by a process that
+# stopped while it was replacing the elements of a set
+# :param before: xsd:dateTime
+SET_DELETE_STALE_STAGING = """
+DELETE {{ ?staging ?p ?o }}
+WHERE {{
+    ?staging <urn:x-repository:stagingStarted> ?started .
+    FILTER (?started < "{before}"^^xsd:dateTime)
+    ?staging ?p ?o .
+}}
+"""
+
+# Add elements to sets
+# :param triples: "{id} {predicate} {element} ." triples
+SET_INSERT_ELEMENTS = """
+INSERT DATA {{
+{triples}
+}}
+"""
+
+# Remove all the elements of a set
+# :param id: id of the set
+# :param predicate: predicate linking the set to its elements
+SET_DELETE_ELEMENTS = """
+DELETE {{ {id} {predicate} ?element }} WHERE {{ {id} {predicate} ?element }}
+"""
+
+# Replace the elements of a set with the staged elements, and remove the
+# staging subject, in one update
+# :param id: id of the set
+# :param predicate: predicate linking the set to its elements
+# :param staging: staging subject
+SET_SWAP_STAGED_ELEMENTS = """
+DELETE {{ {id} {predicate} ?element }} WHERE {{ {id} {predicate} ?element }} ;
+INSERT {{ {id} {predicate} ?element }} WHERE {{ {staging} <urn:x-repository:stagedElement> ?element }} ;
+DELETE {{ {staging} ?p ?o }} WHERE {{ {staging} ?p ?o }}
+"""
@@ -7,17 +7,126 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 
+import json
+import logging
 import uuid
 
 import arrow
 from tornado.gen import coroutine, Return
+from tornado.options import options, define
 
 from .asset import Asset
 from .framework.entity import build_sparql_str
-from .queries.generic import TURTLE_PREFIXES
-from .queries.set import SET_TEMPLATE, SET_LIST_EXTRA_IDS, SET_LIST_EXTRA_QUERY
+from .queries.generic import SPARQL_PREFIXES, TURTLE_PREFIXES
+from .queries.set import (SET_TEMPLATE, SET_LIST_EXTRA_IDS, SET_LIST_EXTRA_QUERY, SET_FILTER_MEMBERS,
+                          SET_STAGING, SET_STAGED_ELEMENT, SET_START_STAGING, SET_DELETE_STAGING,
+                          SET_DELETE_STALE_STAGING, SET_INSERT_ELEMENTS, SET_DELETE_ELEMENTS,
+                          SET_SWAP_STAGED_ELEMENTS)
 from .queries.policy import SET_CLASS, SET_HAS_ELEMENT
 
+define('set_membership_chunk_size', help='maximum number of elements checked by a set membership query',
+       default=1000, type=int)
+define('set_update_chunk_size', help='maximum number of elements written by a set update query',
+       default=5000, type=int)
+define('set_staging_ttl', help='time in seconds after which the elements staged by an unfinished replacement '
+       'of the elements of a set are removed', default=86400.0, type=float)
+
+
+class ElementsReplacement(object):
+    """
+    Replace the elements of a set with elements given in batches.
+
+    The elements are staged on a subject specific to the replacement, one
+    query per set_update_chunk_size elements, so that neither the queries nor
+    the memory used grow with the size of the set. The staged elements then
+    replace the elements of the set in a single update. If all the elements
+    fit in one batch they are written directly.
+
+    The staging subject is not linked to the set, so the staged elements are
+    not seen by the queries of the set. It is removed when the replacement is
+    committed or aborted, or, if neither happens (e.g. the process stopped),
+    by the first replacement started set_staging_ttl seconds later.
+    """
+
+    def __init__(self, set_cls, repository, set_id):
+        """
+        :param set_cls: the Set class
+        :param repository: the linked-data database
+        :param set_id: the id of the set
+        """
+        self.set_cls = set_cls
+        self.repository = repository
+        self.set_id = set_cls.normalise_id(set_id)
+        self.staging = '<{}{}>'.format(SET_STAGING, uuid.uuid4().hex)
+        self.chunk_size = max(1, int(options.set_update_chunk_size))
+        self.count = 0
+        self._pending = []
+        self._staged = False
+
+    @staticmethod
+    def _triples(subject, predicate, elements):
+        return '\n'.join('{} {} {} .'.format(subject, predicate, element) for element in elements)
+
+    @coroutine
+    def _stage(self, elements):
+        query = SET_INSERT_ELEMENTS.format(triples=self._triples(self.staging, SET_STAGED_ELEMENT, elements))
+        if not self._staged:
+            now = arrow.utcnow()
+            before = now.replace(seconds=-float(options.set_staging_ttl))
+            query = ';'.join([
+                SET_DELETE_STALE_STAGING.format(before=before.isoformat()),
+                SET_START_STAGING.format(staging=self.staging, id=self.set_id, started=now.isoformat()),
+                query])
+
+        self._staged = True
+        yield self.repository.update(SPARQL_PREFIXES + query)
+
+    @coroutine
+    def add(self, element_ids):
+        """
+        Add elements, staging every complete batch
+
+        :param element_ids: ids of elements
+        :raises ValidationException: if an id is invalid
+        """
+        for element_id in element_ids:
+            self._pending.append(self.set_cls.normalise_id(element_id))
+            self.count += 1
+            if len(self._pending) >= self.chunk_size:
+                pending, self._pending = self._pending, []
+                yield self._stage(pending)
+
+    @coroutine
+    def commit(self):
+        """Replace the elements of the set with the elements added"""
+        if self._staged:
+            if self._pending:
+                yield self._stage(self._pending)
+            query = SET_SWAP_STAGED_ELEMENTS.format(id=self.set_id, predicate=SET_HAS_ELEMENT, staging=self.staging)
+        else:
+            query = SET_DELETE_ELEMENTS.format(id=self.set_id, predicate=SET_HAS_ELEMENT)
+            if self._pending:
+                query += ';' + SET_INSERT_ELEMENTS.format(
+                    triples=self._triples(self.set_id, SET_HAS_ELEMENT, self._pending))
+
+        self._pending = []
+        query += ';' + self.set_cls._insert_timestamps_query(self.set_id)
+        yield self.repository.update(SPARQL_PREFIXES + query)
+        self._staged = False
+
+    @coroutine
+    def abort(self):
+        """Remove the staged elements, leaving the elements of the set unchanged"""
+        self._pending = []
+        if not self._staged:
+            return
+
+        self._staged = False
+        try:
+            yield self.repository.update(SPARQL_PREFIXES + SET_DELETE_STAGING.format(staging=self.staging))
+        except Exception:
+            logging.exception('Unable to remove the elements staged for set %s' % self.set_id)
+
 
 class Set(Asset):
     CLASS = SET_CLASS
@@ -53,18 +162,76 @@ class Set(Asset):
 
     @classmethod
     @coroutine
-    def get_elements(cls, repository, set_id, page=1, page_size=100):
-        res = yield cls.get_attr(repository, set_id, SET_HAS_ELEMENT, page=page, page_size=page_size)
+    def filter_members(cls, repository, set_id, element_ids):
+        """
+        Find which of a list of elements belong to a set, with one query per
+        chunk of set_membership_chunk_size elements instead of one per element
+
+        :param repository: the linked-data database
+        :param set_id: the id of the set
+        :param element_ids: ids of the candidate elements
+        :returns: set of the element ids that belong to the set
+        """
+        normalised = {eid: cls.normalise_id(eid) for eid in set(element_ids)}
+        if not normalised:
+            raise Return(set())
+
+        candidates = sorted(set(normalised.values()))
+        chunk_size = max(1, int(options.set_membership_chunk_size))
+        queries = [
+            repository.query(SPARQL_PREFIXES + SET_FILTER_MEMBERS.format(
+                id=cls.normalise_id(set_id),
+                predicate=SET_HAS_ELEMENT,
+                elements=' '.join(candidates[i:i + chunk_size])), response_type='json')
+            for i in range(0, len(candidates), chunk_size)
+        ]
+        responses = yield queries
+
+        members = set()
+        for rsp in responses:
+            members.update(row['element']['value'] for row in json.loads(rsp.body)['results']['bindings'])
+
+        raise Return({eid for eid, nid in normalised.items() if unicode(cls._id_uri(nid)) in members})
+
+    @classmethod
+    @coroutine
+    def get_elements(cls, repository, set_id, page=1, page_size=100, after=None):
+        """
+        Get a page of the elements of a set, in the order of their URIs
+
+        :param repository: the linked-data database
+        :param set_id: the id of the set
+        :param page: the page, ignored if after is given
+        :param page_size: the number of elements per page
+        :param after: (optional) id of the last element of the previous page
+        :returns: list of element URIs
+        """
+        if after is not None:
+            after = cls._id_uri(cls.normalise_id(after))
+        res = yield cls.get_attr(repository, set_id, SET_HAS_ELEMENT, page=page, page_size=page_size, after=after)
         raise Return(res)
 
+    @classmethod
+    def replace_elements(cls, repository, set_id):
+        """
+        Start replacing the elements of a set in batches
+
+        :param repository: the linked-data database
+        :param set_id: the id of the set
+        :returns: ElementsReplacement
+        """
+        return ElementsReplacement(cls, repository, set_id)
+
     @classmethod
     @coroutine
     def set_elements(cls, repository, set_id, elements_id):
-        res = yield cls.set_attr(repository, set_id, SET_HAS_ELEMENT,
-                                 [cls.normalise_id(element_id) for element_id in elements_id],
-                                 None
-                                 )
-        raise Return(res)
+        replacement = cls.replace_elements(repository, set_id)
+        try:
+            yield replacement.add(elements_id)
+            yield replacement.commit()
+        except Exception:
+            yield replacement.abort()
+            raise
 
     @classmethod
     @coroutine
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+"""
+Benchmark of the normalisation of the element ids of a 100k-element set.
+
+Compares the previous normalisation, normalise_entity_id and normalise_entity_id
+memoised with memos of several sizes. Only prints the timings, e.g.
+
+    python tests/benchmarks/normalise_ids.py
+"""
+import re
+import timeit
+import uuid
+
+from repository.models.framework.cache import memoise
+from repository.models.framework.entity import normalise_entity_id
+from repository.models.framework.helper import ValidationException
+from repository.models.queries.generic import PREFIXES
+
+ELEMENTS = 100000
+MEMO_SIZES = (4096, 65536, 2 * ELEMENTS)
+
+
+def legacy_normalise_id(entity_id):
+    """The normalisation of the ids replaced by normalise_entity_id"""
+    if entity_id.startswith(PREFIXES['id']):
+        entity_id = entity_id[len(PREFIXES['id']):]
+    entity_id = entity_id.lower()
+    if not re.match("id:{}".format("([0-9a-fA-F]{1,64})"), entity_id):
+        if not re.match("([0-9a-fA-F]{1,64})", entity_id):
+            raise ValidationException("%r is not a valid uuid" % (entity_id,))
+        return "id:%s" % (entity_id,)
+    return entity_id
+
+
+def timed(normalise, element_ids, repeat=3):
+    """Fastest time in ms of normalising all the element ids"""
+    return 1000 * min(timeit.repeat(lambda: [normalise(eid) for eid in element_ids], number=1, repeat=repeat))
+
+
+def main():
+    element_ids = [uuid.uuid4().hex for _ in range(ELEMENTS)]
+    assert map(normalise_entity_id, element_ids) == map(legacy_normalise_id, element_ids)
+
+    print('normalising {} set elements'.format(ELEMENTS))
+    print('  previous normalisation: {:.1f}ms'.format(timed(legacy_normalise_id, element_ids)))
+    print('  normalise_entity_id: {:.1f}ms'.format(timed(normalise_entity_id, element_ids)))
+    for size in MEMO_SIZES:
+        memoised = memoise(size)(normalise_entity_id)
+        first = timed(memoised, element_ids, repeat=1)
+        print('  memoised, {} ids: {:.1f}ms, then {:.1f}ms'.format(size, first, timed(memoised, element_ids)))
+
+
+if __name__ == '__main__':
+    main()
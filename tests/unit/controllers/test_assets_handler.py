@@ -7,13 +7,15 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 
+import tempfile
+
 import pytest
 from mock import MagicMock, patch
 
 from koi import exceptions
 from koi.test_helpers import gen_test, make_future
 
-from repository.controllers.assets_handler import _validate_body, AssetsHandler
+from repository.controllers.assets_handler import _validate_body, AssetsHandler, AssetsUploadHandler
 
 
 TEST_NAMESPACE = 'c8ab01'
@@ -68,7 +70,7 @@ def test__validate_body_empty_body():
 @patch('repository.controllers.assets_handler.asset')
 @gen_test
 def test_repository_assets_handler_post(assets, audit, helper, _validate_body):
-    helper.validate.return_value = None
+    helper.parse.return_value = make_future(None)
     assets.store.return_value = make_future('asset data')
     audit.log_added_assets.return_value = make_future(None)
 
@@ -133,9 +135,9 @@ def test_repository_assets_handler_post_invalid_body(_validate_body):
 @patch('repository.controllers.assets_handler.helper')
 @gen_test
 def test_repository_assets_handler_post_invalid_body_xml(helper, _validate_body):
-    def mock_validate(data, format=None):
+    def mock_parse(data, format=None):
         raise exceptions.HTTPError(400, 'errormsg')
-    helper.validate.side_effect = mock_validate
+    helper.parse.side_effect = mock_parse
 
     handler = PartialMockedHandler()
 
@@ -143,3 +145,102 @@ def test_repository_assets_handler_post_invalid_body_xml(helper, _validate_body)
         yield handler.post('repository1')
 
     assert exc.value.status_code == 400
+
+
+def _upload_handler(content_type='application/xml', content_length=None):
+    handler = AssetsUploadHandler(application=MagicMock(), request=MagicMock())
+    handler.finish = MagicMock()
+    handler.token = {'sub': 'client1', 'client': {'id': 'testco'}}
+    handler.request.method = 'POST'
+    handler.request.headers = {'Content-Type': content_type}
+    if content_length is not None:
+        handler.request.headers['Content-Length'] = str(content_length)
+
+    return handler
+
+
+@patch('repository.controllers.base.RepoBaseHandler.prepare', return_value=make_future(None))
+@gen_test
+def test_assets_upload_handler_prepare(prepare):
+    handler = _upload_handler(content_length=10)
+
+    yield handler.prepare()
+
+    handler.request.connection.set_max_body_size.assert_called_once_with(1024 ** 3)
+    handler.data_received(b'<a> <b> ')
+    handler.data_received(b'<c> .')
+    assert handler._upload.tell() == 13
+
+    upload = handler._upload
+    handler.on_connection_close()
+    assert upload.closed
+
+
+@patch('repository.controllers.base.RepoBaseHandler.prepare', return_value=make_future(None))
+@gen_test
+def test_assets_upload_handler_prepare_invalid_content_type(prepare):
+    handler = _upload_handler(content_type='application/ld+json')
+
+    with pytest.raises(exceptions.HTTPError) as exc:
+        yield handler.prepare()
+
+    assert exc.value.status_code == 415
+    assert handler._upload is None
+
+
+@patch('repository.controllers.base.RepoBaseHandler.prepare', return_value=make_future(None))
+@gen_test
+def test_assets_upload_handler_prepare_turtle(prepare):
+    handler = _upload_handler(content_type='text/rdf+n3')
+
+    with pytest.raises(exceptions.HTTPError) as exc:
+        yield handler.prepare()
+
+    assert exc.value.status_code == 415
+    assert handler._upload is None
+
+
+@patch('repository.controllers.base.RepoBaseHandler.prepare', return_value=make_future(None))
+@gen_test
+def test_assets_upload_handler_prepare_too_large(prepare):
+    handler = _upload_handler(content_length=1024 ** 3 + 1)
+
+    with pytest.raises(exceptions.HTTPError) as exc:
+        yield handler.prepare()
+
+    assert exc.value.status_code == 413
+    assert handler._upload is None
+
+
+@patch('repository.controllers.assets_handler.audit')
+@patch('repository.controllers.assets_handler.asset')
+@gen_test
+def test_assets_upload_handler_post(assets, audit):
+    assets.parse_upload.return_value = make_future('payload')
+    assets.store.return_value = make_future('asset data')
+
+    handler = _upload_handler()
+    handler._upload = tempfile.TemporaryFile()
+    handler._upload.write(b'<a> <b> <c> .')
+    yield handler.post(TEST_NAMESPACE)
+
+    assets.parse_upload.assert_called_once_with(handler._upload, 'application/xml', 'xml')
+    assert assets.store.call_args[0][1] == 'payload'
+    audit.log_added_assets.assert_called_once_with(
+        'asset data',
+        {'sub': 'client1', 'client': {'id': 'testco'}},
+        repository_id='c8ab01')
+    handler.finish.assert_called_once_with({"status": 200})
+
+
+@patch('repository.controllers.assets_handler.asset')
+@gen_test
+def test_assets_upload_handler_post_empty(assets):
+    handler = _upload_handler()
+    handler._upload = tempfile.TemporaryFile()
+
+    with pytest.raises(exceptions.HTTPError) as exc:
+        yield handler.post(TEST_NAMESPACE)
+
+    assert exc.value.status_code == 400
+    assert not assets.parse_upload.called
@@ -9,14 +9,26 @@
 
 from __future__ import unicode_literals
 from mock import MagicMock, patch
+import jwt
 import pytest
+import time
 import urllib
 import tornado.httpclient
+from tornado import gen
+from tornado.concurrent import Future
 
 from koi.exceptions import HTTPError
 from koi.test_helpers import gen_test, make_future
 
+from repository.controllers import base
 from repository.controllers.base import RepoBaseHandler
+from repository.models.framework.cache import TTLCache
+
+
+@pytest.fixture(autouse=True)
+def caches(monkeypatch):
+    monkeypatch.setattr(base, '_token_cache', None)
+    monkeypatch.setattr(base, '_organisation_cache', None)
 
 
 class PartialMockedHandler(RepoBaseHandler):
@@ -28,7 +40,7 @@ class PartialMockedHandler(RepoBaseHandler):
         self.path_kwargs = {'repository_id': 'repo1'}
 
 
-@patch('repository.controllers.base.API')
+@patch('repository.models.framework.clients.client')
 @gen_test
 def test_get_organisation_id(API):
     client = API().accounts.repositories['repo1']
@@ -47,7 +59,7 @@ def test_get_organisation_id(API):
     assert result == 'org1'
 
 
-@patch('repository.controllers.base.API')
+@patch('repository.models.framework.clients.client')
 @gen_test
 def test_get_organisation_id_http_error(API):
     client = API().accounts.repositories['repo1']
@@ -68,8 +80,63 @@ def test_get_organisation_id_http_error(API):
     assert exc.value.status_code == 500
 
 
+@patch('repository.models.framework.clients.client')
+@gen_test
+def test_get_organisation_id_cached(API):
+    client = API().accounts.repositories['repo1']
+    client.get.return_value = make_future({'status': 200, 'data': {'id': 'repo1', 'organisation': {'id': 'org1'}}})
+
+    handler = PartialMockedHandler()
+    first = yield handler.get_organisation_id('repo1')
+    second = yield handler.get_organisation_id('repo1')
+
+    assert first == second == 'org1'
+    assert client.get.call_count == 1
+    assert base.cache_stats()['organisation']['hits'] == 1
+    assert base.cache_stats()['organisation']['misses'] == 1
+
+
+@patch('repository.models.framework.clients.client')
+@gen_test
+def test_get_organisation_id_stale_refreshed(API):
+    now = [1000.0]
+    cache = TTLCache(clock=lambda: now[0])
+    cache.set('repo1', 'org1', ttl=10, stale_ttl=100)
+    now[0] += 50
+
+    client = API().accounts.repositories['repo1']
+    client.get.return_value = make_future({'status': 200, 'data': {'id': 'repo1', 'organisation': {'id': 'org2'}}})
+
+    handler = PartialMockedHandler()
+    with patch.object(base, '_organisation_cache', cache):
+        result = yield handler.get_organisation_id('repo1')
+        assert result == 'org1'
+
+        yield gen.moment
+        yield gen.moment
+
+        assert client.get.call_count == 1
+        result = yield handler.get_organisation_id('repo1')
+        assert result == 'org2'
+
+
+@patch('repository.models.framework.clients.client')
+@gen_test
+def test_get_organisation_id_not_found_cached(API):
+    client = API().accounts.repositories['repo1']
+    client.get.side_effect = tornado.httpclient.HTTPError(404, 'errormsg')
+
+    handler = PartialMockedHandler()
+    for _ in range(2):
+        with pytest.raises(HTTPError) as exc:
+            yield handler.get_organisation_id('repo1')
+        assert exc.value.status_code == 404
+
+    assert client.get.call_count == 1
+
+
 @patch('repository.controllers.base.options')
-@patch('repository.controllers.base.API')
+@patch('repository.models.framework.clients.client')
 @gen_test
 def test_verify_repository_token_true(API, options):
     options.service_id = 'service1'
@@ -97,7 +164,7 @@ def test_verify_repository_token_true(API, options):
 
 
 @patch('repository.controllers.base.options')
-@patch('repository.controllers.base.API')
+@patch('repository.models.framework.clients.client')
 @gen_test
 def test_verify_repository_token_false(API, options):
     options.service_id = 'service1'
@@ -125,7 +192,7 @@ def test_verify_repository_token_false(API, options):
 
 
 @patch('repository.controllers.base.options')
-@patch('repository.controllers.base.API')
+@patch('repository.models.framework.clients.client')
 @gen_test
 def test_verify_repository_token_no_repo_id(API, options):
     options.service_id = 'service1'
@@ -152,7 +219,7 @@ def test_verify_repository_token_no_repo_id(API, options):
 
 
 @patch('repository.controllers.base.options')
-@patch('repository.controllers.base.API')
+@patch('repository.models.framework.clients.client')
 @gen_test
 def test_verify_repository_token_http_error(API, options):
     options.service_id = 'service1'
@@ -181,6 +248,99 @@ def test_verify_repository_token_http_error(API, options):
     assert exc.value.status_code == 500
 
 
+def _auth_options(options):
+    options.auth_cache_size = 10
+    options.auth_cache_ttl = 60.0
+    options.auth_cache_negative_ttl = 5.0
+
+
+@patch('repository.controllers.base.options')
+@patch('repository.models.framework.clients.client')
+@gen_test
+def test_verify_repository_token_cached(API, options):
+    _auth_options(options)
+    token = jwt.encode({'exp': int(time.time()) + 3600}, 'secret')
+    client = API().auth.verify
+    client.post.return_value = make_future({'status': 200, 'has_access': True})
+
+    handler = PartialMockedHandler()
+    first = yield handler.verify_repository_token(token, 'r', 'repo1')
+    second = yield handler.verify_repository_token(token, 'r', 'repo1')
+    other = yield handler.verify_repository_token(token, 'w', 'repo1')
+
+    assert first is second is other is True
+    assert client.post.call_count == 2
+
+
+@patch('repository.controllers.base.options')
+@patch('repository.models.framework.clients.client')
+@gen_test
+def test_verify_repository_token_expired_not_cached(API, options):
+    _auth_options(options)
+    token = jwt.encode({'exp': int(time.time()) - 10}, 'secret')
+    client = API().auth.verify
+    client.post.return_value = make_future({'status': 200, 'has_access': True})
+
+    handler = PartialMockedHandler()
+    yield handler.verify_repository_token(token, 'r', 'repo1')
+    yield handler.verify_repository_token(token, 'r', 'repo1')
+
+    assert client.post.call_count == 2
+
+
+@patch('repository.controllers.base.options')
+@patch('repository.models.framework.clients.client')
+@gen_test
+def test_verify_repository_token_denial_cached(API, options):
+    _auth_options(options)
+    client = API().auth.verify
+    client.post.return_value = make_future({'status': 200, 'has_access': False})
+
+    handler = PartialMockedHandler()
+    first = yield handler.verify_repository_token('token1', 'r', 'repo1')
+    second = yield handler.verify_repository_token('token1', 'r', 'repo1')
+
+    assert first is second is False
+    assert client.post.call_count == 1
+
+
+@patch('repository.controllers.base.options')
+@patch('repository.models.framework.clients.client')
+@gen_test
+def test_verify_repository_token_error_not_cached(API, options):
+    _auth_options(options)
+    client = API().auth.verify
+    client.post.side_effect = [tornado.httpclient.HTTPError(502, 'errormsg'),
+                               make_future({'status': 200, 'has_access': False})]
+
+    handler = PartialMockedHandler()
+    with pytest.raises(HTTPError):
+        yield handler.verify_repository_token('token1', 'r', 'repo1')
+    result = yield handler.verify_repository_token('token1', 'r', 'repo1')
+
+    assert result is False
+    assert client.post.call_count == 2
+
+
+@patch('repository.controllers.base.options')
+@patch('repository.models.framework.clients.client')
+@gen_test
+def test_verify_repository_token_concurrent(API, options):
+    _auth_options(options)
+    response = Future()
+    client = API().auth.verify
+    client.post.return_value = response
+
+    handler = PartialMockedHandler()
+    pending = [handler.verify_repository_token('token1', 'r', 'repo1'),
+               handler.verify_repository_token('token1', 'r', 'repo1')]
+    response.set_result({'status': 200, 'has_access': True})
+    result = yield pending
+
+    assert result == [True, True]
+    assert client.post.call_count == 1
+
+
 @patch('repository.controllers.base.options')
 @patch('repository.controllers.base.RepoBaseHandler.get_organisation_id')
 @patch('repository.controllers.base.RepoBaseHandler.verify_repository_token')
@@ -292,6 +452,9 @@ def test_prepare_oauth_required_missing_bearer(jwt, verify_repository_token, get
 @gen_test
 def test_prepare_oauth_required_invalid(verify_repository_token, get_organisation_id, options):
     verify_repository_token.return_value = make_future(False)
+    organisation = Future()
+    organisation.set_exception(HTTPError(404, 'Not Found'))
+    get_organisation_id.return_value = organisation
     options.standalone = False
     handler = PartialMockedHandler()
     handler.request.headers = {'Authorization': 'Bearer token1234'}
@@ -300,10 +463,64 @@ def test_prepare_oauth_required_invalid(verify_repository_token, get_organisatio
         yield handler.prepare()
 
     verify_repository_token.assert_called_once_with('token1234', 'r', 'repo1')
-    assert not get_organisation_id.called
+    get_organisation_id.assert_called_once_with('repo1')
+    assert handler.organisation_id is None
     assert exc.value.status_code == 403
 
 
+@patch('repository.controllers.base.options')
+@patch('repository.controllers.base.RepoBaseHandler.get_organisation_id')
+@patch('repository.controllers.base.RepoBaseHandler.verify_repository_token')
+@patch('repository.controllers.base.jwt')
+@gen_test
+def test_prepare_concurrent_lookups(jwt, verify_repository_token, get_organisation_id, options):
+    verification = Future()
+    verify_repository_token.return_value = verification
+    get_organisation_id.return_value = make_future('org1')
+    options.standalone = False
+    handler = PartialMockedHandler()
+    handler.request.headers = {'Authorization': 'Bearer token1234'}
+
+    pending = handler.prepare()
+    assert get_organisation_id.called
+    assert not pending.done()
+
+    verification.set_result(True)
+    yield pending
+
+    assert handler.organisation_id == 'org1'
+    assert set(handler.request.timings) == {'verify_token', 'organisation', 'prepare'}
+
+
+@patch('repository.controllers.base.time')
+@patch('repository.controllers.base.options')
+@patch('repository.controllers.base.RepoBaseHandler.get_organisation_id')
+@patch('repository.controllers.base.RepoBaseHandler.verify_repository_token')
+@patch('repository.controllers.base.jwt')
+@gen_test
+def test_prepare_timings(jwt, verify_repository_token, get_organisation_id, options, time):
+    verification = Future()
+    verify_repository_token.return_value = verification
+    organisation = Future()
+    get_organisation_id.return_value = organisation
+    options.standalone = False
+    handler = PartialMockedHandler()
+    handler.request.headers = {'Authorization': 'Bearer token1234'}
+    # start of prepare, of the organisation lookup and of the token verification
+    time.time.side_effect = [10.0, 10.5, 11.0]
+
+    pending = handler.prepare()
+
+    time.time.side_effect = [14.0]
+    verification.set_result(True)
+    yield gen.sleep(0)
+    time.time.side_effect = [17.5, 18.0]
+    organisation.set_result('org1')
+    yield pending
+
+    assert handler.request.timings == {'verify_token': 3.0, 'organisation': 7.0, 'prepare': 8.0}
+
+
 @patch('repository.controllers.base.options')
 @patch('repository.controllers.base.RepoBaseHandler.get_organisation_id')
 @patch('repository.controllers.base.RepoBaseHandler.verify_repository_token')
@@ -9,9 +9,12 @@
 
 import json
 
+import pytest
+from koi.exceptions import HTTPError
 from mock import MagicMock, patch
+from tornado import gen
 from koi.test_helpers import make_future, gen_test
-from repository.controllers.assets_handler import BulkOfferHandler
+from repository.controllers.assets_handler import BulkOfferHandler, _unique_ids
 
 
 class PartialMockedHandler(BulkOfferHandler):
@@ -48,4 +51,138 @@ def test_offer_handler_success_check_id_types(Offer):
     ]
 
     yield handler.post(repository_id)
-    handler.finish.assert_called_once_with({'status': 200, 'data': result})
+    handler.finish.assert_called_once_with({'status': 200, 'data': result,
+                                            'metadata': {'duplicates_removed': 2}})
+
+
+def test_unique_ids_keeps_first_occurrence():
+    ids, duplicates = _unique_ids([
+        {'source_id_type': 'testcopictureid', 'source_id': 'b'},
+        {'source_id_type': 'testcopictureid', 'source_id': 'a'},
+        {'source_id_type': 'testcopictureid', 'source_id': 'b', 'extra': 1},
+        {'source_id_type': 'testcopictureid', 'source_id': 'B'},
+    ])
+
+    assert ids == [{'source_id_type': 'testcopictureid', 'source_id': 'b'},
+                   {'source_id_type': 'testcopictureid', 'source_id': 'a'},
+                   {'source_id_type': 'testcopictureid', 'source_id': 'B'}]
+    assert duplicates == 1
+
+
+def test_unique_ids_folds_hub_keys():
+    ids, duplicates = _unique_ids([
+        {'source_id_type': 'hub_key', 'source_id': '749946384ADF460982EDAFECC9C846C0'},
+        {'source_id_type': 'hub_key', 'source_id': '749946384adf460982edafecc9c846c0'},
+        {'source_id_type': 'hub_key', 'source_id': 'http://openpermissions.org/ns/id/749946384adf460982edafecc9c846c0'},
+    ])
+
+    assert ids == [{'source_id_type': 'hub_key', 'source_id': '749946384ADF460982EDAFECC9C846C0'}]
+    assert duplicates == 2
+
+
+def test_unique_ids_many():
+    body = [{'source_id_type': 'testcopictureid', 'source_id': str(i % 1000)} for i in range(20000)]
+
+    ids, duplicates = _unique_ids(body)
+
+    assert len(ids) == 1000
+    assert duplicates == 19000
+
+
+@pytest.mark.parametrize('body', [
+    {'source_id_type': 'testcopictureid', 'source_id': '1'},
+    [{'source_id_type': 'testcopictureid'}],
+    [{'source_id_type': 'testcopictureid', 'source_id': ['1']}],
+    ['testcopictureid'],
+])
+def test_unique_ids_invalid(body):
+    with pytest.raises(HTTPError) as exc:
+        _unique_ids(body)
+
+    assert exc.value.status_code == 400
+
+
+@patch('repository.controllers.assets_handler.DatabaseConnection')
+@patch('repository.controllers.assets_handler.Offer')
+@gen_test
+def test_offer_handler_streams_ndjson(Offer, DatabaseConnection):
+    handler = PartialMockedHandler()
+    handler.request.headers = {'Content-Type': 'application/json', 'Accept': 'application/x-ndjson'}
+    handler.request.body = json.dumps([
+        {'source_id_type': 'testcopictureid', 'source_id': '100456'},
+        {'source_id_type': 'testcopictureid', 'source_id': '100456'},
+        {'source_id_type': 'testcopictureid', 'source_id': '100123'}
+    ])
+    handler.write = MagicMock()
+    handler.flush = MagicMock(return_value=make_future(None))
+
+    @gen.coroutine
+    def mock_stream(source_id_list, repository, callback):
+        yield callback([{'source_id': '100456', 'offers': []}])
+        yield callback([{'source_id': '100123', 'offers': [{'@id': 'o1'}]}])
+        raise gen.Return(2)
+
+    Offer.stream_for_assets.side_effect = mock_stream
+
+    yield handler.post('c8ab01')
+
+    assert Offer.stream_for_assets.call_args[0][0] == [
+        {'source_id_type': 'testcopictureid', 'source_id': '100456'},
+        {'source_id_type': 'testcopictureid', 'source_id': '100123'}
+    ]
+    assert not Offer.retrieve_for_assets.called
+    lines = ''.join(x[0][0] for x in handler.write.call_args_list).splitlines()
+    assert [json.loads(x) for x in lines] == [
+        {'source_id': '100456', 'offers': []},
+        {'source_id': '100123', 'offers': [{'@id': 'o1'}]},
+        {'status': 200, 'metadata': {'count': 2, 'duplicates_removed': 1}}
+    ]
+    assert handler.flush.call_count == 2
+    handler.finish.assert_called_once_with()
+
+
+@patch('repository.controllers.assets_handler.DatabaseConnection')
+@patch('repository.controllers.assets_handler.Offer')
+@gen_test
+def test_offer_handler_streams_ndjson_error(Offer, DatabaseConnection):
+    handler = PartialMockedHandler()
+    handler.request.headers = {'Content-Type': 'application/json', 'Accept': 'application/x-ndjson'}
+    handler.request.body = json.dumps([{'source_id_type': 'testcopictureid', 'source_id': '100456'}])
+    handler.write = MagicMock()
+    handler.flush = MagicMock()
+
+    def mock_stream(source_id_list, repository, callback):
+        raise Exception('database unavailable')
+
+    Offer.stream_for_assets.side_effect = mock_stream
+
+    yield handler.post('c8ab01')
+
+    lines = ''.join(x[0][0] for x in handler.write.call_args_list).splitlines()
+    assert [json.loads(x) for x in lines] == [
+        {'status': 500, 'metadata': {'count': 0, 'duplicates_removed': 0}}
+    ]
+
+
+@patch('repository.controllers.assets_handler.DatabaseConnection')
+@patch('repository.controllers.assets_handler.Offer')
+@gen_test
+def test_offer_handler_streams_ndjson_finished(Offer, DatabaseConnection):
+    handler = PartialMockedHandler()
+    handler.request.headers = {'Content-Type': 'application/json', 'Accept': 'application/x-ndjson'}
+    handler.request.body = json.dumps([{'source_id_type': 'testcopictureid', 'source_id': '100456'}])
+    handler.write = MagicMock()
+    handler.flush = MagicMock()
+    results = []
+
+    def mock_stream(source_id_list, repository, callback):
+        handler._finished = True
+        results.append(callback([{'source_id': '100456', 'offers': []}]))
+        return make_future(1)
+
+    Offer.stream_for_assets.side_effect = mock_stream
+
+    yield handler.post('c8ab01')
+
+    assert results == [None]
+    assert not handler.flush.called
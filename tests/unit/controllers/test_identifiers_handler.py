@@ -7,13 +7,16 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 
+import json
+
 import arrow
 import pytest
 from mock import MagicMock, patch
-from koi.test_helpers import make_future
+from koi.test_helpers import gen_test, make_future
+from tornado.concurrent import Future
 from koi.exceptions import HTTPError
 
-from repository.controllers.assets_handler import IdentifiersHandler
+from repository.controllers.assets_handler import IdentifiersHandler, _encode_cursor, _decode_cursor
 
 
 class PartialMockedHandler(IdentifiersHandler):
@@ -177,3 +180,231 @@ def test_handler_get_no_result(assets, options, url):
 
     assert handler.finish.called
     assert handler.finish.call_args[0][0].keys() == ['status', 'data', 'metadata']
+
+
+def test_cursor_roundtrip():
+    after = ('2016-01-01T11:00:00+00:00', 'a1b2')
+    cursor = _encode_cursor(after)
+
+    assert isinstance(cursor, str)
+    assert _decode_cursor(cursor) == after
+
+
+def test_decode_empty_cursor():
+    assert _decode_cursor('') is None
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64!',
+    _encode_cursor(['2016-01-01T11:00:00+00:00']),
+    _encode_cursor(['not a time', 'a1b2']),
+    _encode_cursor(['2016-01-01T11:00:00+00:00', 'not an id']),
+    _encode_cursor(['2016-01-01T11:00:00+00:00', 1]),
+    _encode_cursor([0, 'a1b2']),
+    _encode_cursor([None, 'a1b2']),
+])
+def test_decode_invalid_cursor(cursor):
+    with pytest.raises(HTTPError) as exc:
+        _decode_cursor(cursor)
+
+    assert exc.value.status_code == 400
+
+
+@patch('repository.controllers.assets_handler.options')
+@patch('repository.controllers.assets_handler.asset')
+def test_handler_get_cursor(assets, options):
+    options.service_id = 'service_id'
+    options.max_page_size = 1000
+    after = ('2016-01-01T11:00:00+00:00', 'b2')
+    assets.retrieve_assets_after.return_value = make_future(
+        (['id1'], ('2016-01-01T12:00:00+00:00', '2016-01-01T12:00:00+00:00'), after))
+
+    handler = PartialMockedHandler()
+    handler.request.protocol = 'https'
+    handler.request.host = 'localhost:8000'
+    handler.request.path = '/v1/repository/repositories/c8ab01/assets/identifiers'
+    handler.request.arguments = {
+        'cursor': [_encode_cursor(('2016-01-01T10:00:00+00:00', 'a1'))],
+        'page_size': ['10']
+    }
+    handler.get('c8ab01').result()
+
+    assert not assets.retrieve_paged_assets.called
+    assert assets.retrieve_assets_after.call_args[1] == {
+        'after': ('2016-01-01T10:00:00+00:00', 'a1'),
+        'page_size': 10
+    }
+    result = handler.finish.call_args[0][0]
+    assert result['data'] == ['id1']
+    assert result['metadata']['cursor'] == _encode_cursor(after)
+    assert 'cursor=' + result['metadata']['cursor'] in result['metadata']['next']
+    assert 'page=' not in result['metadata']['next']
+
+
+@patch('repository.controllers.assets_handler.options')
+@patch('repository.controllers.assets_handler.asset')
+def test_handler_get_empty_cursor_starts_at_first_page(assets, options):
+    options.service_id = 'service_id'
+    options.max_page_size = 1000
+    assets.retrieve_assets_after.return_value = make_future(([], (), None))
+
+    handler = PartialMockedHandler()
+    handler.request.arguments = {'cursor': ['']}
+    handler.get('c8ab01').result()
+
+    assert assets.retrieve_assets_after.call_args[1]['after'] is None
+    result = handler.finish.call_args[0][0]
+    assert result['data'] == []
+    assert 'next' not in result['metadata']
+
+
+@patch('repository.controllers.assets_handler.NDJSON_FLUSH_SIZE', 10)
+@patch('repository.controllers.assets_handler.options')
+@patch('repository.controllers.assets_handler.asset')
+def test_handler_get_ndjson(assets, options):
+    options.service_id = 'service_id'
+    options.max_page_size = 1000
+    next_after = ('2016-01-01T11:00:00+00:00', 'b2')
+
+    def stream(repository, from_time, to_time, on_record, after=None, page_size=None):
+        on_record({'entity_id': 'a1'})
+        on_record({'entity_id': 'b2'})
+        return make_future((2, ('2016-01-01T10:00:00+00:00', '2016-01-01T11:00:00+00:00'), next_after))
+
+    assets.stream_assets_after.side_effect = stream
+
+    handler = PartialMockedHandler()
+    handler.write = MagicMock()
+    handler.flush = MagicMock(return_value=make_future(None))
+    handler.set_header = MagicMock()
+    handler.request.protocol = 'https'
+    handler.request.host = 'localhost:8000'
+    handler.request.path = '/v1/repository/repositories/c8ab01/assets/identifiers'
+    handler.request.headers = {'Accept': 'application/x-ndjson'}
+    handler.request.arguments = {'page_size': ['2']}
+    handler.get('c8ab01').result()
+
+    assert not assets.retrieve_paged_assets.called
+    assert assets.stream_assets_after.call_args[1] == {'after': None, 'page_size': 2}
+    handler.set_header.assert_called_once_with('Content-Type', 'application/x-ndjson; charset=UTF-8')
+    assert handler.flush.call_count == 2
+
+    lines = [json.loads(call[0][0]) for call in handler.write.call_args_list]
+    assert lines[:2] == [{'entity_id': 'a1'}, {'entity_id': 'b2'}]
+    trailer = lines[2]
+    assert trailer['status'] == 200
+    assert trailer['metadata']['count'] == 2
+    assert trailer['metadata']['cursor'] == _encode_cursor(next_after)
+    assert 'cursor=' + trailer['metadata']['cursor'] in trailer['metadata']['next']
+    assert handler.finish.call_args == ((), {})
+
+
+@patch('repository.controllers.assets_handler.NDJSON_FLUSH_SIZE', 10)
+@patch('repository.controllers.assets_handler.options')
+@patch('repository.controllers.assets_handler.asset')
+@gen_test
+def test_handler_get_ndjson_waits_for_flush(assets, options):
+    options.service_id = 'service_id'
+    options.max_page_size = 1000
+
+    def stream(repository, from_time, to_time, on_record, after=None, page_size=None):
+        on_record({'entity_id': 'a1'})
+        on_record({'entity_id': 'b2'})
+        return make_future((2, ('2016-01-01T10:00:00+00:00', '2016-01-01T11:00:00+00:00'),
+                            ('2016-01-01T11:00:00+00:00', 'b2')))
+
+    assets.stream_assets_after.side_effect = stream
+
+    flushed = Future()
+    handler = PartialMockedHandler()
+    handler.write = MagicMock()
+    handler.flush = MagicMock(return_value=flushed)
+    handler.set_header = MagicMock()
+    handler.request.protocol = 'https'
+    handler.request.host = 'localhost:8000'
+    handler.request.path = '/v1/repository/repositories/c8ab01/assets/identifiers'
+    handler.request.headers = {'Accept': 'application/x-ndjson'}
+    handler.request.arguments = {}
+    result = handler.get('c8ab01')
+
+    # the second record is buffered until the first flush completes
+    assert handler.flush.call_count == 1
+    assert handler.write.call_count == 2
+    assert not handler.finish.called
+
+    flushed.set_result(None)
+    yield result
+
+    assert json.loads(handler.write.call_args[0][0])['status'] == 200
+    assert handler.finish.call_args == ((), {})
+
+
+@patch('repository.controllers.assets_handler.NDJSON_QUERY_SIZE', 2)
+@patch('repository.controllers.assets_handler.options')
+@patch('repository.controllers.assets_handler.asset')
+@gen_test
+def test_handler_get_ndjson_queries_after_flush(assets, options):
+    options.service_id = 'service_id'
+    options.max_page_size = 1000
+    replies = [
+        (['a1', 'b2'], (2, ('2016-01-01T10:00:00+00:00', '2016-01-01T11:00:00+00:00'),
+                        ('2016-01-01T11:00:00+00:00', 'b2'))),
+        (['c3'], (1, ('2016-01-01T12:00:00+00:00', '2016-01-01T12:00:00+00:00'),
+                  ('2016-01-01T12:00:00+00:00', 'c3'))),
+    ]
+
+    def stream(repository, from_time, to_time, on_record, after=None, page_size=None):
+        entity_ids, result = replies.pop(0)
+        for entity_id in entity_ids:
+            on_record({'entity_id': entity_id})
+        return make_future(result)
+
+    assets.stream_assets_after.side_effect = stream
+
+    flushed = Future()
+    handler = PartialMockedHandler()
+    handler.write = MagicMock()
+    handler.flush = MagicMock(return_value=flushed)
+    handler.set_header = MagicMock()
+    handler.request.protocol = 'https'
+    handler.request.host = 'localhost:8000'
+    handler.request.path = '/v1/repository/repositories/c8ab01/assets/identifiers'
+    handler.request.headers = {'Accept': 'application/x-ndjson'}
+    handler.request.arguments = {'page_size': ['3']}
+    result = handler.get('c8ab01')
+
+    # the next identifiers are queried once the first ones are flushed
+    assert assets.stream_assets_after.call_count == 1
+    assert handler.flush.call_count == 1
+
+    flushed.set_result(None)
+    yield result
+
+    assert [call[1] for call in assets.stream_assets_after.call_args_list] == [
+        {'after': None, 'page_size': 2},
+        {'after': ('2016-01-01T11:00:00+00:00', 'b2'), 'page_size': 1}]
+    lines = [json.loads(call[0][0]) for call in handler.write.call_args_list]
+    assert [line['entity_id'] for line in lines[:3]] == ['a1', 'b2', 'c3']
+    trailer = lines[3]
+    assert trailer['metadata']['count'] == 3
+    assert trailer['metadata']['result_range'] == ['2016-01-01T10:00:00+00:00', '2016-01-01T12:00:00+00:00']
+    assert trailer['metadata']['cursor'] == _encode_cursor(('2016-01-01T12:00:00+00:00', 'c3'))
+
+
+@patch('repository.controllers.assets_handler.options')
+@patch('repository.controllers.assets_handler.asset')
+def test_handler_get_ndjson_error(assets, options):
+    options.service_id = 'service_id'
+    options.max_page_size = 1000
+    assets.stream_assets_after.side_effect = Exception('connection closed')
+
+    handler = PartialMockedHandler()
+    handler.write = MagicMock()
+    handler.set_header = MagicMock()
+    handler.request.headers = {'Accept': 'application/x-ndjson'}
+    handler.request.arguments = {}
+    handler.get('c8ab01').result()
+
+    trailer = json.loads(handler.write.call_args[0][0])
+    assert trailer['status'] == 500
+    assert 'next' not in trailer['metadata']
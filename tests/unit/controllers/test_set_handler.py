@@ -8,12 +8,14 @@
 # See the License for the specific language governing permissions and limitations under the License.
 
 from functools import partial
-from mock import MagicMock, patch
+from mock import MagicMock, Mock, patch
 import pytest
 from koi.test_helpers import make_future, gen_test
 from koi.exceptions import HTTPError
+from tornado import gen
 from tornado.ioloop import IOLoop
 from repository.controllers import sets_handler
+from repository.models.framework.helper import ValidationException
 
 TEST_NAMESPACE = 'c8ab01'
 
@@ -121,6 +123,25 @@ def test_set_assets_handler_get(DatabaseConnection, Set, audit):
     assert (Set.get_elements.call_count == 1)
     handler.finish.assert_called_once_with({'status': 200, 'data': {'assets': map(str, range(10))}})
 
+@pytest.mark.parametrize('after, expected_after, page_size, next_', [
+    ('', None, '3', '2'),
+    ('1', '1', '3', '2'),
+    ('1', '1', '4', None),
+])
+@patch("repository.controllers.sets_handler.Set")
+@patch("repository.controllers.sets_handler.DatabaseConnection", return_value=TEST_NAMESPACE)
+def test_set_assets_handler_get_after(DatabaseConnection, Set, after, expected_after, page_size, next_):
+    handler = PartialMockedHandler(sets_handler.SetAssetsHandler)
+    handler.request.arguments = {'after': [after], 'page_size': [page_size]}
+
+    Set.get_elements.return_value = make_future(['http://openpermissions.org/ns/id/' + x for x in '012'])
+    Set.exists.return_value = make_future(True)
+    IOLoop.current().run_sync(partial(handler.get, TEST_NAMESPACE, "504504"))
+
+    Set.get_elements.assert_called_once_with(TEST_NAMESPACE, "504504", page_size=int(page_size), after=expected_after)
+    handler.finish.assert_called_once_with({'status': 200, 'data': {'assets': ['0', '1', '2'], 'next': next_}})
+
+
 @patch("repository.controllers.sets_handler.audit")
 @patch("repository.controllers.sets_handler.Asset")
 @patch("repository.controllers.sets_handler.Set")
@@ -185,3 +206,149 @@ def test_set_asset_handler_delete(DatabaseConnection, Set, Asset, audit):
     assert (audit.log.call_count == 0)
     assert (Set.remove_elements.call_count == 1)
     handler.finish.assert_called_once_with({'status': 200})
+
+
+@patch("repository.controllers.sets_handler.options", max_page_size=1000)
+@patch("repository.controllers.sets_handler.filter_existing")
+@patch("repository.controllers.sets_handler.Set")
+@patch("repository.controllers.sets_handler.DatabaseConnection", return_value=TEST_NAMESPACE)
+@gen_test
+def test_set_membership_handler_post(DatabaseConnection, Set, filter_existing, options):
+    handler = PartialMockedHandler(sets_handler.SetMembershipHandler)
+    handler.request.body = '{"assets": ["a1", "a2", "a3", "a1"]}'
+    handler.request.headers = {"Content-Type": "application/json"}
+
+    Asset = sets_handler.Asset
+    filter_existing.return_value = make_future({(Set, "504504"), (Asset, "a1"), (Asset, "a2")})
+    Set.filter_members.return_value = make_future({"a2"})
+    yield handler.post(TEST_NAMESPACE, "504504")
+
+    entities = filter_existing.call_args[0][1]
+    assert entities[0] == (Set, "504504")
+    assert sorted(entities[1:]) == [(Asset, "a1"), (Asset, "a1"), (Asset, "a2"), (Asset, "a3")]
+    assert filter_existing.call_count == 1
+    assert Set.filter_members.call_count == 1
+    assert sorted(Set.filter_members.call_args[0][2]) == ["a1", "a2"]
+    handler.finish.assert_called_once_with({'status': 200, 'data': {
+        'is_member': {'a1': False, 'a2': True},
+        'not_found': ['a3']
+    }})
+
+
+@patch("repository.controllers.sets_handler.options", max_page_size=1000)
+@patch("repository.controllers.sets_handler.filter_existing")
+@patch("repository.controllers.sets_handler.Set")
+@patch("repository.controllers.sets_handler.DatabaseConnection", return_value=TEST_NAMESPACE)
+@gen_test
+def test_set_membership_handler_post_set_not_found(DatabaseConnection, Set, filter_existing, options):
+    handler = PartialMockedHandler(sets_handler.SetMembershipHandler)
+    handler.request.body = '{"assets": ["a1"]}'
+    handler.request.headers = {"Content-Type": "application/json"}
+
+    filter_existing.return_value = make_future({(sets_handler.Asset, "a1")})
+    with pytest.raises(HTTPError) as exc:
+        yield handler.post(TEST_NAMESPACE, "504504")
+
+    assert exc.value.status_code == 404
+    assert not Set.filter_members.called
+
+
+@pytest.mark.parametrize('body', ['{"assets": "a1"}', '{"assets": [1]}', '{"assets": ["a1", "a2", "a3"]}'])
+@patch("repository.controllers.sets_handler.options")
+@patch("repository.controllers.sets_handler.filter_existing")
+def test_set_membership_handler_post_invalid_assets(filter_existing, options, body):
+    options.max_page_size = 2
+    handler = PartialMockedHandler(sets_handler.SetMembershipHandler)
+    handler.request.body = body
+    handler.request.headers = {"Content-Type": "application/json"}
+
+    with pytest.raises(HTTPError) as exc:
+        IOLoop.current().run_sync(partial(handler.post, TEST_NAMESPACE, "504504"))
+
+    assert exc.value.status_code == 400
+    assert not filter_existing.called
+
+
+def _post_set_assets(db, chunks, content_type="application/json"):
+    handler = PartialMockedHandler(sets_handler.SetAssetsHandler)
+    handler.request.method = "POST"
+    handler.request.headers = {"Content-Type": content_type}
+    handler.path_kwargs = {'repository_id': TEST_NAMESPACE, 'set_id': "504504"}
+
+    with patch("repository.controllers.base.RepoBaseHandler.prepare", return_value=make_future(None)), \
+            patch("repository.controllers.sets_handler.DatabaseConnection", return_value=db), \
+            patch.object(sets_handler.Set, "exists", return_value=make_future(True)), \
+            patch("repository.models.set.options") as options:
+        options.set_update_chunk_size = 2
+
+        @gen.coroutine
+        def post():
+            yield handler.prepare()
+            for chunk in chunks:
+                yield handler.data_received(chunk)
+            yield handler.post(TEST_NAMESPACE, "504504")
+
+        IOLoop.current().run_sync(post)
+
+    return handler
+
+
+def test_set_assets_handler_post_streamed_json():
+    db = Mock()
+    db.update.return_value = make_future(None)
+
+    handler = _post_set_assets(db, ['{"assets": ["a1", ', '"a2", "a', '3"]}'])
+
+    handler.finish.assert_called_once_with({'status': 200})
+    queries = [call[0][0] for call in db.update.call_args_list]
+    # one batch staged, then the swap with the last (partial) batch staged before it
+    assert len(queries) == 3
+    assert '<urn:x-repository:stagedElement> id:a1 .' in queries[0]
+    assert 'id:a2' in queries[0]
+    assert 'id:a3' in queries[1]
+    assert 'op:hasElement' not in queries[1]
+    assert 'INSERT { id:504504 op:hasElement ?element }' in queries[2]
+
+
+def test_set_assets_handler_post_ndjson():
+    db = Mock()
+    db.update.return_value = make_future(None)
+
+    handler = _post_set_assets(db, ['"a1"\n', '"a2"'], content_type="application/x-ndjson")
+
+    handler.finish.assert_called_once_with({'status': 200})
+    queries = [call[0][0] for call in db.update.call_args_list]
+    assert len(queries) == 2
+    assert 'id:a1' in queries[0] and 'id:a2' in queries[0]
+    assert 'INSERT { id:504504 op:hasElement ?element }' in queries[1]
+
+
+def test_set_assets_handler_post_invalid_body_aborts():
+    db = Mock()
+    db.update.return_value = make_future(None)
+
+    with pytest.raises(ValidationException):
+        _post_set_assets(db, ['{"assets": ["a1", "a2", ', '3]}'])
+
+    queries = [call[0][0] for call in db.update.call_args_list]
+    # the staged batch is removed and the elements of the set left unchanged
+    assert len(queries) == 2
+    assert 'DELETE { <urn:x-repository:setStaging:' in queries[1]
+    assert 'op:hasElement' not in ''.join(queries)
+
+
+@pytest.mark.parametrize('chunks', [
+    ['{"assets": ["a1", "a2", ', '"a3"]} trailing'],
+    ['{"assets": ["a1", "a2", ', '"a3"],}'],
+])
+def test_set_assets_handler_post_invalid_json_aborts(chunks):
+    db = Mock()
+    db.update.return_value = make_future(None)
+
+    with pytest.raises(ValidationException):
+        _post_set_assets(db, chunks)
+
+    queries = [call[0][0] for call in db.update.call_args_list]
+    assert len(queries) == 2
+    assert 'DELETE { <urn:x-repository:setStaging:' in queries[1]
+    assert 'op:hasElement' not in ''.join(queries)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+from mock import MagicMock, patch
+from repository.controllers.stats_handler import StatsHandler
+
+
+@patch('repository.controllers.stats_handler.workers.pool_stats', return_value={'pending': 2})
+@patch('repository.controllers.stats_handler.base.cache_stats',
+       return_value={'token': {'hits': 1, 'misses': 2}, 'organisation': {'hits': 3, 'misses': 4}})
+@patch('repository.controllers.stats_handler.db.pool_stats', return_value={'requests': 3})
+def test_get_stats(pool_stats, cache_stats, worker_stats):
+    handler = StatsHandler(MagicMock(), MagicMock())
+    handler.finish = MagicMock()
+
+    # MUT
+    handler.get()
+    msg = {
+        'status': 200,
+        'data': {
+            'db': {'requests': 3},
+            'cache': {'token': {'hits': 1, 'misses': 2}, 'organisation': {'hits': 3, 'misses': 4}},
+            'rdf_workers': {'pending': 2}
+        }
+    }
+
+    handler.finish.assert_called_once_with(msg)
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import pytest
+from mock import MagicMock
+from koi.test_helpers import gen_test
+from tornado.concurrent import Future
+
+from repository.models.framework.cache import TTLCache, memoise
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_get_set():
+    cache = TTLCache(clock=Clock())
+    cache.set('a', 1)
+
+    assert cache.get('a') == 1
+    assert cache.get('b', 'default') == 'default'
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_expiry():
+    clock = Clock()
+    cache = TTLCache(ttl=10, clock=clock)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=20)
+
+    clock.now += 15
+
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert len(cache) == 1
+
+
+def test_not_cached_without_ttl():
+    cache = TTLCache(clock=Clock())
+    cache.set('a', 1, ttl=0)
+    cache.set('b', 1, ttl=-5)
+
+    assert len(cache) == 0
+
+
+def test_stale():
+    clock = Clock()
+    cache = TTLCache(ttl=10, clock=clock)
+    cache.set('a', 1, stale_ttl=100)
+
+    clock.now += 50
+
+    assert cache.get('a') is None
+    assert cache.lookup('a') == (1, False)
+    assert cache.stats()['stale_hits'] == 1
+
+    clock.now += 100
+
+    assert cache.lookup('a') == (None, False)
+
+
+def test_lookup_fresh():
+    cache = TTLCache(clock=Clock())
+    cache.set('a', 1)
+
+    assert cache.lookup('a') == (1, True)
+    assert cache.lookup('b') == (None, False)
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_least_recently_used_evicted():
+    cache = TTLCache(max_size=2, clock=Clock())
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+def test_max_cost():
+    cache = TTLCache(max_cost=10, clock=Clock())
+    cache.set('a', 1, cost=4)
+    cache.set('b', 2, cost=4)
+    cache.set('c', 3, cost=4)
+    cache.set('d', 4, cost=11)
+
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert cache.get('c') == 3
+    assert cache.get('d') is None
+    assert cache.cost == 8
+
+    cache.set('b', 2, cost=1)
+    assert cache.cost == 5
+
+
+def test_pop_clear():
+    cache = TTLCache(clock=Clock())
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    assert cache.pop('a') == 1
+    assert cache.pop('a') is None
+    cache.clear()
+    assert len(cache) == 0
+
+
+@gen_test
+def test_shared():
+    cache = TTLCache(clock=Clock())
+    future = Future()
+    func = MagicMock(return_value=future)
+
+    first = cache.shared('a', func)
+    second = cache.shared('a', func)
+    future.set_result(1)
+    result = yield [first, second]
+
+    assert result == [1, 1]
+    assert func.call_count == 1
+
+
+def test_memoise():
+    calls = []
+
+    @memoise(10)
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    assert double(1) == 2
+    assert double(1) == 2
+    assert double(2) == 4
+    assert calls == [1, 2]
+
+
+def test_memoise_bounded():
+    calls = []
+
+    @memoise(4)
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    for x in range(10):
+        double(x)
+    del calls[:]
+
+    # only the most recently used results are kept
+    for x in range(10):
+        double(x)
+    assert calls == range(10)
+
+
+def test_memoise_least_recently_used_dropped():
+    calls = []
+
+    @memoise(4)
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    double(1)
+    double(2)
+    double(3)
+    # 1 is used again before 4 and 5 are added
+    double(1)
+    double(4)
+    double(5)
+    del calls[:]
+
+    double(1)
+    double(2)
+    assert calls == [2]
+
+
+def test_memoise_exception_not_memoised():
+    calls = []
+
+    @memoise(10)
+    def fail(x):
+        calls.append(x)
+        raise ValueError(x)
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            fail(1)
+    assert calls == [1, 1]
+
+
+def test_memoise_clear():
+    calls = []
+
+    @memoise(10)
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    double(1)
+    double.clear()
+    double(1)
+    assert calls == [1, 1]
+
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+
+from __future__ import unicode_literals
+import time
+
+import jwt
+import pytest
+from chub.oauth2 import Write
+from mock import patch
+from tornado.gen import sleep
+from koi.test_helpers import gen_test, make_future
+
+from repository.models.framework import clients
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(clients, '_fetchers', {})
+    monkeypatch.setattr(clients, '_service_token_cache', None)
+
+
+def test_client_shares_http_client():
+    first = clients.client('https://localhost:8002', token='token1')
+    second = clients.client('https://localhost:8002')
+
+    assert first.fetch is second.fetch
+    assert first.base_url == second.base_url == 'https://localhost:8002/v1'
+    assert first.token == 'token1'
+    assert second.token == ''
+
+
+def test_client_token_header():
+    first = clients.client('https://localhost:8002', token='token1')
+    second = clients.client('https://localhost:8002')
+
+    assert first.index.notifications.default_headers['Authorization'] == 'Bearer token1'
+    assert 'Authorization' not in second.index.notifications.default_headers
+
+
+def test_client_resources_not_shared():
+    first = clients.client('https://localhost:8002')
+    second = clients.client('https://localhost:8002')
+
+    first.index.notifications.prepare_request(request_timeout=10)
+
+    assert first.index.notifications is not second.index.notifications
+    assert second.index.notifications.http_request is None
+
+
+def test_client_defaults():
+    first = clients.client('https://localhost:8007', auth_username='service1')
+    second = clients.client('https://localhost:8007', auth_username='service2')
+    other = clients.client('https://localhost:8006', auth_username='service1')
+
+    assert first.fetch is not second.fetch
+    assert first.fetch is not other.fetch
+    assert first.fetch is clients.client('https://localhost:8007', auth_username='service1').fetch
+
+
+@patch('repository.models.framework.clients.options')
+def test_token_lifetime_bounded_by_expiry(options):
+    options.service_token_ttl = 600.0
+    token = jwt.encode({'exp': int(time.time()) + 100}, 'secret')
+
+    lifetime = clients._token_lifetime(token)
+
+    assert 80 < lifetime <= 100 - clients.TOKEN_EXPIRY_MARGIN
+
+
+@patch('repository.models.framework.clients.options')
+def test_token_lifetime_opaque_token(options):
+    options.service_token_ttl = 600.0
+    assert clients._token_lifetime('token1234') == 600.0 - clients.TOKEN_EXPIRY_MARGIN
+
+
+@patch('repository.models.framework.clients.get_token', return_value=make_future('token1234'))
+@gen_test
+def test_service_token_cached(get_token):
+    with patch('repository.models.framework.clients.options') as options:
+        options.service_token_ttl = 600.0
+        options.service_token_refresh = 60.0
+        first = yield clients.service_token(Write('https://localhost:8002'))
+        second = yield clients.service_token(Write('https://localhost:8002'))
+
+    assert first == second == 'token1234'
+    assert get_token.call_count == 1
+    assert get_token.call_args[1]['scope'] == Write('https://localhost:8002')
+    assert get_token.call_args[1]['cache'] is False
+
+
+@patch('repository.models.framework.clients.get_token')
+@gen_test
+def test_service_token_per_scope(get_token):
+    get_token.side_effect = lambda *args, **kwargs: make_future(str(kwargs['scope']))
+    with patch('repository.models.framework.clients.options') as options:
+        options.service_token_ttl = 600.0
+        options.service_token_refresh = 60.0
+        first = yield clients.service_token(Write('https://localhost:8002'))
+        second = yield clients.service_token(Write('https://localhost:8003'))
+
+    assert first == 'write[https://localhost:8002]'
+    assert second == 'write[https://localhost:8003]'
+
+
+@patch('repository.models.framework.clients.get_token', return_value=make_future('new'))
+@gen_test
+def test_service_token_refreshed_in_background(get_token):
+    scope = Write('https://localhost:8002')
+    clients.service_token_cache().set(str(scope), 'old', ttl=0, stale_ttl=60)
+
+    with patch('repository.models.framework.clients.options') as options:
+        options.service_token_ttl = 600.0
+        options.service_token_refresh = 60.0
+        token = yield clients.service_token(scope)
+        assert token == 'old'
+
+        yield sleep(0.01)
+        token = yield clients.service_token(scope)
+
+    assert token == 'new'
+    assert get_token.call_count == 1
+
+
+@patch('repository.models.framework.clients.logging')
+@patch('repository.models.framework.clients.get_token')
+@gen_test
+def test_service_token_refresh_error(get_token, logging):
+    get_token.side_effect = Exception('unavailable')
+    scope = Write('https://localhost:8002')
+    clients.service_token_cache().set(str(scope), 'old', ttl=0, stale_ttl=60)
+
+    with patch('repository.models.framework.clients.options'):
+        token = yield clients.service_token(scope)
+        yield sleep(0.01)
+
+    assert token == 'old'
+    assert logging.warning.called
+    assert clients.service_token_cache().lookup(str(scope)) == ('old', False)
+
+
+def test_drop_service_token():
+    scope = Write('https://localhost:8002')
+    clients.service_token_cache().set(str(scope), 'token1234')
+
+    clients.drop_service_token(scope)
+
+    assert clients.service_token_cache().lookup(str(scope)) == (None, False)
@@ -12,13 +12,20 @@ from __future__ import unicode_literals
 import logging
 import os
 import pytest
+import tempfile
+import time
 from koi.exceptions import HTTPError
 from koi.test_helpers import make_future, gen_test
-from mock import patch
+from mock import Mock, patch
 from tornado import httpclient
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
 
 from repository.models.framework.db import (load_data, load_directory, DatabaseConnection, _initialise_namespace, INITIAL_DATA,
-                                            _namespace_url, _set_accept_header, request, NAMESPACE_ASSET, create_namespace
+                                            _namespace_url, _set_accept_header, request, NAMESPACE_ASSET, create_namespace,
+                                            http_client, pool_stats, CurlAsyncHTTPClient, known_namespaces,
+                                            warm_namespaces, _known_namespaces, _streaming_arguments,
+                                            upload_client, UPLOAD_CHUNK_SIZE, _fetch
                                             )
 from ..util import create_mockdb
 
@@ -193,6 +200,11 @@ def test__set_accept_header_json():
     assert result == {'Accept': 'application/sparql-results+json'}
 
 
+def test__set_accept_header_tsv():
+    result = _set_accept_header('tsv')
+    assert result == {'Accept': 'text/tab-separated-values'}
+
+
 def test__set_accept_header_none():
     result = _set_accept_header(None)
     assert result == {}
@@ -371,4 +383,232 @@ def test_request_uninitialised_namespace_standalone_mode(options, fetch, url, cr
         yield request(None, 'c8ab01', 'pay load')
     assert not create_namespace.called
     assert fetch.call_count == 1
-    assert exc.value.code == 404
\ No newline at end of file
+    assert exc.value.code == 404
+
+@patch('repository.models.framework.db.options')
+@gen_test
+def test_http_client_shared(options):
+    options.repo_db_use_curl = False
+    options.repo_db_max_clients = 7
+    options.repo_db_connect_timeout = 3
+    options.repo_db_request_timeout = 4
+    options.repo_db_gzip = False
+    with patch.dict('repository.models.framework.db._clients', clear=True):
+        client = http_client()
+
+        assert http_client() is client
+        assert client.max_clients == 7
+        assert client.defaults['connect_timeout'] == 3
+        assert client.defaults['request_timeout'] == 4
+        assert client.defaults['decompress_response'] is False
+
+
+@pytest.mark.skipif(CurlAsyncHTTPClient is None, reason='pycurl is not installed')
+@patch('repository.models.framework.db.options')
+@gen_test
+def test_http_client_curl(options):
+    options.repo_db_use_curl = True
+    options.repo_db_max_clients = 3
+    with patch.dict('repository.models.framework.db._clients', clear=True):
+        assert isinstance(http_client(), CurlAsyncHTTPClient)
+        assert pool_stats()['max_clients'] == 3
+
+
+@patch('repository.models.framework.db._namespace_url', return_value='https://localhost:8000/bigdata/namespace/c8ab01')
+@patch('repository.models.framework.db.AsyncHTTPClient.fetch')
+@gen_test
+def test_request_pool_stats(fetch, url):
+    fetch.side_effect = [make_future('my response'), httpclient.HTTPError(500, 'Internal Server Error')]
+    before = pool_stats()
+
+    yield request(None, 'c8ab01', 'pay load')
+    with pytest.raises(httpclient.HTTPError):
+        yield request(None, 'c8ab01', 'pay load')
+
+    after = pool_stats()
+    assert after['requests'] == before['requests'] + 2
+    assert after['errors'] == before['errors'] + 1
+    assert after['active'] == 0
+
+
+@patch('repository.models.framework.db.options')
+@gen_test
+def test_pool_stats_queued(options):
+    options.repo_db_max_clients = 2
+    client = Mock()
+    responses = [Future() for _ in range(3)]
+    client.fetch.side_effect = responses
+    with patch.dict('repository.models.framework.db._clients', {IOLoop.current(): client}, clear=True):
+        fetches = [_fetch('https://localhost:8000/bigdata') for _ in responses]
+        stats = pool_stats()
+        for response in responses:
+            response.set_result('my response')
+        yield fetches
+
+    assert stats['max_clients'] == 2
+    assert stats['queued'] == 1
+
+
+NAMESPACE_LISTING = """<?xml version="1.0" encoding="UTF-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:nodeID="kb">
+    <Namespace xmlns="http://www.bigdata.com/rdf#/features/KB/">kb</Namespace>
+  </rdf:Description>
+  <rdf:Description rdf:nodeID="c8ab02">
+    <Namespace xmlns="http://www.bigdata.com/rdf#/features/KB/">c8ab02</Namespace>
+  </rdf:Description>
+</rdf:RDF>
+"""
+
+
+@patch('repository.models.framework.db.create_namespace')
+@patch('repository.models.framework.db._namespace_url', return_value='https://localhost:8000/bigdata/namespace/c8ab01')
+@patch('repository.models.framework.db.AsyncHTTPClient.fetch')
+@gen_test
+def test_request_concurrent_uninitialised_namespace(fetch, url, create_namespace):
+    creation = Future()
+    create_namespace.return_value = creation
+    fetch.side_effect = [httpclient.HTTPError(404, 'Not Found'), httpclient.HTTPError(404, 'Not Found'),
+                         make_future('my response'), make_future('my response')]
+
+    with patch.dict('repository.models.framework.db._known_namespaces', clear=True):
+        pending = [request(None, 'c8ab01', 'pay load'), request(None, 'c8ab01', 'pay load')]
+        creation.set_result(None)
+        result = yield pending
+
+        assert 'c8ab01' in known_namespaces()
+
+    assert result == ['my response', 'my response']
+    assert create_namespace.call_count == 1
+    assert fetch.call_count == 4
+
+
+@patch('repository.models.framework.db.create_namespace', return_value=make_future(None))
+@patch('repository.models.framework.db._namespace_url', return_value='https://localhost:8000/bigdata/namespace/c8ab01')
+@patch('repository.models.framework.db.AsyncHTTPClient.fetch')
+@gen_test
+def test_request_namespace_created_since_sent(fetch, url, create_namespace):
+    def created_meanwhile(*args, **kwargs):
+        fetch.side_effect = None
+        fetch.return_value = make_future('my response')
+        _known_namespaces['c8ab01'] = time.time() + 1
+        raise httpclient.HTTPError(404, 'Not Found')
+
+    fetch.side_effect = created_meanwhile
+
+    with patch.dict('repository.models.framework.db._known_namespaces', clear=True):
+        result = yield request(None, 'c8ab01', 'pay load')
+
+    assert result == 'my response'
+    assert not create_namespace.called
+    assert fetch.call_count == 2
+
+
+@patch('repository.models.framework.db.AsyncHTTPClient.fetch')
+@gen_test
+def test_warm_namespaces(fetch):
+    fetch.return_value = make_future(Mock(body=NAMESPACE_LISTING))
+
+    with patch.dict('repository.models.framework.db._known_namespaces', clear=True):
+        yield warm_namespaces()
+
+        assert known_namespaces() == {'kb', 'c8ab02'}
+
+    assert fetch.call_args[1]['method'] == 'GET'
+
+
+@patch('repository.models.framework.db.logging.warning')
+@patch('repository.models.framework.db.AsyncHTTPClient.fetch')
+@gen_test
+def test_warm_namespaces_error(fetch, warning):
+    fetch.side_effect = httpclient.HTTPError(599, 'Timeout')
+
+    with patch.dict('repository.models.framework.db._known_namespaces', clear=True):
+        yield warm_namespaces()
+
+        assert known_namespaces() == set()
+
+    assert warning.called
+
+
+def test_streaming_arguments_none():
+    assert _streaming_arguments(None) == {}
+
+
+def test_streaming_arguments_successful_response():
+    chunks = []
+    kwargs = _streaming_arguments(chunks.append)
+
+    kwargs['header_callback']('HTTP/1.1 200 OK\r\n')
+    kwargs['header_callback']('Content-Type: text/tab-separated-values\r\n')
+    kwargs['streaming_callback'](b'?id\n')
+    kwargs['streaming_callback'](b'<http://x/a1>\n')
+
+    assert chunks == [b'?id\n', b'<http://x/a1>\n']
+
+
+def test_streaming_arguments_error_response():
+    chunks = []
+    kwargs = _streaming_arguments(chunks.append)
+
+    kwargs['header_callback']('HTTP/1.1 404 Not Found\r\n')
+    kwargs['streaming_callback'](b'Namespace does not exist')
+
+    assert chunks == []
+
+
+@patch('repository.models.framework.db._namespace_url', return_value='https://localhost:8000/bigdata/namespace/c8ab01')
+@patch('repository.models.framework.db.AsyncHTTPClient.fetch', return_value=make_future('my response'))
+@gen_test
+def test_request_streaming_callback(fetch, url):
+    chunks = []
+    yield request('query', 'c8ab01', 'pay load', response_type='tsv', streaming_callback=chunks.append)
+
+    kwargs = fetch.call_args[1]
+    kwargs['header_callback']('HTTP/1.1 200 OK\r\n')
+    kwargs['streaming_callback'](b'?id\n')
+    assert chunks == [b'?id\n']
+    assert kwargs['headers'] == {'Accept': 'text/tab-separated-values'}
+
+
+@patch('repository.models.framework.db._namespace_url', return_value='https://localhost:8000/bigdata/namespace/c8ab01')
+@patch('repository.models.framework.db.AsyncHTTPClient.fetch', return_value=make_future('my response'))
+@gen_test
+def test_request_streams_file(fetch, url):
+    upload = tempfile.TemporaryFile()
+    upload.write(b'x' * (UPLOAD_CHUNK_SIZE + 10))
+
+    yield request(None, 'c8ab01', upload, content_type='application/xml')
+
+    kwargs = fetch.call_args[1]
+    assert 'body' not in kwargs
+    assert kwargs['headers'] == {'Content-Type': 'application/xml', 'Content-Length': str(UPLOAD_CHUNK_SIZE + 10)}
+
+    chunks = []
+
+    def write(chunk):
+        chunks.append(chunk)
+        return make_future(None)
+
+    yield kwargs['body_producer'](write)
+    assert [len(x) for x in chunks] == [UPLOAD_CHUNK_SIZE, 10]
+    assert not upload.closed
+
+
+@patch('repository.models.framework.db._namespace_url', return_value='https://localhost:8000/bigdata/namespace/c8ab01')
+@patch('repository.models.framework.db.AsyncHTTPClient.fetch', return_value=make_future('my response'))
+@gen_test
+def test_request_streams_file_with_upload_client(fetch, url):
+    upload = tempfile.TemporaryFile()
+    upload.write(b'data')
+
+    with patch('repository.models.framework.db.http_client') as http_client:
+        yield request(None, 'c8ab01', upload)
+
+    assert not http_client.called
+    assert fetch.call_args[0][0] == 'https://localhost:8000/bigdata/namespace/c8ab01'
+
+
+def test_upload_client_shared_per_ioloop():
+    assert upload_client() is upload_client()
+    assert upload_client() is not http_client()
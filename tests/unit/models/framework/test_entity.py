@@ -13,7 +13,7 @@ import json
 import rdflib
 from koi.test_helpers import make_future, gen_test
 
-from repository.models.framework.entity import Entity
+from repository.models.framework.entity import Entity, filter_existing, split_predicate_path
 from repository.models.framework.helper import solve_ns, future_wrap
 # use this for accessing internal nodes of the ontology
 _entities = {}
@@ -61,6 +61,28 @@ def test_entity_copy_change_multiple_id():
     assert ng[1][2] != entity_id2
 
 
+@gen_test
+def test_entity_copy_graph():
+    entity_id = solve_ns("id:01234")
+    entity_id2 = solve_ns("id:23456")
+    g = rdflib.Graph()
+
+    class TestEntity(Entity):
+        CLASS = "hub:Test"
+        STRUCT_SELECT = """ SELECT DISTINCT ?s {{ {id} (hub:pred)? ?s . }} """
+
+    g.add((entity_id, rdflib.RDF.type, solve_ns("hub:Test")))
+    g.add((entity_id, solve_ns("hub:pred"), entity_id2))
+    g.add((entity_id2, solve_ns("hub:pred"), entity_id))
+    ng = yield TestEntity.copy_graph(g, entity_id)
+
+    subjects = set(ng.subjects())
+    assert len(ng) == 3
+    assert len(subjects) == 2
+    assert not subjects & {entity_id, entity_id2}
+    assert set(ng.objects(predicate=solve_ns("hub:pred"))) == subjects
+
+
 def test_entity_entity_memoizes():
     assert entity("id:Test") is entity("id:Test")
 
@@ -145,3 +167,50 @@ def test_set_get_match_attr():
     yield e.set_attr(wg, entity_id, "hub:pred1", r'\xe3\x83\x81\xe3\x83\xa7\xe3\x82\xb3\xe3\x83\x81\xe3\x83\xa7\xe3\x82\xb3'.decode('utf8'), "xsd:string")
     r = yield e.get_attr(wg, entity_id, "hub:pred1")
     assert(str(r[0]).decode('utf8') == r'\xe3\x83\x81\xe3\x83\xa7\xe3\x82\xb3\xe3\x83\x81\xe3\x83\xa7\xe3\x82\xb3')
+
+
+def json_graphdb(graph):
+    """Wrap a graph as a database answering SELECT queries in JSON"""
+    class Response(object):
+        def __init__(self, body):
+            self.body = body
+
+    def query(query, response_type=None):
+        return make_future(Response(graph.query(query).serialize(format='json')))
+
+    class Database(object):
+        pass
+
+    db = Database()
+    db.query = query
+    return db
+
+
+@gen_test
+def test_filter_existing():
+    asset = entity("op:Asset")
+    set_ = entity("op:Set")
+    g = rdflib.Graph()
+    g.add((solve_ns("id:a1"), rdflib.RDF.type, solve_ns("op:Asset")))
+    g.add((solve_ns("id:51"), rdflib.RDF.type, solve_ns("op:Set")))
+
+    r = yield filter_existing(json_graphdb(g), [(set_, "id:51"), (asset, "id:a1"), (asset, "id:a2"),
+                                                (asset, "id:51"), (asset, "id:a1")])
+
+    assert r == {(set_, "id:51"), (asset, "id:a1")}
+
+
+@gen_test
+def test_filter_existing_no_entities():
+    r = yield filter_existing(None, [])
+    assert r == set()
+
+
+def test_split_predicate_path():
+    path = '(<http://openpermissions.org/definedBy>|rdf:type/<http://openpermissions.org/definedBy>)/op:comment'
+
+    assert split_predicate_path(path) == (
+        '(<http://openpermissions.org/definedBy>|rdf:type/<http://openpermissions.org/definedBy>)', 'op:comment')
+    assert split_predicate_path('dcterm:title') == ('dcterm:title',)
+    assert split_predicate_path(path) is split_predicate_path(path)
+
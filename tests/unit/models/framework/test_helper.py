@@ -11,11 +11,12 @@ from __future__ import unicode_literals
 
 import os
 import pytest
+import rdflib
+import tempfile
+from koi.test_helpers import gen_test
+from mock import MagicMock, patch
 
-from repository.models.framework import helper
-
-
-
+from repository.models.framework import helper, workers
 
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), '../../..', 'data')
@@ -52,3 +53,215 @@ def test_validate_with_no_request_body_data():
     with pytest.raises(helper.ValidationException) as exc:
         helper.validate(data)
     assert exc.value.args[0].startswith("error while parsing data")
+
+
+@patch('repository.models.framework.helper.validate', wraps=helper.validate)
+def test_parsed_payload_parses_once(validate):
+    with open(valid_examples[0][0], 'r') as f:
+        payload = helper.ParsedPayload(f.read(), 'application/xml')
+
+    assert payload.graph is payload.validate()
+    assert validate.call_count == 1
+
+
+def test_parsed_payload_uses_given_graph():
+    graph = MagicMock()
+    payload = helper.ParsedPayload('data', 'text/rdf+n3', graph=graph)
+
+    assert payload.graph is graph
+    assert payload.serialize() == ('data', 'text/rdf+n3')
+
+
+def test_parsed_payload_json_ld_serialized_as_xml():
+    data = '{"@id": "http://openpermissions.org/ns/id/a1", "@type": "http://openpermissions.org/ns/op/1.1/Asset"}'
+    payload = helper.ParsedPayload(data, 'application/ld+json')
+
+    data, content_type = payload.serialize()
+    assert content_type == 'application/xml'
+    assert 'http://openpermissions.org/ns/id/a1' in data
+
+
+@gen_test
+def test_parse_on_workers():
+    pool = workers.WorkerPool(2)
+    with open(valid_examples[0][0], 'r') as f:
+        data = f.read()
+
+    try:
+        with patch.object(workers, '_pool', pool):
+            graph = yield helper.parse(data, format='xml')
+    finally:
+        pool.close()
+
+    assert len(graph) > 0
+    assert pool.stats()['completed'] == 1
+
+
+@gen_test
+def test_parse_invalid_on_workers():
+    pool = workers.WorkerPool(2)
+    with open(invalid_examples[1][0], 'r') as f:
+        data = f.read()
+
+    try:
+        with patch.object(workers, '_pool', pool):
+            with pytest.raises(helper.ValidationException):
+                yield helper.parse(data, format='xml')
+    finally:
+        pool.close()
+
+
+@gen_test
+def test_parsed_payload_load_json_ld():
+    pool = workers.WorkerPool(2)
+    data = '{"@id": "http://openpermissions.org/ns/id/a1", "@type": "http://openpermissions.org/ns/op/1.1/Asset"}'
+    payload = helper.ParsedPayload(data, 'application/ld+json')
+
+    try:
+        with patch.object(workers, '_pool', pool):
+            graph = yield payload.load()
+    finally:
+        pool.close()
+
+    assert payload.graph is graph
+    assert pool.stats()['completed'] == 2
+    data, content_type = payload.serialize()
+    assert content_type == 'application/xml'
+    assert 'http://openpermissions.org/ns/id/a1' in data
+    assert pool.stats()['completed'] == 2
+
+
+def test_parsed_payload_query_memoised():
+    graph = MagicMock()
+    graph.query.return_value = iter([1, 2])
+    payload = helper.ParsedPayload('data', graph=graph)
+
+    assert payload.query('SELECT') == [1, 2]
+    assert payload.query('SELECT') == [1, 2]
+    assert graph.query.call_count == 1
+
+
+def test_tsv_result_stream_split_chunks():
+    rows = []
+    stream = helper.TSVResultStream(rows.append)
+
+    stream.feed(b'?id\t?value\t?modified\r\n<http://openpermissions.org/ns/id/a1>\t"caf\xc3\xa9"\t')
+    assert rows == []
+
+    stream.feed(b'"2016-01-01T10:00:00Z"^^<http://www.w3.org/2001/XMLSchema#dateTime>\n<http://openpermissions.org/')
+    stream.feed(b'ns/id/b2>\t"1"\t')
+    stream.close()
+
+    assert stream.variables == ['id', 'value', 'modified']
+    assert stream.rows == 2
+    assert rows[0][0] == rdflib.URIRef('http://openpermissions.org/ns/id/a1')
+    assert rows[0][1] == rdflib.Literal('café')
+    assert rows[0][2].toPython().isoformat() == '2016-01-01T10:00:00+00:00'
+    assert rows[1] == [rdflib.URIRef('http://openpermissions.org/ns/id/b2'), rdflib.Literal('1'), None]
+
+
+def test_tsv_result_stream_no_results():
+    rows = []
+    stream = helper.TSVResultStream(rows.append)
+    stream.feed(b'?id\t?value\n')
+    stream.close()
+
+    assert stream.rows == 0
+    assert rows == []
+
+
+def test_filtered_graph_keeps_predicates_and_types():
+    graph = helper.FilteredGraph([rdflib.RDFS.label], types=[rdflib.OWL.Class])
+    subject = rdflib.URIRef('http://example.com/a')
+
+    graph.add((subject, rdflib.RDFS.label, rdflib.Literal('a')))
+    graph.add((subject, rdflib.RDFS.comment, rdflib.Literal('b')))
+    graph.add((subject, rdflib.RDF.type, rdflib.OWL.Class))
+    graph.add((subject, rdflib.RDF.type, rdflib.OWL.Thing))
+
+    assert graph.parsed == 4
+    assert set(graph) == {(subject, rdflib.RDFS.label, rdflib.Literal('a')),
+                          (subject, rdflib.RDF.type, rdflib.OWL.Class)}
+
+
+@pytest.mark.parametrize('filename,format', [(f, 'xml' if f.endswith('.xml') else 'turtle')
+                                             for f, _ in valid_examples])
+def test_parse_file_leaves_file_open(filename, format):
+    upload = tempfile.TemporaryFile()
+    with open(filename) as f:
+        upload.write(f.read())
+
+    graph = helper.parse_file(upload, rdflib.Graph(), format)
+
+    assert len(graph)
+    assert not upload.closed
+
+
+@pytest.mark.parametrize('filename,format', [x for x in invalid_examples if x[1]])
+def test_parse_file_invalid(filename, format):
+    upload = tempfile.TemporaryFile()
+    with open(filename) as f:
+        upload.write(f.read())
+
+    with pytest.raises(helper.ValidationException):
+        helper.parse_file(upload, rdflib.Graph(), format)
+
+
+def _parse_strings(chunks, key='assets'):
+    items = []
+    parser = helper.JSONStringsStream(items.append, key=key)
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+    return items
+
+
+@pytest.mark.parametrize('chunks,key', [
+    ([b'{"title": "x", "assets": ["a1", ', b'"a2", "a', b'3"], "other": {"assets": 1}}'], 'assets'),
+    ([b' [ "a1" ,"a2",', b'"a3" ] \n'], None),
+    ([b'{"other": {"assets": ["x1"]}, "title": "\\"assets\\": [", ', b'"assets": ["a1", "a2", "a3"]}'], 'assets'),
+    ([b'{"other": ["assets", ["x1"]], "a', b'ssets"', b' :', b' ["a1", "a2", "a3"]}'], 'assets'),
+])
+def test_json_strings_stream(chunks, key):
+    assert _parse_strings(chunks, key) == ['a1', 'a2', 'a3']
+
+
+def test_json_strings_stream_empty():
+    assert _parse_strings([b'{"assets": [ ]}']) == []
+
+
+@pytest.mark.parametrize('body', [
+    b'{"assets": ["a1"]} trailing',
+    b'{"assets": ["a1"]}}',
+    b'{"assets": ["a1"],}',
+    b'{"assets": ["a1",, "a2"]}',
+    b'{"assets": [, "a1"]}',
+    b'{"assets": ["a1", ]}',
+    b'{"assets": ["a1" "a2"]}',
+    b'{"assets": ["a1", 2]}',
+    b'{"assets": ["\\x"]}',
+    b'{"other": {"assets": ["a1"]}}',
+    b'{"assets": ["a1"], "assets": ["a2"]}',
+    b'{"assets": ["a1"]',
+    b'{"assets": ["a1"',
+])
+def test_json_strings_stream_invalid(body):
+    with pytest.raises(helper.ValidationException):
+        _parse_strings([body[:7], body[7:]])
+
+
+@pytest.mark.parametrize('body,key', [
+    (b'{"other": {"assets": ["a1"]}}', 'assets'),
+    (b'{"title" "x", "assets": ["a1"]}', 'assets'),
+    (b'{"title": "x" "assets": ["a1"]}', 'assets'),
+    (b'{"title": ["x"}, "assets": ["a1"]}', 'assets'),
+    (b'{"assets": "a1"}', 'assets'),
+    (b'["assets", {"assets": ["a1"]}]', 'assets'),
+    (b'{"assets": ["a1"]}', None),
+])
+def test_json_strings_stream_invalid_before_items(body, key):
+    items = []
+    parser = helper.JSONStringsStream(items.append, key=key)
+    with pytest.raises(helper.ValidationException):
+        parser.feed(body)
+    assert items == []
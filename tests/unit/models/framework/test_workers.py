@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+
+from __future__ import unicode_literals
+import threading
+
+import pytest
+from koi.test_helpers import gen_test
+
+from repository.models.framework import workers
+
+
+def current_thread():
+    return threading.current_thread().ident
+
+
+@gen_test
+def test_run_on_thread():
+    pool = workers.WorkerPool(2)
+    try:
+        result = yield pool.run(10, current_thread)
+
+        assert result != current_thread()
+        assert pool.stats() == {
+            'size': 2,
+            'min_size': 0,
+            'pending': 0,
+            'max_pending': 1,
+            'submitted': 1,
+            'completed': 1,
+            'failed': 0,
+            'inline': 0
+        }
+    finally:
+        pool.close()
+
+
+@gen_test
+def test_run_error():
+    pool = workers.WorkerPool(2)
+    try:
+        def fail():
+            raise ValueError('invalid')
+
+        with pytest.raises(ValueError):
+            yield pool.run(10, fail)
+
+        assert pool.stats()['failed'] == 1
+    finally:
+        pool.close()
+
+
+@gen_test
+def test_run_arguments():
+    pool = workers.WorkerPool(2)
+    try:
+        result = yield pool.run(10, sorted, [3, 1, 2], reverse=True)
+
+        assert result == [3, 2, 1]
+    finally:
+        pool.close()
+
+
+@gen_test
+def test_run_pending():
+    pool = workers.WorkerPool(2)
+    try:
+        event = threading.Event()
+        futures = [pool.run(10, event.wait, 1) for _ in range(3)]
+
+        assert pool.stats()['pending'] == 3
+        event.set()
+        yield futures
+
+        assert pool.stats()['pending'] == 0
+        assert pool.stats()['max_pending'] == 3
+    finally:
+        pool.close()
+
+
+@gen_test
+def test_run_small_data_inline():
+    pool = workers.WorkerPool(2, min_size=100)
+    try:
+        result = yield pool.run(10, current_thread)
+    finally:
+        pool.close()
+
+    assert result == current_thread()
+    assert pool.stats()['inline'] == 1
+    assert pool.stats()['submitted'] == 0
+
+
+@gen_test
+def test_run_without_threads():
+    pool = workers.WorkerPool(0)
+
+    result = yield pool.run(10, current_thread)
+
+    assert result == current_thread()
+    assert pool.stats()['inline'] == 1
+
+
+@gen_test
+def test_run_inline_error():
+    pool = workers.WorkerPool(0)
+
+    def fail():
+        raise ValueError('invalid')
+
+    with pytest.raises(ValueError):
+        yield pool.run(10, fail)
@@ -15,34 +15,42 @@ from datetime import datetime
 from StringIO import StringIO
 import uuid
 import os
+import pytest
+import tempfile
+import rdflib
+from koi.exceptions import HTTPError
 from mock import patch, Mock, MagicMock
+from tornado.concurrent import Future
+from tornado.httpclient import HTTPError as ClientError
+from tornado.gen import sleep
 from tornado.ioloop import IOLoop
 from koi.test_helpers import gen_test, make_future
 from repository.models.asset import store, send_notification
 from repository.models import asset
+from repository.models.framework import helper
 from repository.models.framework.db import DatabaseConnection
 
 from .util import create_mockdb
 
 
 ASSET_TEMPLATE = """
-_:Id1_d435a6cdd786300dff204ee7c2ef942d3e9034e2_N28_ad0d7ec34e9135c60ece82d3d231d0e0c75a6a46_N30 <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.0/Id> .
+_:Id1_d435a6cdd786300dff204ee7c2ef942d3e9034e2_N28_ad0d7ec34e9135c60ece82d3d231d0e0c75a6a46_N30 <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Id> .
 <{hub_key}> <http://openpermissions.org/ns/opex/0.1/distributedBy> <https://openpermissions.org/s0/hub1/party/pid/testco> .
-_:Id1_8f21840a222b74b97016b6a91781ac43414356d7_N33_8707c18164e538ad0dbbea652968661c2f7f9b0d_N32 <http://openpermissions.org/ns/op/1.0/value> "e48e2bb8-bda5-424e-885d-c2ffec1fe887" .
-<{hub_key}> <http://openpermissions.org/ns/op/1.0/description> "Deer" .
-<https://openpermissions.org/s0/hub1/party/rightsourceid/RightSource1> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.0/Party> .
-_:Id1_d435a6cdd786300dff204ee7c2ef942d3e9034e2_N28_ad0d7ec34e9135c60ece82d3d231d0e0c75a6a46_N30 <http://openpermissions.org/ns/op/1.0/value> "23" .
-<{hub_key}> <http://openpermissions.org/ns/op/1.0/alsoIdentifiedBy> _:Id1_d435a6cdd786300dff204ee7c2ef942d3e9034e2_N28_ad0d7ec34e9135c60ece82d3d231d0e0c75a6a46_N30 .
-<https://openpermissions.org/s0/hub1/right/bapla/hk/12> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.0/Policy> .
+_:Id1_8f21840a222b74b97016b6a91781ac43414356d7_N33_8707c18164e538ad0dbbea652968661c2f7f9b0d_N32 <http://openpermissions.org/ns/op/1.1/value> "e48e2bb8-bda5-424e-885d-c2ffec1fe887" .
+<{hub_key}> <http://openpermissions.org/ns/op/1.1/description> "Deer" .
+<https://openpermissions.org/s0/hub1/party/rightsourceid/RightSource1> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Party> .
+_:Id1_d435a6cdd786300dff204ee7c2ef942d3e9034e2_N28_ad0d7ec34e9135c60ece82d3d231d0e0c75a6a46_N30 <http://openpermissions.org/ns/op/1.1/value> "23" .
+<{hub_key}> <http://openpermissions.org/ns/op/1.1/alsoIdentifiedBy> _:Id1_d435a6cdd786300dff204ee7c2ef942d3e9034e2_N28_ad0d7ec34e9135c60ece82d3d231d0e0c75a6a46_N30 .
+<https://openpermissions.org/s0/hub1/right/bapla/hk/12> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Policy> .
 <{hub_key}> <http://openpermissions.org/ns/opex/0.1/explicitOffer> <https://openpermissions.org/s0/hub1/right/bapla/hk/11> .
-<{hub_key}> <http://openpermissions.org/ns/op/1.0/alsoIdentifiedBy> _:Id1_8f21840a222b74b97016b6a91781ac43414356d7_N33_8707c18164e538ad0dbbea652968661c2f7f9b0d_N32 .
+<{hub_key}> <http://openpermissions.org/ns/op/1.1/alsoIdentifiedBy> _:Id1_8f21840a222b74b97016b6a91781ac43414356d7_N33_8707c18164e538ad0dbbea652968661c2f7f9b0d_N32 .
 <{hub_key}> <http://openpermissions.org/ns/opex/0.1/suppliedBy> <https://openpermissions.org/s0/hub1/party/rightsourceid/RightSource1> .
-<https://openpermissions.org/s0/hub1/right/bapla/hk/11> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.0/Policy> .
-_:Id1_d435a6cdd786300dff204ee7c2ef942d3e9034e2_N28_ad0d7ec34e9135c60ece82d3d231d0e0c75a6a46_N30 <http://openpermissions.org/ns/op/1.0/id_type> "testcopictureid" .
-<https://openpermissions.org/s0/hub1/party/pid/testco> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.0/Party> .
-<{hub_key}> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.0/Asset> .
-_:Id1_8f21840a222b74b97016b6a91781ac43414356d7_N33_8707c18164e538ad0dbbea652968661c2f7f9b0d_N32 <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.0/Id> .
-_:Id1_8f21840a222b74b97016b6a91781ac43414356d7_N33_8707c18164e538ad0dbbea652968661c2f7f9b0d_N32 <http://openpermissions.org/ns/op/1.0/id_type> "picscoutpictureid" .
+<https://openpermissions.org/s0/hub1/right/bapla/hk/11> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Policy> .
+_:Id1_d435a6cdd786300dff204ee7c2ef942d3e9034e2_N28_ad0d7ec34e9135c60ece82d3d231d0e0c75a6a46_N30 <http://openpermissions.org/ns/op/1.1/id_type> "testcopictureid" .
+<https://openpermissions.org/s0/hub1/party/pid/testco> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Party> .
+<{hub_key}> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Asset> .
+_:Id1_8f21840a222b74b97016b6a91781ac43414356d7_N33_8707c18164e538ad0dbbea652968661c2f7f9b0d_N32 <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Id> .
+_:Id1_8f21840a222b74b97016b6a91781ac43414356d7_N33_8707c18164e538ad0dbbea652968661c2f7f9b0d_N32 <http://openpermissions.org/ns/op/1.1/id_type> "picscoutpictureid" .
 <{hub_key}> <http://openpermissions.org/ns/opex/0.1/explicitOffer> <https://openpermissions.org/s0/hub1/right/bapla/hk/12> .
 """
 
@@ -50,6 +58,12 @@ FIXTURE_DIR = os.path.join(os.path.dirname(__file__), '../..', 'data')
 TEST_NAMESPACE = 'c8ab01'
 
 
+@pytest.fixture(autouse=True)
+def reset_notifications(monkeypatch):
+    monkeypatch.setattr(asset, '_notification_scheduler', None)
+    monkeypatch.setattr(asset, '_index_delete_queue', None)
+
+
 def get_valid_xml():
     with open(os.path.abspath(os.path.join(FIXTURE_DIR, 'sample.xml')), 'r') as fr:
         return fr.read()
@@ -87,11 +101,10 @@ def test_store_db_called(get_asset_ids, send_notification):
 @gen_test
 def test_store_db_called_with_content_type(get_asset_ids, send_notification):
     db = create_mockdb()
-    yield store(db, 'valid_json_data',
-        content_type='application/json')
-    db.store.assert_called_once_with(
-        'valid_json_data',
-        content_type='application/json')
+    hub_key = 'https://openpermissions.org/s0/hub1/asset/testco/testcopictureid/{}'.format(uuid.uuid4())
+    doc = ASSET_TEMPLATE.format(hub_key=hub_key)
+    yield store(db, doc, content_type='text/rdf+n3')
+    db.store.assert_called_once_with(doc, content_type='text/rdf+n3')
 
 
 @patch('repository.models.asset.get_asset_ids', return_value=[])
@@ -100,32 +113,46 @@ def test_store_db_called_with_content_type(get_asset_ids, send_notification):
 def test_store_notification_sent(IOLoop, get_asset_ids):
     db = create_mockdb()
     yield store(db, get_valid_xml())
-    assert IOLoop.current().spawn_callback.called_once
+    assert IOLoop.current().call_later.call_count == 1
+
 
 @patch('repository.models.asset.get_asset_ids', return_value=[])
 @patch('repository.models.asset.IOLoop')
+@gen_test
+def test_store_notifications_folded(IOLoop, get_asset_ids):
+    db = create_mockdb()
+    yield store(db, get_valid_xml())
+    yield store(db, get_valid_xml())
+
+    assert IOLoop.current().call_later.call_count == 1
+    assert asset.notification_scheduler().stats()['folded'] == 1
+
+@patch('repository.models.asset.get_asset_ids', return_value=[])
+@patch('repository.models.asset.IOLoop')
+@patch('repository.models.asset.notification_scheduler')
 @patch('repository.models.asset.options')
 @gen_test
-def test_store_notification_not_sent_in_standalone_mode(options, IOLoop, get_asset_ids):
+def test_store_notification_not_sent_in_standalone_mode(options, notification_scheduler, IOLoop, get_asset_ids):
     options.standalone = True
     db = create_mockdb()
     yield store(db, get_valid_xml())
-    assert not IOLoop.current().spawn_callback.called
+    assert not notification_scheduler().notify.called
+    assert not IOLoop.current().call_later.called
 
 @patch('repository.models.asset.send_notification', return_value=make_future(None))
-@patch('repository.models.asset.get_asset_ids', return_value=[{'entity_id':  'res'}])
+@patch('repository.models.asset.get_asset_ids', return_value=[{'entity_id':  'fa0'}])
 @gen_test
 def test_store_return_value(get_asset_ids, send_notification):
     db = create_mockdb()
     result = yield store(db, get_valid_xml())
-    assert result == [{'entity_id':  'res'}]
+    assert result == [{'entity_id':  'fa0'}]
 
 
-@patch('repository.models.asset.get_token', return_value=make_future('token1234'))
-@patch('repository.models.asset.API')
+@patch('repository.models.framework.clients.service_token', return_value=make_future('token1234'))
+@patch('repository.models.framework.clients.client')
 @patch('repository.models.asset.options')
 @gen_test
-def test_notification(options, API, get_token):
+def test_notification(options, API, service_token):
     db = create_mockdb()
     options.service_id = 'a test service ID'
     client = API()
@@ -151,20 +178,21 @@ def test_notification(options, API, get_token):
         body=body
     )
 
-    assert get_token.called
+    assert service_token.called
+    assert API.call_args[1]['token'] == 'token1234'
     assert client.index.notifications.post.called
 
 
-@patch('repository.models.asset.get_token')
+@patch('repository.models.framework.clients.service_token')
 @patch('repository.models.asset.logging')
-@patch('repository.models.asset.API')
+@patch('repository.models.framework.clients.client')
 @patch('repository.models.asset.options')
 @gen_test
-def test_notification_get_token_error(options, API, logging, get_token):
+def test_notification_get_token_error(options, API, logging, service_token):
     options.service_id = 'a test service ID'
     client = API()
     db = create_mockdb()
-    get_token.side_effect = Exception
+    service_token.side_effect = Exception
 
     yield send_notification(db)
 
@@ -173,6 +201,195 @@ def test_notification_get_token_error(options, API, logging, get_token):
     assert logging.exception.called
 
 
+@patch('repository.models.framework.clients.drop_service_token')
+@patch('repository.models.framework.clients.service_token', return_value=make_future('token1234'))
+@patch('repository.models.asset.logging')
+@patch('repository.models.framework.clients.client')
+@patch('repository.models.asset.options')
+@gen_test
+def test_notification_unauthorized_token_dropped(options, API, logging, service_token, drop_service_token):
+    client = API()
+    client.index.notifications.post.side_effect = ClientError(401)
+
+    yield send_notification(create_mockdb())
+
+    assert drop_service_token.called
+    assert logging.exception.called
+
+
+@gen_test
+def test_notification_scheduler_folds_notifications():
+    send = Mock(return_value=make_future(None))
+    scheduler = asset.NotificationScheduler(send, 0.01, 10)
+    db1 = create_mockdb()
+    db2 = create_mockdb()
+    db2.repository_id = 'other'
+
+    scheduler.notify(db1)
+    scheduler.notify(db1)
+    scheduler.notify(db2)
+    yield sleep(0.05)
+
+    assert sorted(call[0][0].repository_id for call in send.call_args_list) == sorted(
+        [db1.repository_id, 'other'])
+    assert scheduler.stats() == {'pending': 0, 'scheduled': 2, 'folded': 1, 'sent': 2}
+
+
+@gen_test
+def test_notification_scheduler_bounds_outstanding():
+    pending = Future()
+    send = Mock(return_value=pending)
+    scheduler = asset.NotificationScheduler(send, 0, 1)
+    db1 = create_mockdb()
+    db2 = create_mockdb()
+    db2.repository_id = 'other'
+
+    scheduler.notify(db1)
+    scheduler.notify(db2)
+    yield sleep(0.01)
+    assert send.call_count == 1
+
+    # folded into the waiting notification
+    scheduler.notify(db2)
+    send.return_value = make_future(None)
+    pending.set_result(None)
+    yield sleep(0.01)
+
+    assert send.call_count == 2
+    assert scheduler.stats()['folded'] == 1
+
+
+@patch('repository.models.asset.logging')
+@gen_test
+def test_notification_scheduler_send_error(logging):
+    send = Mock(side_effect=Exception)
+    scheduler = asset.NotificationScheduler(send, 0, 1)
+    db = create_mockdb()
+
+    scheduler.notify(db)
+    yield sleep(0.01)
+    scheduler.notify(db)
+    yield sleep(0.01)
+
+    assert send.call_count == 2
+    assert logging.exception.called
+
+
+@patch('repository.models.framework.clients.service_token', return_value=make_future('token1234'))
+@patch('repository.models.framework.clients.client')
+@patch('repository.models.asset.options')
+@gen_test
+def test_delete_from_index(options, API, service_token):
+    client = API()
+    repositories = client.index['entity-types']['asset']['id-types']['t1,t2'].ids['a,b'].repositories
+    repositories['c8ab01'].delete.return_value = make_future(None)
+    db = create_mockdb()
+    db.repository_id = 'c8ab01'
+    ids = [{'source_id_type': 't1', 'source_id': 'a'}, {'source_id_type': 't2', 'source_id': 'b'}]
+
+    yield asset.delete_from_index(db, ids)
+    yield asset.delete_from_index(db, ids)
+
+    assert repositories['c8ab01'].delete.call_count == 2
+
+
+@patch('repository.models.framework.clients.drop_service_token')
+@patch('repository.models.framework.clients.service_token', return_value=make_future('token1234'))
+@patch('repository.models.framework.clients.client')
+@patch('repository.models.asset.options')
+@gen_test
+def test_delete_from_index_error(options, API, service_token, drop_service_token):
+    client = API()
+    repositories = client.index['entity-types']['asset']['id-types']['t1'].ids['a'].repositories
+    repositories['c8ab01'].delete.side_effect = ClientError(401)
+    db = create_mockdb()
+    db.repository_id = 'c8ab01'
+
+    with pytest.raises(ClientError):
+        yield asset.delete_from_index(db, [{'source_id_type': 't1', 'source_id': 'a'}])
+
+    assert drop_service_token.called
+
+
+def _source_ids(count, offset=0):
+    return [{'source_id_type': 't', 'source_id': str(i)} for i in range(offset, offset + count)]
+
+
+@gen_test
+def test_index_delete_queue_batches_ids():
+    send = Mock(return_value=make_future(None))
+    queue = asset.IndexDeleteQueue(send, 2, 10, 3, 0)
+    db = create_mockdb()
+
+    queue.delete(db, _source_ids(3))
+    queue.delete(db, _source_ids(2, 3))
+    queue.delete(db, [])
+    yield sleep(0.01)
+
+    batches = [call[0][1] for call in send.call_args_list]
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert sum(batches, []) == _source_ids(5)
+    assert queue.stats() == {'pending': 0, 'queued': 5, 'sent': 3, 'retried': 0, 'failed': 0}
+
+
+@gen_test
+def test_index_delete_queue_retries_failed_batch():
+    send = Mock(side_effect=[Exception('connection refused'), ClientError(503), make_future(None)])
+    queue = asset.IndexDeleteQueue(send, 10, 1, 3, 0.001)
+
+    queue.delete(create_mockdb(), _source_ids(1))
+    yield sleep(0.05)
+
+    assert send.call_count == 3
+    assert queue.stats()['sent'] == 1
+    assert queue.stats()['retried'] == 2
+
+
+@patch('repository.models.asset.logging')
+@gen_test
+def test_index_delete_queue_gives_up(logging):
+    send = Mock(side_effect=ClientError(503))
+    queue = asset.IndexDeleteQueue(send, 10, 1, 2, 0.001)
+
+    queue.delete(create_mockdb(), _source_ids(1))
+    yield sleep(0.05)
+
+    assert send.call_count == 3
+    assert queue.stats()['failed'] == 1
+    assert logging.error.called
+
+
+@patch('repository.models.asset.logging')
+@gen_test
+def test_index_delete_queue_does_not_retry_client_error(logging):
+    send = Mock(side_effect=ClientError(400))
+    queue = asset.IndexDeleteQueue(send, 10, 1, 3, 0.001)
+
+    queue.delete(create_mockdb(), _source_ids(1))
+    yield sleep(0.05)
+
+    assert send.call_count == 1
+    assert queue.stats()['failed'] == 1
+
+
+@patch('repository.models.asset.index_delete_queue')
+@patch('repository.models.asset.Asset._delete', return_value=make_future(None))
+@patch('repository.models.asset.get_asset_source_ids')
+@patch('repository.models.asset.get_asset_ids', return_value=[{'entity_id': 'e1'}, {'entity_id': 'e2'}])
+@gen_test
+def test_before_store_queues_index_deletes(get_asset_ids, get_asset_source_ids, _delete, index_delete_queue):
+    get_asset_source_ids.side_effect = lambda payload, content_type, entity_id: [
+        {'source_id_type': 't', 'source_id': entity_id}]
+    db = create_mockdb()
+
+    yield asset.Asset.before_store('payload', 'text/turtle', db)
+
+    index_delete_queue().delete.assert_any_call(db, [{'source_id_type': 't', 'source_id': 'e1'}])
+    index_delete_queue().delete.assert_any_call(db, [{'source_id_type': 't', 'source_id': 'e2'}])
+    _delete.assert_called_once_with(db, [[{'source_id_type': 't', 'source_id': 'e1'}],
+                                         [{'source_id_type': 't', 'source_id': 'e2'}]])
+
+
 ###############################################################################
 # exists                                                                      #
 ###############################################################################
@@ -240,6 +457,19 @@ def test_insert_timestamps_multiple_ids_update_called():
     assert db.update.call_count == 1
 
 
+@gen_test
+def test_insert_timestamps_on_entity():
+    db = create_mockdb()
+    db.update.return_value = make_future('')
+
+    yield asset.insert_timestamps(db, ['a11bee', 'id:a11bef'])
+
+    query = db.update.call_args[0][0]
+    assert 'id:a11bee dcterm:modified' in query
+    assert 'id:a11bef dcterm:modified' in query
+    assert 'id:id:' not in query
+
+
 ###############################################################################
 # _retrieve_paged_ids                                                         #
 ###############################################################################
@@ -375,6 +605,161 @@ def test__retrieve_paged_ids_query_no_result():
     assert result[0] == []
 
 
+###############################################################################
+# retrieve_assets_after                                                       #
+###############################################################################
+@gen_test
+def test_retrieve_assets_after_first_page_query():
+    db = create_mockdb()
+
+    response = Mock()
+    response.buffer = StringIO("""<?xml version="1.0"?>
+<sparql xmlns="http://www.w3.org/2005/sparql-results#"><results></results>
+</sparql>""")
+    db.query.return_value = make_future(response)
+
+    result = yield asset.retrieve_assets_after(
+        db,
+        datetime(2016, 1, 1, 0, 0, 0),
+        datetime(2016, 1, 2, 0, 0, 0),
+        page_size=1000)
+
+    query = db.query.call_args[0][0]
+    assert 'LIMIT 1000' in query
+    assert 'OFFSET' not in query
+    assert 'STR(?id)' not in query
+    assert result == ([], (), None)
+
+
+@gen_test
+def test_retrieve_assets_after_query_starts_after_cursor():
+    db = create_mockdb()
+
+    response = Mock()
+    response.buffer = StringIO("""<?xml version="1.0"?>
+<sparql xmlns="http://www.w3.org/2005/sparql-results#"><results></results>
+</sparql>""")
+    db.query.return_value = make_future(response)
+
+    yield asset.retrieve_assets_after(
+        db,
+        datetime(2016, 1, 1, 0, 0, 0),
+        datetime(2016, 1, 2, 0, 0, 0),
+        after=('2016-01-01T10:00:00+00:00', 'a1b2'),
+        page_size=100)
+
+    query = db.query.call_args[0][0]
+    assert 'LIMIT 100' in query
+    assert 'OFFSET' not in query
+    assert '?when > "2016-01-01T10:00:00+00:00"^^xsd:dateTime' in query
+    assert 'STR(?id) > "http://openpermissions.org/ns/id/a1b2"' in query
+
+
+@gen_test
+def test_retrieve_assets_after_next_cursor():
+    db = create_mockdb()
+
+    response = Mock()
+    response.buffer = StringIO("""<?xml version="1.0"?>
+<sparql xmlns="http://www.w3.org/2005/sparql-results#">
+  <head>
+    <variable name="id"/>
+    <variable name="source_id"/>
+    <variable name="source_id_type"/>
+    <variable name="last_modified"/>
+    <variable name="cursor"/>
+  </head>
+  <results>
+    <result>
+      <binding name="id"><uri>http://openpermissions.org/ns/id/a1</uri></binding>
+      <binding name="source_id"><literal>100</literal></binding>
+      <binding name="source_id_type"><uri>http://openpermissions.org/ns/hub/testid</uri></binding>
+      <binding name="last_modified"><literal datatype="http://www.w3.org/2001/XMLSchema#dateTime">2016-01-01T12:00:00Z</literal></binding>
+      <binding name="cursor"><literal datatype="http://www.w3.org/2001/XMLSchema#dateTime">2016-01-01T10:00:00Z</literal></binding>
+    </result>
+    <result>
+      <binding name="id"><uri>http://openpermissions.org/ns/id/b2</uri></binding>
+      <binding name="source_id"><literal>101</literal></binding>
+      <binding name="source_id_type"><uri>http://openpermissions.org/ns/hub/testid</uri></binding>
+      <binding name="last_modified"><literal datatype="http://www.w3.org/2001/XMLSchema#dateTime">2016-01-01T11:00:00Z</literal></binding>
+      <binding name="cursor"><literal datatype="http://www.w3.org/2001/XMLSchema#dateTime">2016-01-01T11:00:00Z</literal></binding>
+    </result>
+  </results>
+</sparql>
+""")
+    db.query.return_value = make_future(response)
+
+    results, results_range, after = yield asset.retrieve_assets_after(
+        db,
+        datetime(2016, 1, 1, 0, 0, 0),
+        datetime(2016, 1, 2, 0, 0, 0),
+        page_size=2)
+
+    assert [r['entity_id'] for r in results] == ['a1', 'b2']
+    assert 'cursor' not in results[0]
+    assert results[0]['source_id_type'] == 'testid'
+    assert after == ('2016-01-01T11:00:00+00:00', 'b2')
+
+
+@gen_test
+def test_stream_assets_after():
+    db = create_mockdb()
+
+    def query(query, response_type=None, streaming_callback=None):
+        assert response_type == 'tsv'
+        streaming_callback(
+            '?id\t?source_id_value\t?source_id_type\t?last_modified\t?cursor\n'
+            '<http://openpermissions.org/ns/id/a1>\t"100"\t<http://openpermissions.org/ns/hub/testid>\t'
+            '"2016-01-01T12:00:00Z"^^<http://www.w3.org/2001/XMLSchema#dateTime>\t')
+        streaming_callback(
+            '"2016-01-01T10:00:00Z"^^<http://www.w3.org/2001/XMLSchema#dateTime>\n'
+            '<http://openpermissions.org/ns/id/b2>\t"101"\t<http://openpermissions.org/ns/hub/testid>\t'
+            '"2016-01-01T13:00:00Z"^^<http://www.w3.org/2001/XMLSchema#dateTime>\t'
+            '"2016-01-01T11:00:00Z"^^<http://www.w3.org/2001/XMLSchema#dateTime>\n')
+        return make_future(Mock())
+
+    db.query.side_effect = query
+    records = []
+
+    count, results_range, after = yield asset.stream_assets_after(
+        db,
+        datetime(2016, 1, 1, 0, 0, 0),
+        datetime(2016, 1, 2, 0, 0, 0),
+        records.append,
+        after=('2016-01-01T09:00:00+00:00', 'f0'),
+        page_size=2)
+
+    assert 'LIMIT 2' in db.query.call_args[0][0]
+    assert 'STR(?id) > "http://openpermissions.org/ns/id/f0"' in db.query.call_args[0][0]
+    assert count == 2
+    assert [r['entity_id'] for r in records] == ['a1', 'b2']
+    assert unicode(records[0]['source_id']) == '100'
+    assert records[0]['source_id_type'] == 'testid'
+    assert 'cursor' not in records[0]
+    assert map(unicode, results_range) == ['2016-01-01T12:00:00+00:00', '2016-01-01T13:00:00+00:00']
+    assert after == ('2016-01-01T11:00:00+00:00', 'b2')
+
+
+@gen_test
+def test_stream_assets_after_no_result():
+    db = create_mockdb()
+
+    def query(query, response_type=None, streaming_callback=None):
+        streaming_callback('?id\t?source_id_value\t?source_id_type\t?last_modified\t?cursor\n')
+        return make_future(Mock())
+
+    db.query.side_effect = query
+    records = []
+
+    result = yield asset.stream_assets_after(
+        db,
+        datetime(2016, 1, 1, 0, 0, 0),
+        datetime(2016, 1, 2, 0, 0, 0),
+        records.append)
+
+    assert result == (0, (), None)
+    assert records == []
+
 
 ###############################################################################
 # _insert_ids                                                                 #
@@ -533,3 +918,154 @@ def test_insert_ids_errors(_insert_ids, insert_timestamps):
     assert not _insert_ids.call_count >= 1
     assert not insert_timestamps.call_count >= 1
     assert result == ['Missing source_id_type for entry:1']
+
+
+###############################################################################
+# parse once                                                                  #
+###############################################################################
+ASSETS_TTL = """
+@prefix op: <http://openpermissions.org/ns/op/1.1/> .
+@prefix id: <http://openpermissions.org/ns/id/> .
+@prefix hub: <http://openpermissions.org/ns/hub/> .
+
+id:a1 a op:Asset ;
+    op:alsoIdentifiedBy [ a op:Id ; op:id_type hub:testcopictureid ; op:value "p1" ] .
+id:a2 a op:Asset ;
+    op:alsoIdentifiedBy [ a op:Id ; op:id_type hub:testcopictureid ; op:value "p2" ] ,
+                        [ a op:Id ; op:id_type hub:otherid ; op:value "o2" ] .
+"""
+
+
+@patch('repository.models.framework.helper.validate', wraps=helper.validate)
+def test_asset_ids_share_parsed_payload(validate):
+    payload = helper.ParsedPayload(ASSETS_TTL, 'text/turtle')
+
+    entity_ids = [x['entity_id'] for x in asset.get_asset_ids(payload, payload.content_type)]
+    source_ids = {x: asset.get_asset_source_ids(payload, payload.content_type, x) for x in entity_ids}
+    asset.get_asset_ids(payload, payload.content_type)
+
+    assert validate.call_count == 1
+    assert sorted(entity_ids) == ['a1', 'a2']
+    assert source_ids['a1'] == [{'source_id_type': 'testcopictureid', 'source_id': 'p1'}]
+    assert sorted(source_ids['a2']) == [{'source_id_type': 'otherid', 'source_id': 'o2'},
+                                        {'source_id_type': 'testcopictureid', 'source_id': 'p2'}]
+
+
+def test_asset_source_ids_unknown_entity():
+    assert asset.get_asset_source_ids(ASSETS_TTL, 'text/turtle', 'a3') == []
+
+
+###############################################################################
+# _delete                                                                     #
+###############################################################################
+STORED_TTL = """
+@prefix op: <http://openpermissions.org/ns/op/1.1/> .
+@prefix id: <http://openpermissions.org/ns/id/> .
+@prefix hub: <http://openpermissions.org/ns/hub/> .
+
+id:a1 a op:Asset ;
+    op:alsoIdentifiedBy [ op:id_type hub:testcopictureid ; op:value "p1" ] .
+id:a2 a op:Asset ;
+    op:alsoIdentifiedBy [ op:id_type hub:testcopictureid ; op:value "p2" ] ,
+                        [ op:id_type hub:otherid ; op:value "shared" ] .
+id:a3 a op:Asset ;
+    op:alsoIdentifiedBy [ op:id_type hub:otherid ; op:value "shared" ] .
+"""
+
+
+def create_graphdb(data):
+    graph = rdflib.Graph()
+    graph.parse(data=data, format='turtle')
+
+    def query(query, **kwargs):
+        return make_future(Mock(buffer=StringIO(graph.query(query).serialize(format='xml'))))
+
+    def update(query, **kwargs):
+        graph.update(query)
+        return make_future(None)
+
+    db = create_mockdb()
+    db.query.side_effect = query
+    db.update.side_effect = update
+    return db, graph
+
+
+def _subjects(graph):
+    return {str(s).split('/')[-1] for s in graph.subjects(rdflib.RDF.type, None)}
+
+
+@gen_test
+def test_delete_replaces_assets_in_fixed_number_of_requests():
+    db, graph = create_graphdb(STORED_TTL)
+
+    yield asset.Asset._delete(db, [
+        [{'source_id_type': 'testcopictureid', 'source_id': 'p1'}],
+        [{'source_id_type': 'testcopictureid', 'source_id': 'p2'},
+         {'source_id_type': 'otherid', 'source_id': 'shared'}],
+    ])
+
+    assert db.query.call_count == 2
+    assert db.update.call_count == 1
+    assert _subjects(graph) == {'a3'}
+    # the id still used by a3 is kept
+    values = {str(o) for o in graph.objects(None, rdflib.URIRef('http://openpermissions.org/ns/op/1.1/value'))}
+    assert values == {'shared'}
+
+
+@gen_test
+def test_delete_only_exact_matches():
+    db, graph = create_graphdb(STORED_TTL)
+
+    yield asset.Asset._delete(db, [[{'source_id_type': 'otherid', 'source_id': 'shared'}]])
+
+    assert db.update.call_count == 1
+    assert _subjects(graph) == {'a1', 'a2'}
+    values = {str(o) for o in graph.objects(None, rdflib.URIRef('http://openpermissions.org/ns/op/1.1/value'))}
+    assert values == {'p1', 'p2', 'shared'}
+
+
+@gen_test
+def test_delete_no_matching_entities():
+    db, graph = create_graphdb(STORED_TTL)
+
+    yield asset.Asset._delete(db, [[{'source_id_type': 'testcopictureid', 'source_id': 'p3'}]])
+
+    assert db.query.call_count == 1
+    assert db.update.call_count == 0
+
+
+@gen_test
+def test_delete_no_ids():
+    db = create_mockdb()
+    yield asset.Asset._delete(db, [[], []])
+    assert not db.query.called
+
+
+def test_validate_source_ids_invalid():
+    with pytest.raises(HTTPError) as exc:
+        asset.Asset._validate_source_ids([{'source_id': 'p1'}])
+    assert exc.value.status_code == 400
+
+
+@gen_test
+def test_parse_upload_keeps_identifiers():
+    hub_key = 'https://openpermissions.org/s0/hub1/asset/testco/testcopictureid/{}'.format(uuid.uuid4())
+    upload = tempfile.TemporaryFile()
+    upload.write(ASSET_TEMPLATE.format(hub_key=hub_key).encode('utf-8'))
+
+    payload = yield asset.parse_upload(upload, 'text/rdf+n3', 'turtle')
+
+    assert payload.serialize() == (upload, 'text/rdf+n3')
+    assert not upload.closed
+    assert payload.graph.parsed == 18
+    assert len(payload.graph) == 7
+    assert asset.get_asset_ids(payload, 'text/rdf+n3') == [{'entity_id': hub_key.split('/')[-1]}]
+
+
+@gen_test
+def test_parse_upload_invalid():
+    upload = tempfile.TemporaryFile()
+    upload.write(b'<not> <valid')
+
+    with pytest.raises(helper.ValidationException):
+        yield asset.parse_upload(upload, 'text/rdf+n3', 'turtle')
@@ -7,17 +7,68 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 
+import csv
+import json
+import urllib
+
+import pytest
 import rdflib
+from rdflib.compare import isomorphic
 from StringIO import StringIO
 
 from mock import Mock, patch
 from koi.test_helpers import make_future, gen_test
+from tornado.concurrent import Future
+from tornado.gen import sleep
 
 from repository.models.offer import Offer, solve_ns
 
+from repository.models.queries.generic import TURTLE_PREFIXES
+
 from .util import TEST_NAMESPACE, create_mockdb
 
 
+OFFERS_TTL = TURTLE_PREFIXES + '''
+id:0ffe31 a op:Policy, odrl:Offer ;
+    dcterm:title "offer 1" ;
+    odrl:permission id:0ffe31a .
+id:0ffe31a a odrl:Permission ;
+    odrl:action odrl:display ;
+    odrl:target id:a1 ;
+    odrl:assigner id:party1 .
+id:0ffe32 a op:Policy, odrl:Offer ;
+    dcterm:title "offer 2" ;
+    odrl:permission id:0ffe32a .
+id:0ffe32a a odrl:Permission ;
+    odrl:action odrl:print ;
+    odrl:target id:a2 ;
+    odrl:assigner id:party1 .
+id:party1 a odrl:Party .
+id:a2 a op:Agreement .
+'''
+
+MODIFIED_OFFERS_TTL = OFFERS_TTL + '''
+id:0ffe31 dcterm:modified "2016-01-01T00:00:00Z"^^xsd:dateTime .
+'''
+
+BULK_CSV_HEADER = 'entity_id_bundle,ids,policies'
+
+
+def create_graphdb(ttl):
+    graph = rdflib.Graph()
+    graph.parse(data=ttl, format='turtle')
+
+    def query(q, response_type=None):
+        q = q.replace('hint:Query hint:optimizer "Runtime" .', '')
+        result_format = 'json' if response_type == 'json' else 'turtle'
+        return make_future(Mock(body=graph.query(q).serialize(format=result_format)))
+
+    db = create_mockdb()
+    db.query.side_effect = query
+    db.graph = graph
+    return db
+
+
 @gen_test
 def test_retrieve_retrieve_offers_for_assets_empty_list():
     db = create_mockdb()
@@ -25,17 +76,198 @@ def test_retrieve_retrieve_offers_for_assets_empty_list():
     assert result == []
 
 
-@patch('repository.models.offer.Offer._process')
+@patch('repository.models.offer.Offer._attach_policies')
 @gen_test
-def test_retrieve_retrieve_offers_for_assets_one_item(_process):
+def test_retrieve_retrieve_offers_for_assets_one_item(_attach_policies):
     expected = {'nice': 123}
     db = create_mockdb()
-    db.query.return_value = make_future(Mock(buffer=None))
-    _process.return_value = make_future(expected)
+    db.query.return_value = make_future(Mock(buffer=StringIO(BULK_CSV_HEADER)))
+    _attach_policies.return_value = make_future(expected)
 
     result = yield Offer.retrieve_for_assets([{'source_id_type': 'chub', 'source_id': 'id0'}], db)
 
     assert result == expected
+    assert db.query.call_count == 1
+
+
+def _bulk_csv(rows):
+    return StringIO('\n'.join([BULK_CSV_HEADER] + [
+        'http://ns/hub/{0}#{1},http://ns/id/e{1},{2}'.format(id_type, id_value, '|'.join(policies))
+        for id_type, id_value, policies in rows]))
+
+
+@patch('repository.models.policy.options')
+@patch('repository.models.offer.Offer.retrieve_many')
+@gen_test
+def test_retrieve_offers_for_assets_chunked(retrieve_many, options):
+    options.bulk_search_chunk_size = 2
+    options.bulk_search_concurrency = 4
+    retrieve_many.side_effect = lambda rid, oids: make_future({oid: {'id': oid} for oid in oids})
+    db = create_mockdb()
+    db.query.side_effect = [
+        make_future(Mock(buffer=_bulk_csv([('t', '1', ['0ffe1']), ('t', '2', ['0ffe2'])]))),
+        make_future(Mock(buffer=_bulk_csv([('t', '3', ['0ffe1', '0ffe3'])]))),
+    ]
+    ids = [{'source_id_type': 't', 'source_id': str(i)} for i in range(1, 4)]
+
+    result = yield Offer.retrieve_for_assets(ids, db)
+
+    assert db.query.call_count == 2
+    assert '(hub:t "1")' in db.query.call_args_list[0][1]['payload']
+    assert '(hub:t "3")' not in db.query.call_args_list[0][1]['payload']
+    assert '(hub:t "3")' in db.query.call_args_list[1][1]['payload']
+    assert retrieve_many.call_count == 1
+    assert [(x['source_id'], x['offers']) for x in result] == [
+        ('1', [{'id': '0ffe1'}]),
+        ('2', [{'id': '0ffe2'}]),
+        ('3', [{'id': '0ffe1'}, {'id': '0ffe3'}])
+    ]
+
+
+@patch('repository.models.policy.options')
+@patch('repository.models.offer.Offer.retrieve_many', return_value=make_future({}))
+@gen_test
+def test_retrieve_offers_for_assets_bounded_concurrency(retrieve_many, options):
+    options.bulk_search_chunk_size = 1
+    options.bulk_search_concurrency = 2
+    pending = []
+
+    def query(payload, response_type=None):
+        future = Future()
+        pending.append(future)
+        return future
+
+    db = create_mockdb()
+    db.query.side_effect = query
+    ids = [{'source_id_type': 't', 'source_id': str(i)} for i in range(5)]
+
+    result = Offer.retrieve_for_assets(ids, db)
+
+    resolved = 0
+    while resolved < 5:
+        yield sleep(0)
+        assert len(pending) - resolved <= 2
+        pending[resolved].set_result(Mock(buffer=StringIO(BULK_CSV_HEADER)))
+        resolved += 1
+
+    assert (yield result) == []
+    assert db.query.call_count == 5
+
+
+@patch('repository.models.policy.options')
+@patch('repository.models.offer.Offer.retrieve_many')
+@gen_test
+def test_stream_offers_for_assets(retrieve_many, options):
+    options.bulk_search_chunk_size = 2
+    options.bulk_search_concurrency = 4
+    retrieve_many.side_effect = lambda rid, oids: make_future({oid: {'id': oid} for oid in oids})
+    first, second = Future(), Future()
+    db = create_mockdb()
+    db.query.side_effect = [first, second]
+    ids = [{'source_id_type': 't', 'source_id': str(i)} for i in range(1, 4)]
+    streamed = []
+
+    result = Offer.stream_for_assets(ids, db, streamed.append)
+
+    second.set_result(Mock(buffer=_bulk_csv([('t', '3', ['0ffe3'])])))
+    yield sleep(0)
+    assert [[x['source_id'] for x in assets] for assets in streamed] == [['3']]
+
+    first.set_result(Mock(buffer=_bulk_csv([('t', '1', ['0ffe1']), ('t', '2', ['0ffe1'])])))
+    assert (yield result) == 3
+    assert streamed[1][0] == {'source_id': '1', 'source_id_type': 't', 'entity_id': 'e1', 'offers': [{'id': '0ffe1'}]}
+    assert retrieve_many.call_count == 2
+
+
+@patch('repository.models.policy.options')
+@patch('repository.models.offer.Offer.retrieve_many')
+@gen_test
+def test_stream_offers_for_assets_repeated_asset(retrieve_many, options):
+    options.bulk_search_chunk_size = 1
+    options.bulk_search_concurrency = 4
+    retrieve_many.side_effect = lambda rid, oids: make_future({oid: {'id': oid} for oid in oids})
+    db = create_mockdb()
+    # e.g. two spellings of a hub key of the same asset
+    db.query.side_effect = [make_future(Mock(buffer=_bulk_csv([('t', '1', ['0ffe1'])]))),
+                            make_future(Mock(buffer=_bulk_csv([('t', '1', ['0ffe1'])])))]
+    ids = [{'source_id_type': 't', 'source_id': '1'}, {'source_id_type': 't', 'source_id': 'x1'}]
+    streamed = []
+
+    result = yield Offer.stream_for_assets(ids, db, streamed.append)
+
+    assert result == 1
+    assert [[x['source_id'] for x in assets] for assets in streamed] == [['1']]
+
+
+@patch('repository.models.policy.options')
+@patch('repository.models.offer.Offer.retrieve_many')
+@gen_test
+def test_stream_offers_for_assets_waits_for_flush(retrieve_many, options):
+    options.bulk_search_chunk_size = 1
+    options.bulk_search_concurrency = 4
+    retrieve_many.side_effect = lambda rid, oids: make_future({oid: {'id': oid} for oid in oids})
+    db = create_mockdb()
+    db.query.return_value = make_future(Mock(buffer=_bulk_csv([('t', '1', ['0ffe1'])])))
+    flushed = Future()
+
+    result = Offer.stream_for_assets([{'source_id_type': 't', 'source_id': '1'}], db, lambda assets: flushed)
+
+    yield sleep(0)
+    assert not result.done()
+    flushed.set_result(None)
+    assert (yield result) == 1
+
+
+@patch('repository.models.policy.options')
+@patch('repository.models.offer.Offer.retrieve_many')
+@gen_test
+def test_stream_offers_for_assets_chunk_error(retrieve_many, options):
+    options.bulk_search_chunk_size = 1
+    options.bulk_search_concurrency = 4
+    retrieve_many.side_effect = lambda rid, oids: make_future({oid: {'id': oid} for oid in oids})
+    first, second = Future(), Future()
+    db = create_mockdb()
+    db.query.side_effect = [first, second]
+    ids = [{'source_id_type': 't', 'source_id': str(i)} for i in range(1, 3)]
+    streamed = []
+
+    result = Offer.stream_for_assets(ids, db, streamed.append)
+
+    second.set_exception(Exception('database unavailable'))
+    yield sleep(0)
+    # the error is raised once all the chunks completed
+    assert not result.done()
+
+    first.set_result(Mock(buffer=_bulk_csv([('t', '1', ['0ffe1'])])))
+    with pytest.raises(Exception) as exc:
+        yield result
+    assert str(exc.value) == 'database unavailable'
+    assert streamed == []
+
+
+@gen_test
+def test_stream_offers_for_assets_empty_list():
+    db = create_mockdb()
+    streamed = []
+
+    result = yield Offer.stream_for_assets([], db, streamed.append)
+
+    assert result == 0
+    assert streamed == []
+    assert not db.query.called
+
+
+def test_merge_rows():
+    chunks = [
+        [{'source_id_type': 't', 'source_id': '1', 'entity_id': 'e1', 'policies_ids': ['p1', 'p2']}],
+        [{'source_id_type': 't', 'source_id': '2', 'entity_id': 'e2', 'policies_ids': ['p3']},
+         {'source_id_type': 't', 'source_id': '1', 'entity_id': 'e1', 'policies_ids': ['p2', 'p4']}],
+    ]
+
+    assert Offer._merge_rows(chunks) == [
+        {'source_id_type': 't', 'source_id': '1', 'entity_id': 'e1', 'policies_ids': ['p1', 'p2', 'p4']},
+        {'source_id_type': 't', 'source_id': '2', 'entity_id': 'e2', 'policies_ids': ['p3']},
+    ]
 
 
 def test_parse_row_chub_id():
@@ -69,12 +301,63 @@ def test_parse_row_other_id():
     assert Offer._parse_row(Repo, row) == expected
 
 
-@patch('repository.models.offer.Offer.retrieve')
+def test_parse_rows_quoted_ids():
+    csv_buffer = StringIO('\n'.join([
+        'policies,entity_id_bundle,ids',
+        '0ffe31|0ffe32,http://ns/hub/id%2Btype#caf%C3%A9+1,http://ns/id/a11beee1110|http://ns/id/a11beee2220',
+        '0ffe31,http://ns/hub/other_id#caf\xc3\xa9,http://ns/id/a11beee3330',
+    ]))
+
+    result = Offer._parse_rows(None, csv_buffer)
+
+    assert result == [
+        {'entity_id': 'a11beee1110', 'source_id': urllib.unquote_plus(u'caf%C3%A9+1'), 'source_id_type': 'id+type',
+         'policies_ids': ['0ffe31', '0ffe32']},
+        {'entity_id': 'a11beee3330', 'source_id': u'caf\xe9', 'source_id_type': 'other_id',
+         'policies_ids': ['0ffe31']}
+    ]
+    # the rows share the policy ids
+    assert result[0]['policies_ids'][0] is result[1]['policies_ids'][0]
+
+
+def test_parse_rows_empty():
+    assert Offer._parse_rows(None, StringIO('')) == []
+    assert Offer._parse_rows(None, StringIO(BULK_CSV_HEADER + '\n')) == []
+
+
+def _legacy_parse_rows(csv_buffer):
+    """The parser of the bulk search replies replaced by Policy._parse_rows"""
+    result = []
+    for row in csv.DictReader(csv_buffer):
+        row = {k: v.decode('utf-8') for k, v in row.iteritems()}
+        entity_id = str(row['ids']).split('|')[0]
+        source_id_type, source_id = row['entity_id_bundle'].split('#')
+        source_id_type = source_id_type.split('/')[-1]
+        result.append({
+            'entity_id': str(entity_id).split('/')[-1],
+            'source_id': urllib.unquote_plus(source_id),
+            'source_id_type': urllib.unquote_plus(source_id_type),
+            'policies_ids': row['policies'].split('|')
+        })
+    return result
+
+
+def test_parse_rows_matches_dict_reader():
+    data = '\n'.join([BULK_CSV_HEADER] + [
+        'http://openpermissions.org/ns/hub/testcopictureid#{0},http://openpermissions.org/ns/id/{0:032x},'
+        'http://openpermissions.org/ns/id/0ffe{1}|http://openpermissions.org/ns/id/0ffe{2}'.format(i, i % 50, i % 7)
+        for i in range(1000)])
+
+    assert Offer._parse_rows(None, StringIO(data)) == _legacy_parse_rows(StringIO(data))
+
+
+@patch('repository.models.offer.Offer.retrieve_many')
 @gen_test
-def test_process_chub_id_type(retrieve):
+def test_process_chub_id_type(retrieve_many):
     db = create_mockdb()
 
-    retrieve.side_effect = lambda rid, oid: make_future({'entity_id': oid, 'repository_id': rid.repository_id})
+    retrieve_many.side_effect = lambda rid, oids: make_future(
+        {oid: {'entity_id': oid, 'repository_id': rid.repository_id} for oid in oids})
     csv_buffer = StringIO('\n'.join([
         'entity_id_bundle,ids,policies',
         'http://ns/id/hub_key#a11beee1110,a11beee1110,0ffe31|0ffe32',
@@ -105,11 +388,12 @@ def test_process_chub_id_type(retrieve):
     assert result[1] in expected
 
 
-@patch('repository.models.offer.Offer.retrieve')
+@patch('repository.models.offer.Offer.retrieve_many')
 @gen_test
-def test_process_other_id_type(retrieve):
+def test_process_other_id_type(retrieve_many):
     db = create_mockdb()
-    retrieve.side_effect = lambda rid, oid: make_future({'id': oid, 'rid': rid.repository_id})
+    retrieve_many.side_effect = lambda rid, oids: make_future(
+        {oid: {'id': oid, 'rid': rid.repository_id} for oid in oids})
 
     csv_buffer = StringIO('\n'.join([
         'ids,entity_id_bundle,policies',
@@ -134,7 +418,98 @@ def test_process_other_id_type(retrieve):
     ]
     result = yield Offer._process(db, csv_buffer)
     assert (result) == (expected)
+    assert retrieve_many.call_count == 1
+
+
+
+@gen_test
+def test_retrieve_many():
+    db = create_graphdb(OFFERS_TTL)
+
+    result = yield Offer.retrieve_many(db, ['0ffe31', '0ffe32', '0ffe33'], format='graph')
+
+    assert db.query.call_count == 1
+    assert set(result) == {'0ffe31', '0ffe32', '0ffe33'}
+    assert len(result['0ffe33']) == 0
 
+    offer = result['0ffe31']
+    assert set(offer.subjects()) == {solve_ns('id:0ffe31'), solve_ns('id:0ffe31a'), solve_ns('id:party1')}
+    assert (solve_ns('id:0ffe31a'), solve_ns('odrl:action'), solve_ns('odrl:display')) in offer
+    assert (solve_ns('id:0ffe32a'), None, None) not in offer
+    assert (solve_ns('id:party1'), None, None) in result['0ffe32']
+
+
+@gen_test
+def test_retrieve_many_jsonld():
+    db = create_graphdb(OFFERS_TTL)
+
+    result = yield Offer.retrieve_many(db, ['0ffe31', '0ffe33'])
+
+    assert result['0ffe33'] is None
+    ids = [item['@id'] for item in result['0ffe31']['@graph']]
+    assert sorted(ids) == ['id:0ffe31', 'id:0ffe31a', 'id:party1']
+
+    single = yield Offer.retrieve(db, '0ffe31')
+    to_graph = lambda data: rdflib.Graph().parse(data=json.dumps(data), format='json-ld')
+    assert isomorphic(to_graph(result['0ffe31']), to_graph(single))
+
+
+@patch('repository.models.policy._policy_cache', None)
+@gen_test
+def test_retrieve_cached():
+    db = create_graphdb(MODIFIED_OFFERS_TTL)
+
+    first = yield Offer.retrieve(db, '0ffe31')
+    assert db.query.call_count == 2
+
+    second = yield Offer.retrieve(db, '0ffe31')
+    assert db.query.call_count == 3
+    assert second == first
+    assert second is not first
+
+    # modified in the database
+    db.graph.add((solve_ns('id:0ffe31'), solve_ns('dcterm:modified'),
+                  rdflib.Literal('2016-02-01T00:00:00Z', datatype=solve_ns('xsd:dateTime'))))
+    yield Offer.retrieve(db, '0ffe31')
+    assert db.query.call_count == 5
+
+    yield Offer.retrieve(db, '0ffe31')
+    assert db.query.call_count == 6
+
+
+@patch('repository.models.policy._policy_cache', None)
+@gen_test
+def test_retrieve_cache_invalidated():
+    db = create_graphdb(MODIFIED_OFFERS_TTL)
+    db.update = Mock(return_value=make_future(None))
+
+    yield Offer.retrieve(db, '0ffe31')
+    yield Offer.expire(db, '0ffe31', '2016-03-01T00:00:00Z')
+    yield Offer.retrieve(db, '0ffe31')
+    assert db.query.call_count == 4
+
+    yield Offer.retrieve(db, '0ffe31')
+    yield Offer.store(db, 'data', content_type='text/turtle')
+    yield Offer.retrieve(db, '0ffe31')
+    assert db.query.call_count == 7
+
+
+@patch('repository.models.policy._policy_cache', None)
+@gen_test
+def test_retrieve_many_not_cached_without_timestamp():
+    db = create_graphdb(OFFERS_TTL)
+
+    yield Offer.retrieve_many(db, ['0ffe31'])
+    yield Offer.retrieve_many(db, ['0ffe31'])
+    assert db.query.call_count == 4
+
+
+@gen_test
+def test_retrieve_many_empty():
+    db = create_mockdb()
+    result = yield Offer.retrieve_many(db, [])
+    assert result == {}
+    assert not db.query.called
 
 
 @gen_test
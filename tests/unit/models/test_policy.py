@@ -51,6 +51,10 @@ selectors = Mock(return_value=make_future(SELECTOR_TARGETS))
 DB = create_mockdb()
 
 
+def all_members(repository, set_id, element_ids):
+    return make_future(set(element_ids))
+
+
 @patch.object(Policy, 'get_targets', return_value=make_future(ASSET_TARGETS))
 @gen_test
 def test_validate_assets(get_targets):
@@ -106,17 +110,17 @@ def test_validate_target_asset_not_in_policy_not_all_required():
     assert sorted(assets) == ASSETS
 
 
-@patch.object(Set, 'has_element', return_value=make_future(True))
+@patch.object(Set, 'filter_members', side_effect=all_members)
 @patch.object(Policy, 'get_targets', selectors)
 @gen_test
-def test_validate_asset_selector(mock_has_element):
+def test_validate_asset_selector(mock_filter_members):
     assets = yield Policy.validate_assets(DB, ENTITY_ID, ['asset1'])
 
     assert assets == ['asset1']
-    mock_has_element.assert_called_once_with(DB, 'set1', 'asset1')
+    mock_filter_members.assert_called_once_with(DB, 'set1', {'asset1'})
 
 
-@patch.object(Set, 'has_element', Mock(return_value=make_future(False)))
+@patch.object(Set, 'filter_members', Mock(return_value=make_future(set())))
 @patch.object(Policy, 'get_targets', selectors)
 @gen_test
 def test_validate_no_assets_within_selector():
@@ -124,7 +128,7 @@ def test_validate_no_assets_within_selector():
         yield Policy.validate_assets(DB, ENTITY_ID, ['asset1'])
 
 
-@patch.object(Set, 'has_element', Mock(return_value=make_future(True)))
+@patch.object(Set, 'filter_members', Mock(side_effect=all_members))
 @patch.object(Policy, 'get_targets', selectors)
 @gen_test
 def test_validate_selected_too_many_assets():
@@ -132,7 +136,7 @@ def test_validate_selected_too_many_assets():
         yield Policy.validate_assets(DB, ENTITY_ID, ['asset1', 'asset2'])
 
 
-@patch.object(Set, 'has_element', Mock(return_value=make_future(True)))
+@patch.object(Set, 'filter_members', Mock(side_effect=all_members))
 @gen_test
 def test_validate_selected_multiple_assets_in_selector():
     selectors = Mock(return_value=make_future([{
@@ -150,7 +154,7 @@ def test_validate_selected_multiple_assets_in_selector():
     assert sorted(assets) == ['asset1', 'asset2', 'asset3']
 
 
-@patch.object(Set, 'has_element', Mock(return_value=make_future(True)))
+@patch.object(Set, 'filter_members', Mock(side_effect=all_members))
 @patch.object(Policy, 'get_targets', selectors)
 @gen_test
 def test_validate_no_assets_selected_for_selector():
@@ -180,9 +184,9 @@ def test_ignore_invalid_target_type():
     assert assets == ['asset1']
 
 
-@patch.object(Set, 'has_element', return_value=make_future(False))
+@patch.object(Set, 'filter_members', return_value=make_future(set()))
 @gen_test
-def test_no_select_required(has_element):
+def test_no_select_required(filter_members):
     targets = Mock(return_value=make_future([{
         'id': 'assetselector1',
         'type': 'http://openpermissions.org/ns/op/1.1/AssetSelector',
@@ -198,9 +202,9 @@ def test_no_select_required(has_element):
 
 
 
-@patch.object(Set, 'has_element', return_value=make_future(True))
+@patch.object(Set, 'filter_members', side_effect=all_members)
 @gen_test
-def test_no_select_required_asset_in_set(has_element):
+def test_no_select_required_asset_in_set(filter_members):
     targets = Mock(return_value=make_future([{
         'id': 'assetselector1',
         'type': 'http://openpermissions.org/ns/op/1.1/AssetSelector',
@@ -217,7 +221,7 @@ def test_no_select_required_asset_in_set(has_element):
 
 
 
-@patch.object(Set, 'has_element', Mock(return_value=make_future(True)))
+@patch.object(Set, 'filter_members', Mock(side_effect=all_members))
 @gen_test
 def test_ignore_invalid_selector():
     targets = Mock(return_value=make_future([{
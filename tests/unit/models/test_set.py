@@ -7,10 +7,15 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 
+import json
+
+import pytest
 import rdflib
-from mock import patch
+from mock import patch, Mock
 from koi.test_helpers import make_future, gen_test
 from repository.models.set import Set
+from repository.models.framework.helper import ValidationException
+from repository.models.queries.generic import PREFIXES, SPARQL_PREFIXES
 from .util import create_mockdb
 
 
@@ -34,6 +39,50 @@ def test_set_has_element():
     assert r is False
 
 
+def _members_response(*uris):
+    rsp = Mock()
+    rsp.body = json.dumps({'results': {'bindings': [{'element': {'type': 'uri', 'value': uri}} for uri in uris]}})
+    return make_future(rsp)
+
+
+@gen_test
+def test_set_filter_members():
+    db = create_mockdb()
+    db.query.return_value = _members_response('http://openpermissions.org/ns/id/1d0002')
+
+    r = yield Set.filter_members(db, "504504", ["1d0001", "1d0002", "1d0002"])
+
+    assert r == {"1d0002"}
+    assert db.query.call_count == 1
+    query = db.query.call_args[0][0]
+    assert 'VALUES ?element { id:1d0001 id:1d0002 }' in query
+    assert 'id:504504 op:hasElement ?element' in query
+
+
+@gen_test
+def test_set_filter_members_chunked():
+    db = create_mockdb()
+    db.query.side_effect = [_members_response('http://openpermissions.org/ns/id/1d0001'),
+                            _members_response('http://openpermissions.org/ns/id/1d0003')]
+
+    with patch('repository.models.set.options') as options:
+        options.set_membership_chunk_size = 2
+        r = yield Set.filter_members(db, "504504", ["1d0001", "1d0002", "1d0003"])
+
+    assert r == {"1d0001", "1d0003"}
+    assert db.query.call_count == 2
+    assert 'VALUES ?element { id:1d0003 }' in db.query.call_args[0][0]
+
+
+@gen_test
+def test_set_filter_members_no_elements():
+    db = create_mockdb()
+    r = yield Set.filter_members(db, "504504", [])
+
+    assert r == set()
+    assert not db.query.called
+
+
 @gen_test
 def test_set_get_elements():
     db = create_mockdb()
@@ -47,6 +96,30 @@ def test_set_get_elements():
     assert set(r) == set([x[0] for x in reply])
 
 
+@gen_test
+def test_set_get_elements_after():
+    db = create_mockdb()
+
+    with patch('repository.models.set.Set._parse_response', return_value=[]):
+        yield Set.get_elements(db, "504504", page_size=10, after="1d0001")
+
+    query = db.query.call_args[0][0]
+    assert 'FILTER((STR(?o) > "http://openpermissions.org/ns/id/1d0001"))' in query
+    assert 'LIMIT 10' in query
+    assert 'OFFSET' not in query
+
+
+@gen_test
+def test_set_get_elements_page():
+    db = create_mockdb()
+
+    with patch('repository.models.set.Set._parse_response', return_value=[]):
+        yield Set.get_elements(db, "504504", page=3, page_size=10)
+
+    query = db.query.call_args[0][0]
+    assert 'OFFSET 20' in query
+    assert 'STR(?o)' not in query
+
 @gen_test
 def test_set_set_elements2():
     db = create_mockdb()
@@ -64,3 +137,97 @@ def test_set_remove_elements():
     db = create_mockdb()
     yield Set.remove_elements(db, "504504", ["1d0001", "1d0002"])
     assert db.update.call_count == 1
+
+
+@gen_test
+def test_set_set_elements_chunked():
+    db = create_mockdb()
+    with patch('repository.models.set.options') as options:
+        options.set_update_chunk_size = 2
+        yield Set.set_elements(db, "504504", ["1d0001", "1d0002", "1d0003"])
+
+    queries = [call[0][0] for call in db.update.call_args_list]
+    assert len(queries) == 3
+    staging = queries[0].split('<urn:x-repository:stagedFor>')[0].split()[-1]
+    assert staging.startswith('<urn:x-repository:setStaging:')
+    assert '{} <urn:x-repository:stagedElement> id:1d0001 .'.format(staging) in queries[0]
+    assert 'id:1d0003' in queries[1] and staging in queries[1]
+    assert 'stagedFor' not in queries[1]
+    assert 'INSERT {{ id:504504 op:hasElement ?element }} WHERE {{ {} <urn:x-repository:stagedElement> ?element }}'\
+        .format(staging) in queries[2]
+    assert 'DELETE {{ {} ?p ?o }}'.format(staging) in queries[2]
+    assert 'dcterm:modified' in queries[2]
+
+
+@gen_test
+def test_set_set_elements_error_removes_staged_elements():
+    db = create_mockdb()
+    db.update.side_effect = [make_future(None), Exception('timeout'), make_future(None)]
+    with patch('repository.models.set.options') as options:
+        options.set_update_chunk_size = 1
+        with pytest.raises(Exception):
+            yield Set.set_elements(db, "504504", ["1d0001", "1d0002"])
+
+    queries = [call[0][0] for call in db.update.call_args_list]
+    assert len(queries) == 3
+    assert 'DELETE { <urn:x-repository:setStaging:' in queries[2]
+    assert 'op:hasElement' not in ''.join(queries)
+
+
+@gen_test
+def test_set_set_elements_staging():
+    graph = rdflib.Graph()
+    graph.update(SPARQL_PREFIXES + """
+    INSERT DATA {
+        id:504504 a op:Set ; op:hasElement id:1d0009 .
+        <urn:x-repository:setStaging:0ld> <urn:x-repository:stagedFor> id:504504 ;
+            <urn:x-repository:stagingStarted> "2016-01-01T00:00:00+00:00"^^xsd:dateTime ;
+            <urn:x-repository:stagedElement> id:1d0008 .
+    }""")
+    db = create_mockdb()
+    db.update.side_effect = lambda query: make_future(graph.update(query))
+    with patch('repository.models.set.options') as options:
+        options.set_update_chunk_size = 2
+        options.set_staging_ttl = 3600.0
+        replacement = Set.replace_elements(db, "504504")
+        yield replacement.add(["1d0001", "1d0002", "1d0003"])
+
+    # the staged elements are not elements of the set, the stale staging is removed
+    elements = {str(o) for o in graph.objects(rdflib.URIRef(PREFIXES['id'] + '504504'), None)}
+    assert elements == {PREFIXES['op'] + 'Set', PREFIXES['id'] + '1d0009'}
+    assert not list(graph.triples((rdflib.URIRef('urn:x-repository:setStaging:0ld'), None, None)))
+
+    yield replacement.commit()
+
+    assert set(graph.objects(None, rdflib.URIRef(PREFIXES['op'] + 'hasElement'))) == {
+        rdflib.URIRef(PREFIXES['id'] + x) for x in ["1d0001", "1d0002", "1d0003"]}
+    assert not [s for s in graph.subjects() if s.startswith('urn:x-repository:')]
+
+
+@gen_test
+def test_set_set_elements_abort_removes_staging():
+    graph = rdflib.Graph()
+    db = create_mockdb()
+    db.update.side_effect = lambda query: make_future(graph.update(query))
+    with patch('repository.models.set.options') as options:
+        options.set_update_chunk_size = 1
+        options.set_staging_ttl = 3600.0
+        replacement = Set.replace_elements(db, "504504")
+        yield replacement.add(["1d0001", "1d0002"])
+
+    assert len(graph)
+    yield replacement.abort()
+
+    assert len(graph) == 0
+
+
+def test_normalise_id():
+    assert Set.normalise_id('A1B2') == 'id:a1b2'
+    assert Set.normalise_id(PREFIXES['id'] + 'a1b2') == 'id:a1b2'
+    assert Set.normalise_id('id:a1b2') == 'id:a1b2'
+
+
+def test_normalise_id_invalid_not_memoised():
+    for _ in range(2):
+        with pytest.raises(ValidationException):
+            Set.normalise_id('not an id')
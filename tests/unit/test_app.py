@@ -58,3 +58,43 @@ def test_main_starts_an_instance(load_config, make_server, make_application,
                                  instance, options, audit):
     repository.app.main()
     assert instance().start.call_count == 1
+
+
+@patch('repository.app.audit')
+@patch('repository.app.options')
+@patch('tornado.ioloop.PeriodicCallback')
+@patch('tornado.ioloop.IOLoop.instance')
+@patch('repository.app.koi.make_server')
+@patch('repository.app.koi.load_config')
+def test_main_logs_stats(load_config, make_server, instance, PeriodicCallback,
+                         options, audit):
+    options.stats_log_interval = 60
+
+    repository.app.main()
+    PeriodicCallback.assert_called_once_with(repository.app.log_stats, 60000.0, io_loop=instance())
+    assert PeriodicCallback().start.call_count == 1
+
+
+@patch('repository.app.audit')
+@patch('repository.app.options')
+@patch('tornado.ioloop.PeriodicCallback')
+@patch('tornado.ioloop.IOLoop.instance')
+@patch('repository.app.koi.make_server')
+@patch('repository.app.koi.load_config')
+def test_main_stats_not_logged(load_config, make_server, instance, PeriodicCallback,
+                               options, audit):
+    options.stats_log_interval = 0
+
+    repository.app.main()
+    assert not PeriodicCallback.called
+
+
+@patch('repository.app.logging')
+@patch('repository.controllers.stats_handler.workers.pool_stats', return_value={'pending': 2})
+@patch('repository.controllers.stats_handler.base.cache_stats', return_value={'token': {'hits': 1}})
+@patch('repository.controllers.stats_handler.db.pool_stats', return_value={'requests': 3})
+def test_log_stats(pool_stats, cache_stats, worker_stats, logging):
+    repository.app.log_stats()
+
+    logging.info.assert_called_once_with(
+        'stats: %s', '{"cache": {"token": {"hits": 1}}, "db": {"requests": 3}, "rdf_workers": {"pending": 2}}')